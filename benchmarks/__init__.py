@@ -0,0 +1,7 @@
+"""
+Benchmarks of the dump-analysis hot paths of mkat_fpga_tests, on synthetic data.
+
+Usage:
+
+python -m benchmarks.bench_dump_analysis --instrument bc8n856M4k --output katreport/benchmarks.json
+"""
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Time and measure the peak memory of the dump-analysis utilities on synthetic accumulations of
+each instrument shape, and write the results as JSON.
+
+Usage:
+
+python -m benchmarks.bench_dump_analysis                   # all instruments
+python -m benchmarks.bench_dump_analysis --instrument bc8n856M4k --repeat 3 \
+    --baseline katreport/benchmarks.json                   # exits 1 on regressions
+"""
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from collections import namedtuple
+from optparse import OptionParser
+from timeit import default_timer
+
+import numpy as np
+
+from memory_profiler import memory_usage
+
+from benchmarks.synthetic import (INSTRUMENTS, SAMPLE_RATE, delay_dumps, instrument_shape,
+                                  write_power_log, xeng_raw)
+from mkat_fpga_tests.delay_model import (baseline_visibilities, fit_phases, model_delays,
+                                         model_phases, nyquist_chan_freqs,
+                                         parse_delay_coefficients)
+from mkat_fpga_tests.power_logger import analyse_power_log, load_power_log
+from mkat_fpga_tests.utils import (DumpView, all_nonzero_baselines, baseline_checker,
+                                   classify_baselines, complexise, loggerise, magnetise, normalise,
+                                   normalised_magnitude, nonzero_baselines, xeng_magnitude,
+                                   xeng_phase, zero_baselines)
+
+LOGGER = logging.getLogger('mkat_fpga_tests')
+
+Benchmark = namedtuple('Benchmark', 'name data fn')
+"""
+name: Str
+data: Function mapping an instrument name to the benchmark input
+fn: Function called with the input, the code being measured
+"""
+
+
+def per_baseline(fn):
+    """Apply `fn` to every baseline of xeng_raw in turn, as the tests do"""
+    def apply(xeng_raw):
+        for baseline in xrange(xeng_raw.shape[1]):
+            fn(xeng_raw[:, baseline, :])
+    return apply
+
+
+def expected_delay_data(data):
+    """Analysis of test_CBF._get_actual_data and _get_expected_data, without the reporting"""
+    dumps, delay_coefficients, n_chans = data
+    sample_period = 1 / SAMPLE_RATE
+    visibilities = baseline_visibilities(dumps, 1)
+    phases = np.angle(visibilities)
+    response = normalise(np.abs(visibilities))
+    coefficients = parse_delay_coefficients(delay_coefficients)[0]
+    model_delays(coefficients, len(dumps), 0.5)
+    chan_freqs = nyquist_chan_freqs(n_chans, sample_period)
+    model_phases(coefficients, chan_freqs, reference_freq=0.25 / sample_period,
+                 n_dumps=len(dumps), int_time=0.5)
+    return fit_phases(phases, chan_freqs, reference_freq=0.25 / sample_period, weights=response)
+
+
+def product_baselines(xeng_raw):
+    """Analysis of one test_CBF._test_product_baselines step, without the reporting"""
+    dump_view = DumpView(xeng_raw)
+    dump_view.normalised_magnitude(range(5))
+    return np.sum(dump_view.power(np.flatnonzero(dump_view.baseline_classes.nonzero)))
+
+
+def power_log_data(instrument):
+    """The log is the same for every instrument: an hour of 8 PDUs"""
+    power_log_file = os.path.join(tempfile.gettempdir(), 'benchmark_power_log.csv')
+    start_timestamp = write_power_log(power_log_file)
+    return power_log_file, start_timestamp
+
+
+def process_power_log(data):
+    """Analysis of test_CBF._process_power_log, without the reporting"""
+    power_log_file, start_timestamp = data
+    return analyse_power_log(load_power_log(power_log_file, start_timestamp), time_gap=60)
+
+
+def _delay_data(instrument):
+    dumps, coefficients = delay_dumps(instrument)
+    return dumps, coefficients, instrument_shape(instrument)[0]
+
+
+BENCHMARKS = [
+    Benchmark('complexise', xeng_raw, per_baseline(complexise)),
+    Benchmark('magnetise', xeng_raw, per_baseline(magnetise)),
+    Benchmark('normalised_magnitude', xeng_raw, per_baseline(normalised_magnitude)),
+    Benchmark('loggerise', xeng_raw,
+              per_baseline(lambda data: loggerise(normalised_magnitude(data)))),
+    Benchmark('xeng_magnitude', xeng_raw, xeng_magnitude),
+    Benchmark('xeng_phase', xeng_raw, xeng_phase),
+    Benchmark('baseline_checker', xeng_raw,
+              lambda data: baseline_checker(data, lambda baseline: np.any(baseline))),
+    Benchmark('classify_baselines', xeng_raw, classify_baselines),
+    Benchmark('zero_baselines', xeng_raw, zero_baselines),
+    Benchmark('nonzero_baselines', xeng_raw, nonzero_baselines),
+    Benchmark('all_nonzero_baselines', xeng_raw, all_nonzero_baselines),
+    Benchmark('product_baselines', xeng_raw, product_baselines),
+    Benchmark('get_expected_data', _delay_data, expected_delay_data),
+    Benchmark('process_power_log', power_log_data, process_power_log),
+]
+
+
+def measure(fn, data, repeat=5):
+    """
+    :param: fn: Function called with `data`
+    :param: data: Benchmark input
+    :param: repeat: Int, timed calls
+    :rtype: Dict: best and mean time [s] and peak memory above the baseline [MiB]
+    """
+    times = []
+    for _ in xrange(repeat):
+        start = default_timer()
+        fn(data)
+        times.append(default_timer() - start)
+    # A separate, untimed call: sampling memory slows the call down
+    base_memory = memory_usage(-1, interval=0.01, timeout=0.05, max_usage=True)
+    peak_memory = memory_usage((fn, (data,)), interval=0.005, max_usage=True)
+    # Older memory_profiler versions return a single element list
+    base_memory, peak_memory = [np.max(memory) for memory in (base_memory, peak_memory)]
+    return {
+        'best': min(times),
+        'mean': float(np.mean(times)),
+        'repeat': repeat,
+        'peak_memory_mib': max(float(peak_memory - base_memory), 0.),
+    }
+
+
+def run(instruments=INSTRUMENTS, benchmarks=None, repeat=5):
+    """
+    :param: instruments: List of Str
+    :param: benchmarks: List of Str, benchmark names, all if None
+    :param: repeat: Int
+    :rtype: Dict, the JSON report
+    """
+    results = []
+    selected = [benchmark for benchmark in BENCHMARKS
+                if benchmarks is None or benchmark.name in benchmarks]
+    for instrument in instruments:
+        data_cache = {}
+        for benchmark in selected:
+            if benchmark.data not in data_cache:
+                data_cache[benchmark.data] = benchmark.data(instrument)
+            result = measure(benchmark.fn, data_cache[benchmark.data], repeat)
+            result.update(benchmark=benchmark.name, instrument=instrument,
+                          shape=list(instrument_shape(instrument)) + [2])
+            LOGGER.info('%(benchmark)s %(instrument)s: best %(best).4fs, mean %(mean).4fs, '
+                        'peak memory %(peak_memory_mib).1fMiB' % result)
+            print '{benchmark:>22} {instrument:>13} {best:10.4f}s {mean:10.4f}s ' \
+                  '{peak_memory_mib:8.1f}MiB'.format(**result)
+            results.append(result)
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'results': results,
+    }
+
+
+def regressions(report, baseline, tolerance=0.25):
+    """
+    :param: report: Dict, as returned by run
+    :param: baseline: Dict, an earlier report
+    :param: tolerance: Float, allowed fractional increase of the best time or peak memory
+    :rtype: List of Str, one line per regression
+    """
+    previous = dict(((result['benchmark'], result['instrument']), result)
+                    for result in baseline['results'])
+    lines = []
+    for result in report['results']:
+        old = previous.get((result['benchmark'], result['instrument']))
+        if old is None:
+            continue
+        for key, unit in (('best', 's'), ('peak_memory_mib', 'MiB')):
+            # Ignore increases below the timer and memory sampling resolution
+            if result[key] > (1 + tolerance) * old[key] and result[key] - old[key] > 1e-3:
+                lines.append('{} {} {}: {:.4f}{} -> {:.4f}{}'.format(
+                    result['benchmark'], result['instrument'], key, old[key], unit,
+                    result[key], unit))
+    return lines
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--instrument', dest='instruments', action='append', default=None,
+                      help='Instrument shape to benchmark, can be repeated. Default: all of '
+                           '{}'.format(', '.join(INSTRUMENTS)))
+    parser.add_option('--benchmark', dest='benchmarks', action='append', default=None,
+                      help='Benchmark to run, can be repeated. Default: all of {}'.format(
+                          ', '.join(benchmark.name for benchmark in BENCHMARKS)))
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+                      help='Timed calls per benchmark. Default: %default')
+    parser.add_option('--output', dest='output', default='katreport/benchmarks.json',
+                      help='JSON report. Default: %default')
+    parser.add_option('--baseline', dest='baseline', default=None,
+                      help='Earlier JSON report, exit with status 1 on regressions')
+    parser.add_option('--tolerance', dest='tolerance', type='float', default=0.25,
+                      help='Allowed fractional increase over the baseline. Default: %default')
+    options, _args = parser.parse_args()
+
+    baseline = None
+    if options.baseline is not None:
+        with open(options.baseline) as fh:
+            baseline = json.load(fh)
+    report = run(options.instruments or INSTRUMENTS, options.benchmarks, options.repeat)
+    output_dir = os.path.dirname(options.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(options.output, 'w') as fh:
+        fh.write(json.dumps(report, indent=4))
+    print 'Benchmark report written to {}'.format(options.output)
+
+    if baseline is not None:
+        lines = regressions(report, baseline, options.tolerance)
+        for line in lines:
+            print 'REGRESSION: {}'.format(line)
+        return 1 if lines else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Synthetic correlator data in the shapes of each instrument, for benchmarking without hardware.
+"""
+import csv
+import re
+
+import numpy as np
+
+INSTRUMENTS = ('bc8n856M4k', 'bc8n856M32k', 'bc16n856M4k', 'bc16n856M32k', 'bc32n856M4k',
+               'bc32n856M32k')
+SAMPLE_RATE = 1712e6
+
+
+def instrument_shape(instrument):
+    """
+    :param: instrument: Str, e.g. 'bc8n856M4k'
+    :rtype: tuple: (Int channels, Int baselines), the leading dimensions of xeng_raw
+    :raises: ValueError if the instrument name is not recognised
+    """
+    match = re.match(r'^b?c(\d+)n\d+M(\d+)k$', instrument)
+    if match is None:
+        raise ValueError('%s is not a valid instrument name' % instrument)
+    n_inputs, n_chans = [int(value) for value in match.groups()]
+    n_ants = n_inputs // 2
+    # Four polarisation products per antenna pair, autocorrelations included
+    return n_chans * 1024, 4 * n_ants * (n_ants + 1) // 2
+
+
+def xeng_raw(instrument, zero_fraction=0.25, seed=0):
+    """
+    Accumulation of noise-like visibilities
+
+    Every fourth baseline is an autocorrelation with a positive real part. `zero_fraction` of
+    the baselines are all zero, as when inputs are disabled, so the baseline checkers see all
+    three classes of baseline.
+
+    :param: instrument: Str, e.g. 'bc8n856M4k'
+    :param: zero_fraction: Float, fraction of baselines with all-zero data
+    :param: seed: Int
+    :rtype: (channels x baselines x 2) int32 array, as SPEAD xeng_raw
+    """
+    n_chans, n_bls = instrument_shape(instrument)
+    rng = np.random.RandomState(seed)
+    data = np.zeros((n_chans, n_bls, 2), dtype=np.int32)
+    zero = set(rng.permutation(n_bls)[:int(zero_fraction * n_bls)].tolist())
+    # Generated a baseline at a time to keep temporaries small on 32k instruments
+    for baseline in xrange(n_bls):
+        if baseline in zero:
+            continue
+        values = rng.standard_normal((n_chans, 2)) * 2 ** 20
+        if baseline % 4 == 0:
+            values[:, 0] = np.abs(values[:, 0]) + 2 ** 24
+            values[:, 1] = 0
+        data[:, baseline, :] = values
+    return data
+
+
+def delay_dumps(instrument, n_dumps=4, delay_samples=2.5, fringe_offset=0.3, seed=0):
+    """
+    Accumulations of a baseline with a delayed input, as used by the delay tests
+
+    :param: instrument: Str
+    :param: n_dumps: Int
+    :param: delay_samples: Float, delay [ADC samples]
+    :param: fringe_offset: Float [rad]
+    :param: seed: Int
+    :rtype: tuple: (List of Dict accumulations with key 'xeng_raw', List of Str coefficients
+            of the delayed input)
+    """
+    n_chans, n_bls = instrument_shape(instrument)
+    rng = np.random.RandomState(seed)
+    chan_freqs = np.arange(n_chans) * SAMPLE_RATE / (2. * n_chans)
+    phases = (2 * np.pi * delay_samples / SAMPLE_RATE * (chan_freqs - SAMPLE_RATE / 4.) -
+              fringe_offset)
+    dumps = []
+    for _ in xrange(n_dumps):
+        data = np.zeros((n_chans, n_bls, 2), dtype=np.int32)
+        noisy = phases + 0.05 * rng.standard_normal(n_chans)
+        data[:, 1, 0] = 2 ** 24 * np.cos(noisy)
+        data[:, 1, 1] = 2 ** 24 * np.sin(noisy)
+        dumps.append({'xeng_raw': data})
+    coefficients = ['{},0:{},0'.format(delay_samples / SAMPLE_RATE, fringe_offset)]
+    return dumps, coefficients
+
+
+def write_power_log(filename, n_samples=3600, n_pdus=8, sample_period=1, seed=0):
+    """
+    Write a PowerLogger log of `n_pdus` PDUs sampled on a shared clock
+
+    :param: filename: Str
+    :param: n_samples: Int, samples per PDU
+    :param: n_pdus: Int, two PDUs per rack
+    :param: sample_period: Int [s]
+    :param: seed: Int
+    :rtype: Int, timestamp of the first sample
+    """
+    rng = np.random.RandomState(seed)
+    start_time = 1500000000
+    hosts = ['rack{}-pdu{}'.format(pdu // 2, pdu % 2) for pdu in xrange(n_pdus)]
+    with open(filename, 'wb') as csvfile:
+        csv_writer = csv.writer(csvfile, delimiter='\t')
+        csv_writer.writerow(['Sample Time', 'PDU Host', 'Phase Current', 'Phase Power'])
+        for sample in xrange(n_samples):
+            smpl_time = str(start_time + sample * sample_period)
+            currents = 8 + rng.standard_normal((n_pdus, 3))
+            for host, current in zip(hosts, currents):
+                csv_writer.writerow([smpl_time, host,
+                                     ','.join('{:.2f}'.format(i) for i in current),
+                                     ','.join('{:.3f}'.format(i * 0.23) for i in current)])
+    return start_time
@@ -94,6 +94,14 @@ class CorrelatorFixture(object):
         self._katcp_rct = None
         self._rct = None
         self.katcp_array_port = None
+        # Cached mkat_fpga_tests.utils.InstrumentParameters, see utils.parameters
+        self.instrument_parameters = None
+        # Shared mkat_fpga_tests.utils.BeamCaptureSession, see utils.beam_capture_session
+        self.beam_capture_session = None
+        # Measured pipeline latencies, see mkat_fpga_tests.latency.dumps_until_effective
+        self.latency_calibrator = None
+        # mkat_fpga_tests.digital_twin.DigitalTwin standing in for the hardware, see use_twin
+        self.twin = None
         self.product_name = product_name
         self.halt_wait_time = 5
         # Assume the correlator is already started if start_correlator is False
@@ -103,6 +111,23 @@ class CorrelatorFixture(object):
         self.test_config = self._test_config_file
         self.array_name, self.instrument = self._get_instrument
 
+    def invalidate_parameters(self):
+        """Invalidate cached instrument parameters and beam settings, e.g. after an instrument
+        or accumulation length change"""
+        if self.instrument_parameters is not None:
+            self.instrument_parameters.invalidate()
+        if self.beam_capture_session is not None:
+            self.beam_capture_session.invalidate()
+
+    def use_twin(self, twin):
+        """Run against a mkat_fpga_tests.digital_twin.DigitalTwin instead of CBF hardware"""
+        self.twin = twin
+        self.instrument = twin.model.instrument
+        self.corr_config = twin.correlator.configd
+        self._correlator_started = True
+        self.invalidate_parameters()
+        LOGGER.info('Using digital twin running %s' % self.instrument)
+
     @property
     def rct(self):
         if self._rct is not None:
@@ -138,6 +163,8 @@ class CorrelatorFixture(object):
 
     @property
     def dhost(self, program=False):
+        if self.twin is not None:
+            return self.twin.dhost
         if self._dhost is not None:
             return self._dhost
         else:
@@ -182,6 +209,8 @@ class CorrelatorFixture(object):
 
     @property
     def correlator(self):
+        if self.twin is not None:
+            return self.twin.correlator
         if self._correlator is not None:
             LOGGER.info('Using cached correlator instance')
             return self._correlator
@@ -266,11 +295,17 @@ class CorrelatorFixture(object):
 
         self._correlator_started = False
         self._correlator = None
+        self.invalidate_parameters()
+        # Reprogrammed hosts may have a different pipeline latency
+        if self.latency_calibrator is not None:
+            self.latency_calibrator.invalidate()
         LOGGER.info('Array %s halted and teared-down' % (self.array_name))
         time.sleep(self.halt_wait_time)
 
     @property
     def katcp_rct(self):
+        if self.twin is not None:
+            return self.twin.katcp_rct
         try:
             katcp_prot = self.test_config['inst_param']['katcp_protocol']
         except TypeError:
@@ -467,6 +502,11 @@ class CorrelatorFixture(object):
         :rtype: Boolean
         """
         self.instrument = instrument
+        self.invalidate_parameters()
+        if self.twin is not None:
+            success = self.twin.ensure_instrument(self.instrument)
+            self.corr_config = self.twin.correlator.configd
+            return success
         if force_reinit:
             LOGGER.info('Forcing an instrument(%s) re-initialisation' %self.instrument)
             corr_success = self.start_correlator(self.instrument, **kwargs)
@@ -650,6 +690,9 @@ class CorrelatorFixture(object):
     @property
     def subscribe_multicast(self):
         """Automated multicasting subscription"""
+        if self.twin is not None:
+            # The twin hands accumulations to its receiver directly
+            return True
         parse_address = StreamAddress._parse_address_string
         try:
             n_xengs = self.katcp_rct.sensor.n_xengs.get_value()
@@ -716,6 +759,7 @@ class CorrelatorFixture(object):
         if instrument is not None:
             self.instrument = instrument
         self._correlator = None  # Invalidate cached correlator instance
+        self.invalidate_parameters()
         LOGGER.info('Confirm DEngine is running before starting correlator')
         if not self.dhost.is_running():
             raise RuntimeError('DEngine: %s not running.' % (self.dhost.host))
@@ -0,0 +1,286 @@
+"""
+Expected correlator phases for delay and fringe tests.
+
+Delay coefficients are handled as (inputs x 4) arrays with columns DELAY_FIELDS, parsed from
+and formatted to the 'delay,delay_rate:fringe_offset,fringe_rate' strings of the CAM `delays`
+request.
+"""
+import logging
+import numpy as np
+
+from collections import namedtuple
+from mkat_fpga_tests.utils import DumpRingBuffer, complexise
+
+LOGGER = logging.getLogger('mkat_fpga_tests')
+
+DELAY_FIELDS = ('delay', 'delay_rate', 'fringe_offset', 'fringe_rate')
+
+
+def parse_delay_coefficients(delay_coefficients):
+    """
+    :param: delay_coefficients: List of Str, 'delay,delay_rate:fringe_offset,fringe_rate' per input
+    :rtype: (inputs x 4) array of Float, columns as DELAY_FIELDS
+    :raises: ValueError if a coefficient string is malformed
+    """
+    coefficients = []
+    for coefficient in delay_coefficients:
+        bits = coefficient.strip().split(':')
+        try:
+            delay, fringe = [bit.split(',') for bit in bits]
+            coefficients.append([float(value) for value in delay + fringe])
+        except ValueError:
+            raise ValueError('%s is not a valid delay setting' % coefficient)
+        if len(coefficients[-1]) != len(DELAY_FIELDS):
+            raise ValueError('%s is not a valid delay setting' % coefficient)
+    return np.array(coefficients, dtype=np.float64).reshape(-1, len(DELAY_FIELDS))
+
+
+def format_delay_coefficients(coefficients):
+    """
+    :param: coefficients: (inputs x 4) array, columns as DELAY_FIELDS
+    :rtype: List of Str, arguments for the CAM `delays` request
+    """
+    return ['{},{}:{},{}'.format(*row) for row in np.atleast_2d(coefficients)]
+
+
+def nyquist_chan_freqs(n_chans, sample_period):
+    """
+    Baseband frequency of each channel across the first Nyquist zone
+    :param: n_chans: Int
+    :param: sample_period: Float [s]
+    :rtype: array [Hz]
+    """
+    return np.arange(n_chans) / (2. * sample_period * n_chans)
+
+
+def dump_times(n_dumps, int_time):
+    """
+    Effective time of each dump relative to the delay load time [s]
+
+    Rates are applied continuously, so a dump sees the average of the coefficients over its
+    accumulation: the middle of the dump. The first dump is the one the coefficients were
+    loaded in, and sees none of the rate.
+
+    :param: n_dumps: Int
+    :param: int_time: Float, accumulation time [s]
+    :rtype: array [s]
+    """
+    return int_time * np.maximum(np.arange(n_dumps) - 0.5, 0)
+
+
+def model_delays(coefficients, n_dumps=1, int_time=0.):
+    """
+    Delay and fringe phase seen in each dump after the coefficients were loaded
+
+    :param: coefficients: (..., 4) array, columns as DELAY_FIELDS
+    :param: n_dumps: Int
+    :param: int_time: Float, accumulation time [s]
+    :rtype: tuple: ((..., dumps) delays [s], (..., dumps) fringe phases [rad])
+    """
+    coefficients = np.asarray(coefficients, dtype=np.float64)[..., np.newaxis]
+    t = dump_times(n_dumps, int_time)
+    delays = coefficients[..., 0, :] + coefficients[..., 1, :] * t
+    # The correlator removes the fringe phase
+    fringe_phases = -(coefficients[..., 2, :] + coefficients[..., 3, :] * t)
+    return delays, fringe_phases
+
+
+def wrap_phases(phases):
+    """Wrap phases to [-pi, pi)"""
+    return (phases + np.pi) % (2 * np.pi) - np.pi
+
+
+def model_phases(coefficients, chan_freqs, reference_freq=0., n_dumps=1, int_time=0.,
+                 wrap=True):
+    """
+    Expected phase of every channel in each dump after the coefficients were loaded
+
+    Usage:
+
+    coefficients = parse_delay_coefficients(delay_coefficients)
+    phases = model_phases(coefficients[test_input], nyquist_chan_freqs(n_chans, sample_period),
+                          reference_freq=0.25 / sample_period, n_dumps=10, int_time=int_time)
+    phases.shape  # (10, n_chans)
+
+    :param: coefficients: (..., 4) array, columns as DELAY_FIELDS, e.g. one row per input
+    :param: chan_freqs: array of channel frequencies [Hz]
+    :param: reference_freq: Float, frequency at which a delay causes no phase [Hz]
+    :param: n_dumps: Int
+    :param: int_time: Float, accumulation time [s]
+    :param: wrap: Boolean, wrap phases to [-pi, pi)
+    :rtype: (..., dumps x channels) array [rad]
+    """
+    delays, fringe_phases = model_delays(coefficients, n_dumps, int_time)
+    freqs = np.asarray(chan_freqs, dtype=np.float64) - reference_freq
+    phases = 2 * np.pi * delays[..., np.newaxis] * freqs + fringe_phases[..., np.newaxis]
+    return wrap_phases(phases) if wrap else phases
+
+
+PhaseFit = namedtuple('PhaseFit', 'phases delays fringe_offsets residuals')
+"""
+phases: (dumps x channels) phases unwrapped across channels [rad]
+delays: array, delay of each dump's least-squares phase slope [s]
+fringe_offsets: array, phase of each dump's fit at the reference frequency [rad]
+residuals: array, weighted rms difference between each dump's phases and its fit [rad]
+"""
+
+
+def baseline_visibilities(dumps, baseline):
+    """
+    Stack one baseline of several accumulations into a complex array
+    :param: dumps: List of SPEAD accumulations
+    :param: baseline: Int, baseline index
+    :rtype: (dumps x channels) complex array
+    """
+    return complexise(np.array([dump['xeng_raw'][:, baseline, :] for dump in dumps]))
+
+
+def fit_phases(phases, chan_freqs, reference_freq=0., weights=None):
+    """
+    Fit a delay and fringe offset to every dump's phases in a single pass
+
+    Phases are unwrapped across channels and fitted with weighted least squares to
+    2 * pi * delay * (chan_freqs - reference_freq) + fringe_offset, the model of model_phases.
+
+    Usage:
+
+    visibilities = baseline_visibilities(dumps, baseline_index)
+    fit = fit_phases(np.angle(visibilities), nyquist_chan_freqs(n_chans, sample_period),
+                     reference_freq=0.25 / sample_period, weights=np.abs(visibilities))
+
+    :param: phases: (dumps x channels) array [rad]
+    :param: chan_freqs: array of channel frequencies [Hz]
+    :param: reference_freq: Float [Hz]
+    :param: weights: (dumps x channels) array, e.g. visibility magnitudes, equal if None
+    :rtype: PhaseFit
+    """
+    phases = np.unwrap(np.atleast_2d(phases), axis=-1)
+    freqs = np.asarray(chan_freqs, dtype=np.float64) - reference_freq
+    if weights is None:
+        weights = np.ones_like(phases)
+    weights = np.atleast_2d(weights).astype(np.float64)
+    weight_sum = weights.sum(axis=-1)
+    # Dumps without signal, e.g. before the coefficients were loaded, fit to NaN
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freqs_mean = (weights * freqs).sum(axis=-1) / weight_sum
+        phases_mean = (weights * phases).sum(axis=-1) / weight_sum
+        freqs_dev = freqs - freqs_mean[:, np.newaxis]
+        slopes = ((weights * freqs_dev * (phases - phases_mean[:, np.newaxis])).sum(axis=-1) /
+                  (weights * freqs_dev ** 2).sum(axis=-1))
+        offsets = phases_mean - slopes * freqs_mean
+        residuals = phases - (slopes[:, np.newaxis] * freqs + offsets[:, np.newaxis])
+        rms = np.sqrt((weights * residuals ** 2).sum(axis=-1) / weight_sum)
+    return PhaseFit(phases, slopes / (2 * np.pi), wrap_phases(offsets), rms)
+
+
+DelayStep = namedtuple('DelayStep', 'load_time coefficients reply settled')
+"""
+load_time: Float, time the coefficients were loaded at, as dump_timestamp [s]
+coefficients: List of Str, the `delays` request arguments
+reply: katcp reply to the `delays` request
+settled: the last accumulation received while the coefficients were active, as returned by
+    DelaySchedule.run's settled_fn, or None if no accumulation of the step was received
+"""
+
+
+class DelayLoadError(RuntimeError):
+    """Raised when the CAM interface rejects a scheduled `delays` request"""
+    pass
+
+
+class DelaySchedule(object):
+    """
+    Apply a sequence of delay coefficient sets at consecutive future dump boundaries, and
+    pick the settled accumulation of each set out of one continuous stream of accumulations.
+
+    Step i is loaded at start_time + i * dumps_per_step * int_time. A `delays` request can only
+    be armed once the previous one has loaded, so each request is issued as soon as the first
+    accumulation of the previous step arrives, leaving (dumps_per_step - 1) accumulations for
+    the request to reach the correlator. Testing N coefficient sets costs N * dumps_per_step
+    accumulations in a single capture instead of N separate apply-and-discard cycles.
+
+    Only the newest accumulation of the current step is held while capturing. Once a step is
+    over, its last accumulation, which lies entirely after the load time, is reduced with
+    `settled_fn` and released, so a capture never holds more than a few accumulations.
+
+    Usage:
+
+    schedule = DelaySchedule(self.corr_fix.katcp_rct, self.receiver, int_time)
+    for step in schedule.run(steps, t_apply, lambda i, dump: xeng_phase(dump['xeng_raw'])):
+        settled_phases = step.settled
+
+    :param: katcp_rct: katcp resource client of the CBF subarray
+    :param: receiver: corr2.corr_rx.CorrRx
+    :param: int_time: Float, accumulation time [s]
+    :param: dumps_per_step: Int, accumulations each coefficient set stays active for
+    :param: dump_timeout: Float, extra time to wait for an accumulation [s]
+    :param: cam_timeout: Float, `delays` request timeout [s]
+    """
+
+    def __init__(self, katcp_rct, receiver, int_time, dumps_per_step=4, dump_timeout=10,
+                 cam_timeout=30):
+        self.katcp_rct = katcp_rct
+        self.receiver = receiver
+        self.int_time = int_time
+        self.dumps_per_step = dumps_per_step
+        self.dump_timeout = dump_timeout
+        self.cam_timeout = cam_timeout
+
+    def load_times(self, n_steps, start_time):
+        """:rtype: array of the load time of each step [s]"""
+        return start_time + np.arange(n_steps) * self.dumps_per_step * self.int_time
+
+    def run(self, steps, start_time, settled_fn=None):
+        """
+        :param: steps: List of coefficient sets, each a List of Str or an (inputs x 4) array
+        :param: start_time: Float, load time of the first step, on a dump boundary [s]
+        :param: settled_fn: Function mapping (step index, settled accumulation) to what is kept
+                as DelayStep.settled, the accumulation itself if None
+        :rtype: List of DelayStep
+        :raises: DelayLoadError if a `delays` request fails, Queue.Empty if accumulations stop
+        """
+        steps = [step if isinstance(step, list) else format_delay_coefficients(step)
+                 for step in steps]
+        if settled_fn is None:
+            settled_fn = lambda _i, dump: dump
+        load_times = self.load_times(len(steps), start_time)
+        # Dumps start on the load times, match them to within half an accumulation
+        edges = np.append(load_times, load_times[-1] + self.dumps_per_step * self.int_time)
+        edges -= self.int_time / 2.
+        timeout = (self.dumps_per_step + 1) * self.int_time + self.dump_timeout
+        replies = []
+        settled = [None] * len(steps)
+        # Step and newest accumulation of the step being captured
+        current_step, current_dump = -1, None
+        dump_timestamp = -np.inf
+        with DumpRingBuffer(self.receiver) as dump_buffer:
+            # Wait for the last accumulation of the last step
+            while dump_timestamp <= edges[-1] - self.int_time:
+                # Arm each step once the first accumulation of the previous one has arrived
+                while len(replies) < len(steps) and (
+                        not replies or dump_timestamp > edges[len(replies) - 1]):
+                    replies.append(self._arm(load_times[len(replies)], steps[len(replies)]))
+                dump = dump_buffer.await_next_dump(dump_timestamp, timeout=timeout)
+                dump_timestamp = dump['dump_timestamp']
+                step = int(np.searchsorted(edges, dump_timestamp, side='right')) - 1
+                if step != current_step and current_dump is not None:
+                    settled[current_step] = settled_fn(current_step, current_dump)
+                current_step = step
+                current_dump = dump if 0 <= step < len(steps) else None
+            if current_dump is not None:
+                settled[current_step] = settled_fn(current_step, current_dump)
+        return [DelayStep(*step) for step in zip(load_times, steps, replies, settled)]
+
+    def _arm(self, load_time, coefficients):
+        """
+        Issue the `delays` request of one step
+        :rtype: katcp reply
+        :raises: DelayLoadError if the request fails
+        """
+        reply, _informs = self.katcp_rct.req.delays(load_time, *coefficients,
+                                                    timeout=self.cam_timeout)
+        if not reply.reply_ok():
+            raise DelayLoadError('Failed to set delays %s at %s: %s' % (
+                coefficients, load_time, str(reply).replace('\_', ' ')))
+        LOGGER.info('Delays %s armed for %s' % (coefficients, load_time))
+        return reply
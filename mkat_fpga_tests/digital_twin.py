@@ -0,0 +1,893 @@
+"""
+Offline digital twin of a CBF subarray, for running and profiling the tests without hardware.
+
+The twin stands in for the three things test_CBF talks to: the CAM (KATCP) interface of the
+subarray, the digitiser simulator and the SPEAD receiver. All three share a CorrelatorModel,
+which computes X-engine accumulations analytically from the digitiser simulator sources, the
+input gains, FFT shift and delay/fringe coefficients, with channel leakage taken from the
+frequency response of a windowed-sinc PFB prototype filter.
+
+Usage:
+
+DIGITAL_TWIN=True nosetests mkat_fpga_tests/test_cbf.py   # or ./run_cbf_tests.py --digital-twin
+python -m mkat_fpga_tests.digital_twin   # smoke check of the twin on its own
+
+twin = DigitalTwin('bc8n856M4k')
+twin.attach(correlator_fixture)
+"""
+import Queue
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+
+from corr2.corr_rx import CorrRx
+from corr2.dsimhost_fpga import FpgaDsimHost
+from corr2.fxcorrelator import FxCorrelator
+from katcp import DeviceServer, Message, Sensor, ioloop_manager, resource_client
+from mkat_fpga_tests import add_cleanup
+from mkat_fpga_tests.delay_model import (format_delay_coefficients, model_phases,
+                                         nyquist_chan_freqs, parse_delay_coefficients)
+
+LOGGER = logging.getLogger('mkat_fpga_tests')
+
+OUTPUT_PRODUCT = 'baseline-correlation-products'
+OUTPUT_DESTINATION = '239.100.0.1+15:7148'
+XENG_ACC_LEN = 256
+PFB_TAPS = 16
+DEFAULT_EQ = '200+0j'
+ADC_FULL_SCALE = 2 ** 9
+# Bit selection between the FFT output and the 8-bit quantiser, relative to ADC counts
+QUANTISER_SCALE = 2. ** -11
+QUANTISER_BITS = 8
+
+
+def parse_instrument(instrument):
+    """
+    :param: instrument: Str, e.g. 'bc8n856M4k'
+    :rtype: tuple: (Int number of inputs, Int number of channels, Float bandwidth [Hz])
+    :raises: ValueError if the instrument name is not recognised
+    """
+    match = re.match(r'^b?c(\d+)n(\d+)M(\d+)k$', instrument)
+    if match is None:
+        raise ValueError('%s is not a valid instrument name' % instrument)
+    n_inputs, bandwidth, n_chans = [int(value) for value in match.groups()]
+    return n_inputs, n_chans * 1024, bandwidth * 1e6
+
+
+def pfb_response(n_taps=PFB_TAPS, oversample=64, proto_chans=64):
+    """
+    Power response of one PFB channel to a tone, as a function of the tone's offset from the
+    channel centre
+
+    The channel shape of a critically sampled PFB only depends on the number of taps, so it is
+    computed once for a short Hann-windowed sinc prototype.
+
+    :param: n_taps: Int
+    :param: oversample: Int, response points per channel
+    :param: proto_chans: Int, channels of the prototype filter
+    :rtype: tuple: (array of offsets [channels], array of power response, 1 at the centre)
+    """
+    fft_len = 2 * proto_chans
+    n = np.arange(n_taps * fft_len)
+    prototype = np.sinc((n - n.size / 2.) / fft_len) * np.hanning(n.size)
+    response = np.abs(np.fft.rfft(prototype, n.size * oversample)) ** 2
+    response /= response[0]
+    offsets = np.arange(response.size) * fft_len / float(n.size * oversample)
+    return offsets, response
+
+
+def default_bls_ordering(input_labels):
+    """
+    Baselines in X-engine output order: the four polarisation products of every antenna pair
+    :param: input_labels: List of Str, x and y input of each antenna in turn
+    :rtype: List of (Str, Str)
+    """
+    ants = [input_labels[i:i + 2] for i in xrange(0, len(input_labels), 2)]
+    bls_ordering = []
+    for ant_b in xrange(len(ants)):
+        for ant_a in xrange(ant_b + 1):
+            (a_x, a_y), (b_x, b_y) = ants[ant_a], ants[ant_b]
+            bls_ordering.extend([(a_x, b_x), (a_y, b_y), (a_x, b_y), (a_y, b_x)])
+    return bls_ordering
+
+
+class _TwinSource(object):
+    """Digitiser simulator sine or noise source, with the FpgaDsimHost source interface"""
+
+    def __init__(self, model, name, output):
+        self._model = model
+        self.name = name
+        # Output (polarisation) the source is routed to, or None for both
+        self.output = output
+        self.frequency = 0
+        self.scale = 0
+        self.repeat = 0
+
+    def set(self, scale=None, frequency=None, repeat_n=None):
+        with self._model.lock:
+            if scale is not None:
+                self.scale = float(scale)
+            if frequency is not None:
+                self.frequency = float(frequency)
+            if repeat_n is not None:
+                if self.name == 'corr':
+                    raise ValueError('Correlated source has no repeat')
+                self.repeat = int(repeat_n)
+
+
+class _TwinOutput(object):
+    """Digitiser simulator output, with the FpgaDsimHost output interface"""
+
+    def __init__(self, model, name):
+        self._model = model
+        self.name = name
+        self.output_type = 'signal'
+        self.scale = 1.
+
+    def select_output(self, output_type):
+        with self._model.lock:
+            self.output_type = output_type
+
+    def scale_output(self, scale):
+        with self._model.lock:
+            self.scale = float(scale)
+
+
+class _TwinRegister(object):
+    """Register that remembers what was written to it"""
+
+    def __init__(self, name):
+        self.name = name
+        self.values = {}
+
+    def read(self):
+        return dict(self.values)
+
+    def write(self, **kwargs):
+        self.values.update(kwargs)
+
+
+class _TwinClockRegister(_TwinRegister):
+    def read(self):
+        return {'timestamp': time.time()}
+
+
+class _TwinRegisters(object):
+    """Any register name resolves, sys_clkcounter reads the digitiser time [s]"""
+
+    def __init__(self):
+        self.sys_clkcounter = _TwinClockRegister('sys_clkcounter')
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        register = _TwinRegister(name)
+        setattr(self, name, register)
+        return register
+
+
+class _Container(list):
+    """Iterable whose items are also attributes, like FpgaDsimHost.sine_sources"""
+
+    def __init__(self, items, prefix):
+        list.__init__(self, items)
+        for item in items:
+            setattr(self, prefix + item.name, item)
+
+
+class CorrelatorModel(object):
+    """
+    Analytic model of the F- and X-engines
+
+    Every input sees the digitiser simulator output of its polarisation (x inputs output 0,
+    y inputs output 1). Each source contributes a power spectrum per channel: tones leak into
+    neighbouring channels through the PFB response and noise is flat. An input's quantised
+    spectrum is that scaled by the FFT shift, its gain and the phase of its delay and fringe
+    coefficients, clipped at quantiser full scale. A baseline accumulates the power the two
+    inputs share, plus Gaussian noise of the expected accumulation variance.
+
+    :param: instrument: Str, e.g. 'bc8n856M4k'
+    :param: acc_time: Float, initial accumulation time [s]
+    :param: seed: Int, seed of the noise generator
+    """
+
+    def __init__(self, instrument='bc8n856M4k', acc_time=0.5, seed=None):
+        self.lock = threading.RLock()
+        self.rng = np.random.RandomState(seed)
+        self.sync_time = float(int(time.time()))
+        self.capturing = False
+        self._pfb_offsets, self._pfb_response = pfb_response()
+        self.sine_sources = _Container([_TwinSource(self, '0', 0), _TwinSource(self, '1', 1),
+                                        _TwinSource(self, 'corr', None)], 'sin_')
+        self.noise_sources = _Container([_TwinSource(self, '0', 0), _TwinSource(self, '1', 1),
+                                         _TwinSource(self, 'corr', None)], 'noise_')
+        self.outputs = _Container([_TwinOutput(self, '0'), _TwinOutput(self, '1')], 'out_')
+        self.configure(instrument, acc_time)
+
+    def configure(self, instrument, acc_time=None):
+        """(Re)start the model as `instrument`, clearing gains, delays and labels"""
+        with self.lock:
+            self.instrument = instrument
+            self.n_inputs, self.n_chans, self.bandwidth = parse_instrument(instrument)
+            self.n_ants = self.n_inputs // 2
+            self.sample_rate = 2 * self.bandwidth
+            self.chan_freqs = nyquist_chan_freqs(self.n_chans, 1. / self.sample_rate)
+            self.input_labels = ['ant{}_{}'.format(i // 2, 'xy'[i % 2])
+                                 for i in xrange(self.n_inputs)]
+            self.gains = [np.full(self.n_chans, complex(DEFAULT_EQ)) for _ in self.input_labels]
+            self.fft_shift = 2 ** (int(np.log2(2 * self.n_chans)) - 4) - 1
+            # (load time, (inputs x 4) coefficients), in load order
+            self.delays = [(0., np.zeros((self.n_inputs, 4)))]
+            self.set_acc_time(self.acc_time if acc_time is None else acc_time)
+
+    @property
+    def spectrum_time(self):
+        """Time between spectra [s]"""
+        return 2 * self.n_chans / self.sample_rate
+
+    @property
+    def bls_ordering(self):
+        return default_bls_ordering(self.input_labels)
+
+    def set_acc_time(self, acc_time):
+        """
+        :param: acc_time: Float, requested accumulation time [s]
+        :rtype: Float, accumulation time the X-engines were set to [s]
+        """
+        with self.lock:
+            self.n_accs = max(int(round(acc_time / (XENG_ACC_LEN * self.spectrum_time))), 1)
+            self.acc_time = self.n_accs * XENG_ACC_LEN * self.spectrum_time
+            # Accumulations restart on the next whole spectrum
+            self.acc_epoch = self.sync_time + self.spectrum_time * np.ceil(
+                (time.time() - self.sync_time) / self.spectrum_time)
+            return self.acc_time
+
+    def input_index(self, label):
+        """:raises: ValueError for an unknown input"""
+        if label in self.input_labels:
+            return self.input_labels.index(label)
+        return int(label)
+
+    def set_gain(self, label, values):
+        """
+        :param: label: Str, input label or index
+        :param: values: List of complex, one value for all channels or one per channel
+        """
+        values = np.array([complex(value) for value in values])
+        if values.size not in (1, self.n_chans):
+            raise ValueError('Expected 1 or %s gains, got %s' % (self.n_chans, values.size))
+        with self.lock:
+            self.gains[self.input_index(label)] = np.resize(values, self.n_chans)
+
+    def load_delays(self, load_time, coefficients):
+        """
+        :param: load_time: Float [s]
+        :param: coefficients: List of Str, 'delay,delay_rate:fringe_offset,fringe_rate' per input
+        :raises: ValueError for the wrong number of coefficients or a load time in the past
+        """
+        coefficients = parse_delay_coefficients(coefficients)
+        if len(coefficients) != self.n_inputs:
+            raise ValueError('Expected delays for %s inputs, got %s' % (
+                self.n_inputs, len(coefficients)))
+        if load_time < time.time():
+            raise ValueError('Load time %s is in the past' % load_time)
+        with self.lock:
+            self.delays.append((load_time, coefficients))
+            self.delays.sort(key=lambda delay: delay[0])
+
+    def _source_spectra(self):
+        """
+        Power spectrum [ADC counts squared] of each output's own sources and of the sources
+        routed to both outputs
+        :rtype: (3 x channels) array: output 0, output 1, both
+        """
+        spectra = np.zeros((3, self.n_chans))
+        chan_width = self.bandwidth / self.n_chans
+        for source in self.sine_sources:
+            if source.scale:
+                offsets = np.abs(source.frequency - self.chan_freqs) / chan_width
+                response = np.interp(offsets, self._pfb_offsets, self._pfb_response,
+                                     right=self._pfb_response[-1])
+                row = 2 if source.output is None else source.output
+                spectra[row] += (source.scale * ADC_FULL_SCALE * self.n_chans) ** 2 * response
+        for source in self.noise_sources:
+            row = 2 if source.output is None else source.output
+            spectra[row] += 2 * self.n_chans * (source.scale * ADC_FULL_SCALE) ** 2
+        return spectra
+
+    def _input_scale(self, t_start):
+        """
+        Complex scaling of each input's spectrum from ADC counts to quantiser full scale
+        :rtype: (inputs x channels) complex array
+        """
+        coefficients = np.zeros((self.n_inputs, 4))
+        int_time = self.acc_time
+        for load_time, _coefficients in self.delays:
+            if load_time - int_time / 2. <= t_start:
+                # Rates act from the load time, see delay_model.dump_times
+                t = max(t_start - load_time - int_time / 2., 0)
+                coefficients = _coefficients.copy()
+                coefficients[:, 0] += coefficients[:, 1] * t
+                coefficients[:, 2] += coefficients[:, 3] * t
+                coefficients[:, [1, 3]] = 0
+        phases = model_phases(coefficients, self.chan_freqs,
+                              reference_freq=self.sample_rate / 4., wrap=False)[:, 0, :]
+        fft_scale = QUANTISER_SCALE / 2 ** bin(self.fft_shift).count('1')
+        output_scale = [output.scale if output.output_type == 'signal' else 0
+                        for output in self.outputs]
+        return np.array([self.gains[i] * fft_scale * output_scale[i % 2]
+                         for i in xrange(self.n_inputs)]) * np.exp(1j * phases)
+
+    def _power(self, t_start):
+        """
+        :rtype: tuple: ((inputs x channels) complex scale, (2 x 2 x channels) power shared
+                between the outputs of two inputs)
+        """
+        spectra = self._source_spectra()
+        shared = np.empty((2, 2, self.n_chans))
+        shared[0, 0] = spectra[0] + spectra[2]
+        shared[1, 1] = spectra[1] + spectra[2]
+        shared[0, 1] = shared[1, 0] = spectra[2]
+        scale = self._input_scale(t_start)
+        # Inputs saturate at quantiser full scale
+        rms = np.abs(scale) * np.sqrt(shared[np.arange(self.n_inputs) % 2,
+                                             np.arange(self.n_inputs) % 2])
+        scale /= np.maximum(rms, 1)
+        return scale, shared
+
+    def accumulation(self, t_start, noise=True):
+        """
+        X-engine output of the accumulation starting at `t_start`
+
+        :param: t_start: Float [s]
+        :param: noise: Boolean, add the noise of a finite accumulation
+        :rtype: (channels x baselines x 2) int32 array, as SPEAD xeng_raw
+        """
+        with self.lock:
+            scale, shared = self._power(t_start)
+            label_index = dict((label, i) for i, label in enumerate(self.input_labels))
+            bls_ordering = self.bls_ordering
+            n_spectra = self.n_accs * XENG_ACC_LEN
+        full_scale = (2 ** (QUANTISER_BITS - 1)) ** 2 * n_spectra
+        xeng_raw = np.empty((self.n_chans, len(bls_ordering), 2), dtype=np.int32)
+        for bl, (label_a, label_b) in enumerate(bls_ordering):
+            a, b = label_index[label_a], label_index[label_b]
+            visibility = np.conj(scale[a]) * scale[b] * shared[a % 2, b % 2] * full_scale
+            values = np.column_stack([visibility.real, visibility.imag])
+            if noise:
+                # Accumulation variance of the product of two noisy inputs
+                power_a = np.abs(scale[a]) ** 2 * shared[a % 2, a % 2]
+                power_b = np.abs(scale[b]) ** 2 * shared[b % 2, b % 2]
+                std = np.sqrt(power_a * power_b / (2. * n_spectra)) * full_scale
+                values += self.rng.standard_normal(values.shape) * std[:, np.newaxis]
+            xeng_raw[:, bl, :] = np.clip(np.round(values), -2 ** 31, 2 ** 31 - 1)
+        return xeng_raw
+
+    def quantiser_spectrum(self, label):
+        """
+        One spectrum at the quantiser output of an input
+        :rtype: complex array, fractions of full scale
+        """
+        with self.lock:
+            scale, shared = self._power(time.time())
+            i = self.input_index(label)
+        amplitude = np.sqrt(shared[i % 2, i % 2] / 2.)
+        spectrum = scale[i] * amplitude * (self.rng.standard_normal(self.n_chans) +
+                                           1j * self.rng.standard_normal(self.n_chans))
+        steps = 2 ** (QUANTISER_BITS - 1)
+        limit = (steps - 1.) / steps
+        return (np.clip(np.round(spectrum.real * steps) / steps, -1, limit) +
+                1j * np.clip(np.round(spectrum.imag * steps) / steps, -1, limit))
+
+    def adc_samples(self, label, n_samples=8192):
+        """
+        :rtype: array of ADC samples of an input, fractions of full scale
+        """
+        with self.lock:
+            output = self.input_index(label) % 2
+            t = time.time() + np.arange(n_samples) / self.sample_rate
+            samples = np.zeros(n_samples)
+            for source in self.sine_sources:
+                if source.output in (output, None):
+                    samples += source.scale * np.sin(2 * np.pi * source.frequency * t)
+            for source in self.noise_sources:
+                if source.output in (output, None):
+                    samples += source.scale * self.rng.standard_normal(n_samples)
+            samples *= self.outputs[output].scale
+        return np.clip(samples, -1, (ADC_FULL_SCALE - 1.) / ADC_FULL_SCALE)
+
+    def dump(self, t_start):
+        """
+        :param: t_start: Float, start of the accumulation [s]
+        :rtype: Dict, as received by corr2.corr_rx.CorrRx
+        """
+        timestamp = int(round((t_start - self.sync_time) * self.sample_rate))
+        dump_timestamp = self.sync_time + timestamp / self.sample_rate
+        return {
+            'xeng_raw': self.accumulation(t_start),
+            'timestamp': timestamp,
+            'dump_timestamp': dump_timestamp,
+            'dump_timestamp_readable': time.strftime('%H:%M:%S',
+                                                     time.localtime(dump_timestamp)),
+            'n_chans': self.n_chans,
+            'bandwidth': self.bandwidth,
+            'scale_factor_timestamp': self.sample_rate,
+            'ticks_between_spectra': 2 * self.n_chans,
+            'n_accs': self.n_accs,
+            'int_time': self.acc_time,
+        }
+
+    @property
+    def configd(self):
+        """Config dict, as corr2.fxcorrelator.FxCorrelator.configd"""
+        fengine = {
+            'n_chans': str(self.n_chans),
+            'bandwidth': str(self.bandwidth),
+            'source_names': ','.join('ant{}_{}'.format(i // 2, 'xy'[i % 2])
+                                     for i in xrange(self.n_inputs)),
+            'hosts': '',
+        }
+        fengine.update(('eq{}'.format(i), DEFAULT_EQ) for i in xrange(self.n_inputs))
+        return {
+            'FxCorrelator': {'sample_rate_hz': str(self.sample_rate)},
+            'fengine': fengine,
+            'xengine': {
+                'output_products': OUTPUT_PRODUCT,
+                'output_destinations_base': OUTPUT_DESTINATION.replace('+15', ''),
+                'accumulation_len': str(XENG_ACC_LEN),
+                'xeng_accumulation_len': str(XENG_ACC_LEN),
+                'hosts': '',
+            },
+            'dsimengine': {'host': 'digital-twin'},
+        }
+
+
+class TwinDsimHost(FpgaDsimHost):
+    """
+    Digitiser simulator of the digital twin, with the FpgaDsimHost interface the tests use.
+    Methods that program or read the FPGA itself are not available.
+    """
+
+    def __init__(self, model, host='digital-twin'):
+        self.host = host
+        self.model = model
+        self.registers = _TwinRegisters()
+
+    @property
+    def sine_sources(self):
+        return self.model.sine_sources
+
+    @property
+    def noise_sources(self):
+        return self.model.noise_sources
+
+    @property
+    def outputs(self):
+        return self.model.outputs
+
+    def is_running(self):
+        return True
+
+    def get_system_information(self, *args, **kwargs):
+        return True
+
+    def initialise(self, *args, **kwargs):
+        pass
+
+    def enable_data_output(self, enabled=True):
+        pass
+
+
+class TwinCorrelator(FxCorrelator):
+    """Correlator of the digital twin: its config, without F- or X-engine hosts"""
+
+    def __init__(self, model):
+        self.model = model
+        self.fhosts = []
+        self.xhosts = []
+
+    @property
+    def configd(self):
+        return self.model.configd
+
+    @property
+    def n_antennas(self):
+        return self.model.n_ants
+
+    def initialise(self, *args, **kwargs):
+        pass
+
+
+class TwinReceiver(CorrRx):
+    """
+    SPEAD receiver of the digital twin: puts an accumulation on data_queue every accumulation
+    time while capture is started, like corr2.corr_rx.CorrRx. When the queue is full the oldest
+    accumulation is dropped.
+
+    :param: model: CorrelatorModel
+    :param: queue_size: Int
+    """
+
+    def __init__(self, model, queue_size=1000, **kwargs):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.model = model
+        self.data_queue = Queue.Queue(maxsize=queue_size)
+        self.running_event = threading.Event()
+        self.stop_event = threading.Event()
+
+    def start(self, timeout=None):
+        threading.Thread.start(self)
+        if timeout is not None:
+            self.running_event.wait(timeout)
+
+    def wait_running(self, timeout=None):
+        return self.running_event.wait(timeout)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stopped(self):
+        return self.stop_event.isSet()
+
+    def confirm_multicast_subs(self, mul_ip=None):
+        return 'Successful'
+
+    def _put(self, dump):
+        while True:
+            try:
+                self.data_queue.put_nowait(dump)
+                return
+            except Queue.Full:
+                try:
+                    self.data_queue.get_nowait()
+                except Queue.Empty:
+                    pass
+
+    def run(self):
+        LOGGER.info('Starting %s' % self.name)
+        self.running_event.set()
+        while not self.stop_event.isSet():
+            with self.model.lock:
+                acc_epoch, acc_time = self.model.acc_epoch, self.model.acc_time
+            # The accumulation that is in progress
+            t_start = acc_epoch + acc_time * np.floor((time.time() - acc_epoch) / acc_time)
+            if self.stop_event.wait(max(t_start + acc_time - time.time(), 0)):
+                break
+            with self.model.lock:
+                changed = (acc_epoch, acc_time) != (self.model.acc_epoch, self.model.acc_time)
+                capturing = self.model.capturing
+            if capturing and not changed:
+                self._put(self.model.dump(t_start))
+        self.running_event.clear()
+        LOGGER.info('Stopping %s' % self.name)
+
+    def get_clean_dump(self, dump_timeout=None, discard=2):
+        """
+        Accumulation after emptying the queue and discarding `discard` further accumulations
+        :raises: Queue.Empty if no accumulation arrives within `dump_timeout`
+        """
+        if dump_timeout is None:
+            dump_timeout = 2 * self.model.acc_time + 5
+        while True:
+            try:
+                self.data_queue.get_nowait()
+            except Queue.Empty:
+                break
+        for _ in xrange(discard):
+            self.data_queue.get(timeout=dump_timeout)
+        return self.data_queue.get(timeout=dump_timeout)
+
+
+class TwinDeviceServer(DeviceServer):
+    """
+    CAM interface of the digital twin's subarray: the sensors InstrumentParameters reads and the
+    requests the tests issue
+
+    :param: model: CorrelatorModel
+    :param: host: Str
+    :param: port: Int, 0 for any free port
+    """
+
+    VERSION_INFO = ('mkat-fpga-tests-digital-twin', 0, 1)
+    BUILD_INFO = ('mkat-fpga-tests-digital-twin', 0, 1, '')
+
+    def __init__(self, model, host='127.0.0.1', port=0):
+        self.model = model
+        DeviceServer.__init__(self, host, port)
+
+    def _add_sensor(self, sensor_type, name, description, unit=''):
+        sensor = sensor_type(name, description, unit)
+        self.add_sensor(sensor)
+
+    def setup_sensors(self):
+        product = OUTPUT_PRODUCT + '-{}'
+        for name, description, unit in [('synchronisation-epoch', 'Digitiser sync epoch', 's'),
+                                        ('sync-time', 'Digitiser sync epoch', 's'),
+                                        ('scale-factor-timestamp', 'Timestamp ticks per second',
+                                         'Hz'),
+                                        ('bandwidth', 'Instrument bandwidth', 'Hz'),
+                                        ('adc-sample-rate', 'ADC sample rate', 'Hz'),
+                                        (product.format('int-time'), 'Accumulation time', 's'),
+                                        (product.format('clock-rate'), 'Timestamp clock', 'Hz')]:
+            self._add_sensor(Sensor.float, name, description, unit)
+        for name, description in [('n-ants', 'Antennas'), ('n-fengs', 'F-engines'),
+                                  ('n-xengs', 'X-engines'), ('n-inputs', 'Inputs'),
+                                  (product.format('n-bls'), 'Baselines'),
+                                  (product.format('n-chans'), 'Channels'),
+                                  (product.format('n-accs'), 'Spectra per accumulation'),
+                                  (product.format('xeng-acc-len'), 'X-engine accumulation'),
+                                  (product.format('xeng-out-bits-per-sample'), 'Output bits')]:
+            self._add_sensor(Sensor.integer, name, description)
+        for name, description in [('instrument-state', 'Running instrument'),
+                                  ('input-labelling', 'Input labels'),
+                                  (product.format('destination'), 'Output destination'),
+                                  (product.format('bls-ordering'), 'Baseline ordering')]:
+            self._add_sensor(Sensor.string, name, description)
+        self.update_sensors()
+
+    def update_sensors(self):
+        """Set all sensors from the model"""
+        model = self.model
+        product = OUTPUT_PRODUCT + '-{}'
+        with model.lock:
+            values = {
+                'synchronisation-epoch': model.sync_time,
+                'sync-time': model.sync_time,
+                'scale-factor-timestamp': model.sample_rate,
+                'bandwidth': model.bandwidth,
+                'adc-sample-rate': model.sample_rate,
+                'n-ants': model.n_ants,
+                'n-fengs': model.n_ants,
+                'n-xengs': model.n_ants,
+                'n-inputs': model.n_inputs,
+                'instrument-state': model.instrument,
+                'input-labelling': repr([(label, i, 'digital-twin', 'xy'[i % 2])
+                                         for i, label in enumerate(model.input_labels)]),
+                product.format('int-time'): model.acc_time,
+                product.format('clock-rate'): model.sample_rate,
+                product.format('n-bls'): len(model.bls_ordering),
+                product.format('n-chans'): model.n_chans,
+                product.format('n-accs'): model.n_accs * XENG_ACC_LEN,
+                product.format('xeng-acc-len'): XENG_ACC_LEN,
+                product.format('xeng-out-bits-per-sample'): 32,
+                product.format('destination'): OUTPUT_DESTINATION,
+                product.format('bls-ordering'): repr(model.bls_ordering),
+            }
+        for name, value in values.iteritems():
+            self.get_sensor(name).set_value(value)
+
+    @staticmethod
+    def _fail(msg, error):
+        LOGGER.error('Digital twin ?%s failed: %s' % (msg.name, error))
+        return Message.reply_to_request(msg, 'fail', str(error))
+
+    def request_instrument_list(self, req, msg):
+        """List the instruments the twin can run (?instrument-list)"""
+        req.inform(self.model.instrument)
+        return Message.reply_to_request(msg, 'ok', 1)
+
+    def request_digitiser_synch_epoch(self, req, msg):
+        """Set the digitiser sync epoch (?digitiser-synch-epoch [epoch])"""
+        return Message.reply_to_request(msg, 'ok', self.model.sync_time)
+
+    def request_accumulation_length(self, req, msg):
+        """Set the accumulation time (?accumulation-length [seconds])"""
+        try:
+            if msg.arguments:
+                self.model.set_acc_time(float(msg.arguments[0]))
+        except ValueError as e:
+            return self._fail(msg, e)
+        self.update_sensors()
+        return Message.reply_to_request(msg, 'ok', self.model.acc_time)
+
+    def request_input_labels(self, req, msg):
+        """Set or get the input labels (?input-labels [label+])"""
+        if msg.arguments:
+            if len(msg.arguments) != self.model.n_inputs:
+                return self._fail(msg, 'Expected %s labels' % self.model.n_inputs)
+            with self.model.lock:
+                self.model.input_labels = list(msg.arguments)
+            self.update_sensors()
+        return Message.reply_to_request(msg, 'ok', *self.model.input_labels)
+
+    def request_gain(self, req, msg):
+        """Set or get the gain of one input (?gain input [value+])"""
+        try:
+            label = msg.arguments[0]
+            if len(msg.arguments) > 1:
+                self.model.set_gain(label, msg.arguments[1:])
+            gains = self.model.gains[self.model.input_index(label)]
+        except (IndexError, ValueError) as e:
+            return self._fail(msg, e)
+        if np.all(gains == gains[0]):
+            gains = gains[:1]
+        return Message.reply_to_request(msg, 'ok', *[str(gain) for gain in gains])
+
+    def request_gain_all(self, req, msg):
+        """Set or get the gain of all inputs (?gain-all [value+])"""
+        try:
+            if msg.arguments:
+                for label in self.model.input_labels:
+                    self.model.set_gain(label, msg.arguments)
+        except ValueError as e:
+            return self._fail(msg, e)
+        gains = self.model.gains[0]
+        if np.all(gains == gains[0]):
+            gains = gains[:1]
+        return Message.reply_to_request(msg, 'ok', *[str(gain) for gain in gains])
+
+    def request_fft_shift(self, req, msg):
+        """Set or get the F-engine FFT shift (?fft-shift [shift])"""
+        try:
+            if msg.arguments:
+                with self.model.lock:
+                    self.model.fft_shift = int(msg.arguments[0])
+        except ValueError as e:
+            return self._fail(msg, e)
+        return Message.reply_to_request(msg, 'ok', self.model.fft_shift)
+
+    def request_delays(self, req, msg):
+        """Load delay and fringe coefficients (?delays load-time coefficients+)"""
+        try:
+            self.model.load_delays(float(msg.arguments[0]), msg.arguments[1:])
+        except (IndexError, ValueError) as e:
+            return self._fail(msg, e)
+        return Message.reply_to_request(msg, 'ok', *format_delay_coefficients(
+            parse_delay_coefficients(msg.arguments[1:])))
+
+    def request_capture_list(self, req, msg):
+        """List the output products (?capture-list)"""
+        req.inform(OUTPUT_PRODUCT, OUTPUT_DESTINATION, 'up' if self.model.capturing else 'down')
+        return Message.reply_to_request(msg, 'ok', 1)
+
+    def _capture(self, msg, capturing):
+        if msg.arguments and msg.arguments[0] != OUTPUT_PRODUCT:
+            return self._fail(msg, 'Unknown output product %s' % msg.arguments[0])
+        with self.model.lock:
+            self.model.capturing = capturing
+        return Message.reply_to_request(msg, 'ok', OUTPUT_PRODUCT)
+
+    def request_capture_start(self, req, msg):
+        """Start output product capture (?capture-start product)"""
+        return self._capture(msg, True)
+
+    def request_capture_stop(self, req, msg):
+        """Stop output product capture (?capture-stop product)"""
+        return self._capture(msg, False)
+
+    def request_capture_meta(self, req, msg):
+        """Issue SPEAD metadata (?capture-meta product)"""
+        return Message.reply_to_request(msg, 'ok', OUTPUT_PRODUCT)
+
+    def request_quantiser_snapshot(self, req, msg):
+        """Quantiser output spectrum of one input (?quantiser-snapshot input)"""
+        try:
+            label = msg.arguments[0]
+            snapshot = str(self.model.quantiser_spectrum(label).tolist())
+        except (IndexError, ValueError) as e:
+            return self._fail(msg, e)
+        req.inform(label, snapshot)
+        return Message.reply_to_request(msg, 'ok', label, snapshot)
+
+    def request_adc_snapshot(self, req, msg):
+        """ADC samples of one input (?adc-snapshot input)"""
+        try:
+            label = msg.arguments[0]
+            snapshot = str(self.model.adc_samples(label).tolist())
+        except (IndexError, ValueError) as e:
+            return self._fail(msg, e)
+        req.inform(label, snapshot)
+        return Message.reply_to_request(msg, 'ok', label, snapshot)
+
+
+class DigitalTwin(object):
+    """
+    Digital twin of a CBF subarray: a CorrelatorModel behind a KATCP server, a digitiser
+    simulator and SPEAD receivers
+
+    Accumulations are handed to the receiver in-process instead of as SPEAD over the network,
+    in the format corr2.corr_rx.CorrRx delivers them.
+
+    Usage:
+
+    twin = DigitalTwin('bc8n856M4k', seed=1)
+    twin.attach(correlator_fixture)  # correlator_fixture.katcp_rct/dhost/correlator are the twin
+    receiver = twin.receiver(queue_size=3)
+
+    :param: instrument: Str, e.g. 'bc8n856M4k'
+    :param: host: Str, KATCP server address
+    :param: port: Int, KATCP server port, 0 for any free port
+    :param: seed: Int, seed of the model's noise
+    :param: timeout: Float, KATCP client sync timeout [s]
+    """
+
+    def __init__(self, instrument='bc8n856M4k', host='127.0.0.1', port=0, seed=None, timeout=30):
+        self.model = CorrelatorModel(instrument, seed=seed)
+        self.server = TwinDeviceServer(self.model, host, port)
+        self.dhost = TwinDsimHost(self.model)
+        self.correlator = TwinCorrelator(self.model)
+        self.timeout = timeout
+        self.katcp_rct = None
+
+    def start(self):
+        """Start the KATCP server and connect a resource client to it"""
+        if self.katcp_rct is not None:
+            return
+        self.server.set_daemon(True)
+        self.server.start(timeout=self.timeout)
+        self.io_manager = ioloop_manager.IOLoopManager()
+        self.io_wrapper = resource_client.IOLoopThreadWrapper(self.io_manager.get_ioloop())
+        self.io_wrapper.default_timeout = self.timeout
+        self.io_manager.start()
+        katcp_rc = resource_client.KATCPClientResource(
+            dict(name='digital-twin', address=self.server.bind_address, controlled=True))
+        katcp_rc.set_ioloop(self.io_manager.get_ioloop())
+        self.katcp_rct = resource_client.ThreadSafeKATCPClientResourceWrapper(katcp_rc,
+                                                                              self.io_wrapper)
+        self.katcp_rct.start()
+        self.katcp_rct.until_synced(timeout=self.timeout)
+        LOGGER.info('Digital twin of %s running on %s:%s' % (
+            (self.model.instrument,) + tuple(self.server.bind_address)))
+
+    def stop(self):
+        if self.katcp_rct is not None:
+            self.katcp_rct.stop()
+            self.io_manager.stop()
+            self.katcp_rct = None
+        self.server.stop()
+
+    def ensure_instrument(self, instrument):
+        """
+        Run `instrument`, reconfiguring the model if it is running another one
+        :rtype: Boolean
+        """
+        try:
+            if instrument != self.model.instrument:
+                LOGGER.info('Digital twin switching to instrument %s' % instrument)
+                self.model.configure(instrument)
+                self.server.update_sensors()
+                self.katcp_rct.until_synced(timeout=self.timeout)
+        except ValueError:
+            LOGGER.exception('Digital twin cannot run instrument %s' % instrument)
+            return False
+        return True
+
+    def receiver(self, queue_size=1000, **kwargs):
+        """:rtype: TwinReceiver, not yet started"""
+        return TwinReceiver(self.model, queue_size=queue_size, **kwargs)
+
+    def attach(self, corr_fix):
+        """
+        Run `corr_fix` (mkat_fpga_tests.CorrelatorFixture) against the twin
+        """
+        self.start()
+        add_cleanup(self.stop)
+        corr_fix.use_twin(self)
+
+
+if __name__ == '__main__':
+    # Smoke check: configure the twin over KATCP and receive one accumulation
+    logging.basicConfig(level=logging.INFO)
+    twin = DigitalTwin(seed=1)
+    twin.start()
+    receiver = twin.receiver(queue_size=3)
+    try:
+        twin.dhost.noise_sources.noise_corr.set(scale=0.1)
+        delays = format_delay_coefficients(np.zeros((twin.model.n_inputs, 4)))
+        for request, args in [('gain_all', [DEFAULT_EQ]),
+                              ('delays', [time.time() + 2 * twin.model.acc_time] + delays),
+                              ('capture_start', [OUTPUT_PRODUCT])]:
+            reply, _informs = getattr(twin.katcp_rct.req, request)(*args)
+            assert reply.reply_ok(), str(reply)
+        receiver.start(timeout=10)
+        dump = receiver.get_clean_dump(discard=0)
+        print '%s accumulation of %s: %s at %s' % (
+            twin.model.instrument, dump['int_time'], dump['xeng_raw'].shape,
+            dump['dump_timestamp_readable'])
+    finally:
+        receiver.stop()
+        twin.stop()
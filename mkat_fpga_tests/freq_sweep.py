@@ -0,0 +1,473 @@
+import h5py
+import logging
+import Queue
+import numpy as np
+
+from collections import namedtuple
+from mkat_fpga_tests.utils import DumpRingBuffer
+
+LOGGER = logging.getLogger('mkat_fpga_tests')
+
+SweepResult = namedtuple('SweepResult',
+                         'requested_freqs source_freqs responses dump_timestamps missed_freqs')
+"""
+Rows are in the order responses were captured.
+requested_freqs: array of requested frequencies that were captured [Hz]
+source_freqs: array of frequencies the digitiser simulator actually generated [Hz]
+responses: (freqs x channels) response matrix, an h5py dataset when written to a SweepStore
+dump_timestamps: array of the dump timestamp each response was taken from
+missed_freqs: list of requested frequencies for which no accumulation was received
+"""
+
+
+class SweepRecorder(object):
+    """
+    Collects sweep responses in memory.
+
+    Sweeps write each response to a recorder as soon as it has been computed; SweepStore
+    implements the same interface on disk.
+    """
+
+    def __init__(self):
+        self.requested_freqs = []
+        self.source_freqs = []
+        self.responses = []
+        self.dump_timestamps = []
+
+    def write(self, requested_freq, source_freq, response, dump_timestamp):
+        self.requested_freqs.append(requested_freq)
+        self.source_freqs.append(source_freq)
+        self.responses.append(response)
+        self.dump_timestamps.append(dump_timestamp)
+
+    def result(self, missed_freqs):
+        """
+        :param: missed_freqs: List of requested frequencies without an accumulation
+        :rtype: SweepResult
+        """
+        return SweepResult(np.array(self.requested_freqs), np.array(self.source_freqs),
+                           np.array(self.responses), np.array(self.dump_timestamps),
+                           missed_freqs)
+
+
+class SweepStore(SweepRecorder):
+    """
+    Writes sweep responses incrementally to a chunked float32 HDF5 file, so that a sweep's
+    responses need not fit in memory and can be analysed again offline, see load_sweep.
+
+    File layout:
+        responses: (captured freqs x channels) float32
+        requested_freqs, source_freqs, dump_timestamps: (captured freqs) float64
+        missed_freqs: requested frequencies without an accumulation, written by result()
+        attributes: any metadata passed as attrs, e.g. cw scale or baseline
+
+    Usage:
+
+    with SweepStore(filename, n_chans, attrs={'baseline': 0}) as store:
+        result = sweep.run(freqs, response_fn, store=store)
+        max_channels = np.argmax(result.responses[:100], axis=1)
+
+    :param: filename: Str, HDF5 file path, overwritten if it exists
+    :param: n_chans: Int, length of each response
+    :param: chunk_rows: Int, responses per HDF5 chunk
+    :param: attrs: Dict, metadata stored as file attributes
+    """
+
+    def __init__(self, filename, n_chans, chunk_rows=16, attrs=None):
+        self.filename = filename
+        self._h5 = h5py.File(filename, 'w')
+        for key, value in (attrs or {}).iteritems():
+            self._h5.attrs[key] = value
+        self.responses = self._h5.create_dataset(
+            'responses', shape=(0, n_chans), maxshape=(None, n_chans), dtype=np.float32,
+            chunks=(chunk_rows, n_chans))
+        self._columns = dict(
+            (name, self._h5.create_dataset(name, shape=(0,), maxshape=(None,),
+                                           dtype=np.float64, chunks=(1024,)))
+            for name in ('requested_freqs', 'source_freqs', 'dump_timestamps'))
+        self.rows = 0
+
+    def write(self, requested_freq, source_freq, response, dump_timestamp):
+        row = self.rows
+        self.responses.resize(row + 1, axis=0)
+        self.responses[row] = response
+        for name, value in (('requested_freqs', requested_freq), ('source_freqs', source_freq),
+                            ('dump_timestamps', dump_timestamp)):
+            self._columns[name].resize(row + 1, axis=0)
+            self._columns[name][row] = value
+        self.rows += 1
+
+    def result(self, missed_freqs):
+        """
+        Flush the store and describe its contents, responses are read lazily from the file
+        :rtype: SweepResult
+        """
+        if 'missed_freqs' in self._h5:
+            del self._h5['missed_freqs']
+        self._h5.create_dataset('missed_freqs', data=np.asarray(missed_freqs, dtype=np.float64))
+        self._h5.flush()
+        return SweepResult(self._columns['requested_freqs'][()],
+                           self._columns['source_freqs'][()], self.responses,
+                           self._columns['dump_timestamps'][()], list(missed_freqs))
+
+    def close(self):
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def load_sweep(filename):
+    """
+    Read a sweep written by SweepStore
+    :param: filename: Str
+    :rtype: tuple: (SweepResult, Dict of file attributes)
+    """
+    with h5py.File(filename, 'r') as h5:
+        missed_freqs = list(h5['missed_freqs'][()]) if 'missed_freqs' in h5 else []
+        result = SweepResult(h5['requested_freqs'][()], h5['source_freqs'][()],
+                             h5['responses'][()], h5['dump_timestamps'][()], missed_freqs)
+        return result, dict(h5.attrs)
+
+
+class SweepAborted(RuntimeError):
+    """
+    Raised when too many consecutive accumulations could not be retrieved during a sweep
+    """
+    pass
+
+
+class FrequencySweep(object):
+    """
+    Sweep a digitiser simulator sine source over a list of frequencies and collect the
+    correlator response to each.
+
+    Received accumulations are indexed by dump timestamp (see DumpRingBuffer) and each step
+    takes the first accumulation that started after the retune and is newer than the previous
+    step's, tagged with the source frequency that was active. The source is retuned as soon as
+    the accumulation for the current frequency has arrived, and the response to that
+    accumulation is only computed after the retune has been issued, so retune latency overlaps
+    with the next accumulation instead of adding to it.
+
+    Usage:
+
+    sweep = FrequencySweep(self.dhost, self.receiver, int_time, scale=cw_scale)
+    result = sweep.run(freqs, lambda dump: normalised_magnitude(dump['xeng_raw'][:, 0, :]))
+    result.responses  # (freqs x channels)
+
+    :param: dhost: corr2.dsimhost_fpga.FpgaDsimHost
+    :param: receiver: corr2.corr_rx.CorrRx
+    :param: int_time: Float, accumulation time [s]
+    :param: source: Str, name of the digitiser simulator sine source
+    :param: scale: Float, sine source scale, left unchanged if None
+    :param: tolerance: Float, fraction of an accumulation a dump may start before the retune
+            timestamp, to absorb an offset between the digitiser simulator and dump clocks
+    :param: dump_timeout: Float, extra time to wait for an accumulation [s]
+    :param: max_failures: Int, consecutive missed accumulations before the sweep is aborted
+    """
+
+    def __init__(self, dhost, receiver, int_time, source='sin_0', scale=None, tolerance=0.,
+                 dump_timeout=10, max_failures=5):
+        self.dhost = dhost
+        self.receiver = receiver
+        self.int_time = int_time
+        self.source = getattr(dhost.sine_sources, source)
+        self.scale = scale
+        self.tolerance = tolerance
+        self.dump_timeout = dump_timeout
+        self.max_failures = max_failures
+
+    def dsim_timestamp(self):
+        """Digitiser simulator time, in the units of the accumulation dump_timestamp"""
+        return self.dhost.registers.sys_clkcounter.read().get('timestamp')
+
+    def retune(self, freq):
+        """
+        Set the source frequency
+        :param: freq: Float [Hz]
+        :rtype: tuple: (Frequency the source generates [Hz], timestamp of the retune)
+        """
+        if self.scale is None:
+            self.source.set(frequency=freq)
+        else:
+            self.source.set(frequency=freq, scale=self.scale)
+        return self.source.frequency, self.dsim_timestamp()
+
+    def run(self, freqs, response_fn, progress_fn=None, skip_repeats=True, store=None):
+        """
+        Sweep the source over `freqs`
+
+        :param: freqs: List/array of frequencies [Hz]
+        :param: response_fn: Function mapping an accumulation to a 1-D response (channels)
+        :param: progress_fn: Function called with (index, requested frequency) before each step
+        :param: skip_repeats: Boolean, skip frequencies the source generates identically to the
+                previous step
+        :param: store: SweepRecorder/SweepStore that receives each response as it is computed,
+                responses are kept in memory if None
+        :rtype: SweepResult
+        :raises: SweepAborted if more than max_failures consecutive accumulations are missed
+        """
+        freqs = np.asarray(freqs, dtype=np.float64)
+        if store is None:
+            store = SweepRecorder()
+        missed = []
+        failures = 0
+        with DumpRingBuffer(self.receiver) as dump_buffer:
+            # (requested freq, source freq, accumulation) whose response is still to be computed
+            pending = None
+            last_source_freq = None
+            last_dump_timestamp = None
+            for i, freq in enumerate(freqs):
+                if progress_fn is not None:
+                    progress_fn(i, freq)
+                source_freq, retune_ts = self.retune(freq)
+                # The source was retuned after the pending dump's window closed; its response is
+                # computed while the next accumulation is running.
+                if pending is not None:
+                    self._record(store, response_fn, *pending)
+                    pending = None
+                if skip_repeats and source_freq == last_source_freq:
+                    LOGGER.info('Skipping channel response for freq %s @ %s: %s MHz.\n'
+                                'Digitiser frequency is same as previous.' % (
+                                    i + 1, len(freqs), freq / 1e6))
+                    continue
+                last_source_freq = source_freq
+                try:
+                    dump = dump_buffer.await_first_dump(
+                        retune_ts - self.tolerance * self.int_time, after=last_dump_timestamp,
+                        timeout=2 * self.int_time + self.dump_timeout)
+                except Queue.Empty:
+                    failures += 1
+                    missed.append(freq)
+                    LOGGER.exception('Could not retrieve accumulation for %s Hz after retune at '
+                                     '%s, as # %s Queue is Empty.' % (freq, retune_ts, failures))
+                    if failures > self.max_failures:
+                        raise SweepAborted('Kept receiving empty SPEAD accumulations')
+                    continue
+                failures = 0
+                last_dump_timestamp = dump['dump_timestamp']
+                LOGGER.info('Received accumulation timestamp: %s, relevant to DEngine '
+                            'timestamp: %s (Difference %.2f)' % (dump['dump_timestamp'],
+                                retune_ts, dump['dump_timestamp'] - retune_ts))
+                pending = (freq, source_freq, dump)
+            if pending is not None:
+                self._record(store, response_fn, *pending)
+        return store.result(missed)
+
+    @staticmethod
+    def _record(store, response_fn, requested_freq, source_freq, dump):
+        store.write(requested_freq, source_freq, response_fn(dump), dump['dump_timestamp'])
+
+
+SfdrPeaks = namedtuple('SfdrPeaks', 'max_channels spur_rows spur_channels spur_levels')
+"""
+max_channels: array, channel with the peak response in each row
+spur_rows, spur_channels: arrays, coordinates of responses within cutoff of their row's peak,
+    the peak itself excluded
+spur_levels: array, level of each spur relative to its row's peak [dB]
+"""
+
+
+def sfdr_peaks(responses, cutoff, chunk_rows=256):
+    """
+    Find the peak channel and spurious peaks of every response in a sweep
+
+    :param: responses: (freqs x channels) array or h5py dataset, e.g. SweepResult.responses.
+            Datasets are read chunk_rows rows at a time
+    :param: cutoff: Float, dB below a row's peak above which another channel counts as a spur
+    :param: chunk_rows: Int
+    :rtype: SfdrPeaks, rows as stored in `responses`
+    """
+    n_rows = len(responses)
+    max_channels = np.empty(n_rows, dtype=np.int64)
+    spur_rows, spur_channels, spur_levels = [], [], []
+    for start in xrange(0, n_rows, chunk_rows):
+        block = np.asarray(responses[start:start + chunk_rows])
+        rows = np.arange(len(block))
+        block_max = np.argmax(block, axis=1)
+        peaks = block[rows, block_max]
+        spurs = block >= (peaks / 10 ** (cutoff / 10.))[:, np.newaxis]
+        spurs[rows, block_max] = False
+        row, channel = np.nonzero(spurs)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            spur_levels.append(10 * np.log10(block[row, channel] / peaks[row]))
+        max_channels[start:start + len(block)] = block_max
+        spur_rows.append(row + start)
+        spur_channels.append(channel)
+    if not n_rows:
+        return SfdrPeaks(max_channels, np.empty(0, dtype=np.int64),
+                         np.empty(0, dtype=np.int64), np.empty(0))
+    return SfdrPeaks(max_channels, np.concatenate(spur_rows), np.concatenate(spur_channels),
+                     np.concatenate(spur_levels))
+
+
+def tone_leakage(responses, channels, cutoff):
+    """
+    Check for inter-tone leakage in a multi-tone accumulation
+
+    :param: responses: (sources x channels) response of each source's input
+    :param: channels: expected channel of each source's tone
+    :param: cutoff: Float, dB below a tone's own peak above which another tone counts as leaked
+    :rtype: Boolean: True if any tone is visible on another source's input
+    """
+    for i, response in enumerate(responses):
+        threshold = response[channels[i]] / 10 ** (cutoff / 10.)
+        for j, channel in enumerate(channels):
+            if j != i and channel != channels[i] and response[channel] >= threshold:
+                return True
+    return False
+
+
+class MultiToneSweep(FrequencySweep):
+    """
+    Frequency sweep placing one tone per digitiser simulator sine source in every accumulation.
+
+    Each source drives its own input, so a single accumulation gives one single-tone response
+    per source and a full-band scan needs 1 / len(sources) of the accumulations. The requested
+    frequencies are split into len(sources) contiguous blocks that are swept simultaneously,
+    keeping the tones of an accumulation well separated, and every response is attributed to
+    its tone by source. Accumulations in which a tone is visible on another source's input
+    (see tone_leakage) are measured again in single-tone mode, and if the first accumulation
+    already shows leakage the whole sweep falls back to single-tone mode.
+
+    Usage:
+
+    sweep = MultiToneSweep(self.dhost, self.receiver, int_time, chan_bw, scale=cw_scale)
+    result = sweep.run_tones(freqs, [response_input0, response_input1])
+
+    :param: chan_bw: Float, channel bandwidth [Hz], to locate each tone's channel
+    :param: sources: Tuple, names of the digitiser simulator sine sources, one per input
+    :param: cutoff: Float, inter-tone leakage threshold [dB], see tone_leakage
+    Other parameters as for FrequencySweep
+    """
+
+    def __init__(self, dhost, receiver, int_time, chan_bw, sources=('sin_0', 'sin_1'),
+                 cutoff=53, **kwargs):
+        FrequencySweep.__init__(self, dhost, receiver, int_time, source=sources[0], **kwargs)
+        self.chan_bw = chan_bw
+        self.source_names = sources
+        self.sources = [getattr(dhost.sine_sources, source) for source in sources]
+        self.cutoff = cutoff
+        self.kwargs = kwargs
+
+    def retune(self, freqs):
+        """
+        Set one frequency per source
+        :param: freqs: Sequence of Float [Hz], one per source
+        :rtype: tuple: (tuple of frequencies the sources generate [Hz], timestamp of the retune)
+        """
+        for source, freq in zip(self.sources, freqs):
+            if self.scale is None:
+                source.set(frequency=freq)
+            else:
+                source.set(frequency=freq, scale=self.scale)
+        return tuple(source.frequency for source in self.sources), self.dsim_timestamp()
+
+    def silence_secondary(self):
+        """Silence all but the first source"""
+        for source in self.sources[1:]:
+            source.set(frequency=source.frequency, scale=0)
+
+    def single_tone(self):
+        """Silence all but the first source and return a single-tone sweep on it"""
+        self.silence_secondary()
+        return FrequencySweep(self.dhost, self.receiver, self.int_time,
+                              source=self.source_names[0], **self.kwargs)
+
+    def run_tones(self, freqs, response_fns, progress_fn=None, store=None):
+        """
+        Sweep `freqs`, len(sources) tones at a time
+
+        :param: freqs: List/array of frequencies [Hz]
+        :param: response_fns: One function per source, mapping an accumulation to the 1-D
+                response (channels) of that source's input
+        :param: progress_fn: Function called with (index, requested frequency) before each
+                accumulation
+        :param: store: SweepRecorder/SweepStore receiving one single-tone response per requested
+                frequency, responses are kept in memory if None
+        :rtype: SweepResult, rows in capture order
+        :raises: SweepAborted if more than max_failures consecutive accumulations are missed
+        """
+        try:
+            return self._run_tones(freqs, response_fns, progress_fn, store)
+        finally:
+            # Only the first source is left playing, whichever way the sweep ended
+            self.silence_secondary()
+
+    def _run_tones(self, freqs, response_fns, progress_fn, store):
+        freqs = np.asarray(freqs, dtype=np.float64)
+        if store is None:
+            store = SweepRecorder()
+        n_sources = len(self.sources)
+        n_steps = len(freqs) // n_sources
+        # Step k places tone i at freqs[i * n_steps + k]
+        tone_idx = np.arange(n_steps * n_sources).reshape(n_sources, n_steps).T
+        single_idx = range(n_steps * n_sources, len(freqs))
+
+        def multi_response(dump):
+            return np.array([response_fn(dump) for response_fn in response_fns])
+
+        def report_progress(idx_map):
+            def _report(i, freq):
+                if progress_fn is not None:
+                    for idx in np.atleast_1d(idx_map[i]):
+                        progress_fn(idx, freqs[idx])
+            return _report
+
+        if n_steps:
+            # Probe with the first tone set before committing to the multi-tone sweep
+            splitter = _ToneSplitter(store, freqs, tone_idx, self.chan_bw, self.cutoff)
+            FrequencySweep.run(self, freqs[tone_idx[:1]], multi_response,
+                               progress_fn=report_progress(tone_idx[:1]), skip_repeats=False,
+                               store=splitter)
+            if splitter.remeasure or not splitter.written:
+                LOGGER.warning('Inter-tone leakage detected, falling back to single-tone sweep.')
+                single_idx = range(len(freqs))
+            else:
+                FrequencySweep.run(self, freqs[tone_idx[1:]], multi_response,
+                                   progress_fn=report_progress(tone_idx[1:]), skip_repeats=False,
+                                   store=splitter)
+                single_idx = sorted(list(single_idx) + splitter.remeasure)
+
+        if single_idx:
+            single_idx = np.asarray(single_idx)
+            return self.single_tone().run(freqs[single_idx], response_fns[0],
+                                          progress_fn=report_progress(single_idx),
+                                          skip_repeats=False, store=store)
+        return store.result([])
+
+
+class _ToneSplitter(object):
+    """
+    Store for multi-tone accumulations: attributes each source's response to its tone and writes
+    it to the target store, or queues the tones to be measured again if they leaked
+    """
+
+    def __init__(self, target, freqs, tone_idx, chan_bw, cutoff):
+        self.target = target
+        self.step_of = dict((tuple(freqs[idx]), idx) for idx in tone_idx)
+        self.chan_bw = chan_bw
+        self.cutoff = cutoff
+        self.remeasure = []
+        self.written = 0
+
+    def write(self, requested_freqs, source_freqs, responses, dump_timestamp):
+        channels = np.round(np.asarray(source_freqs) / self.chan_bw).astype(int)
+        if tone_leakage(responses, channels, self.cutoff):
+            LOGGER.warning('Inter-tone leakage at %s Hz, measuring tones separately.'
+                           % list(source_freqs))
+            self.remeasure.extend(self.step_of[tuple(requested_freqs)])
+            return
+        for requested_freq, source_freq, response in zip(requested_freqs, source_freqs,
+                                                          responses):
+            self.target.write(requested_freq, source_freq, response, dump_timestamp)
+        self.written += 1
+
+    def result(self, missed_freqs):
+        for step_freqs in missed_freqs:
+            self.remeasure.extend(self.step_of[tuple(step_freqs)])
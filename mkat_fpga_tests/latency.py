@@ -0,0 +1,202 @@
+"""
+Measured latency from a CAM request to the first accumulation it affects.
+
+Tests discard accumulations after a configuration change so that the one they analyse was
+captured under the new configuration. Instead of a fixed number of discards per test,
+LatencyCalibrator measures how many accumulations a change takes to reach the output, once per
+instrument and accumulation length, and caches the result on the correlator fixture.
+
+Usage:
+
+test_dump = self.receiver.get_clean_dump(discard=dumps_until_effective(self))
+"""
+import logging
+import math
+import threading
+import time
+
+from collections import namedtuple
+
+import numpy as np
+
+from mkat_fpga_tests.utils import classify_baselines, parameters
+
+LOGGER = logging.getLogger('mkat_fpga_tests')
+
+Latency = namedtuple('Latency', 'dumps seconds int_time')
+"""
+dumps: Int, accumulations received after the request returned that were not yet affected by it
+seconds: Float, time from issuing the request to receiving the first affected accumulation [s]
+int_time: Float, accumulation time during the measurement [s]
+"""
+
+
+class LatencyCalibrationError(RuntimeError):
+    """Raised when the effect of a calibration request is never seen in the output"""
+    pass
+
+
+class LatencyCalibrator(object):
+    """
+    Measure the latency of configuration changes by setting all input gains to zero and waiting
+    for the first all-zero accumulation. Any accumulation that includes data from before the
+    change is non-zero, so the count is of whole accumulations, whatever part of the latency is
+    spent in the CAM interface, the F-engines or the X-engine accumulators. Each input's gains
+    are then restored, per channel, and the calibration waits until every baseline that had
+    signal has it again.
+
+    A measurement needs signal on the inputs, e.g. the digitiser simulator noise that most tests
+    configure. If there is none, `fallback_latency` is assumed until the measurements are
+    invalidated.
+
+    Usage:
+
+    calibrator = LatencyCalibrator(self.corr_fix)
+    _parameters = parameters(self)
+    discards = calibrator.dumps_until_effective(self.receiver, _parameters['int_time'],
+                                                _parameters['input_labels'])
+
+    :param: corr_fix: CorrelatorFixture
+    :param: margin: Int, accumulations discarded on top of the measured latency
+    :param: fallback_latency: Float, latency assumed when it cannot be measured [s]
+    :param: max_dumps: Int, accumulations to wait for a gain change to take effect
+    :param: dump_timeout: Float, extra time to wait for an accumulation [s]
+    :param: cam_timeout: Float, `gain` and `gain-all` request timeout [s]
+    """
+
+    def __init__(self, corr_fix, margin=1, fallback_latency=10., max_dumps=50, dump_timeout=10,
+                 cam_timeout=60):
+        self.corr_fix = corr_fix
+        self.margin = margin
+        self.fallback_latency = fallback_latency
+        self.max_dumps = max_dumps
+        self.dump_timeout = dump_timeout
+        self.cam_timeout = cam_timeout
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Drop all measurements, e.g. after the correlator was reprogrammed"""
+        with self._lock:
+            self._cache.clear()
+
+    def latency(self, receiver, int_time, input_labels):
+        """
+        Latency of the running instrument, measured on first use for each accumulation length and
+        cached, also when there was no signal to measure it with, until `invalidate`
+        :param: receiver: corr2.corr_rx.CorrRx
+        :param: int_time: Float, current accumulation time [s]
+        :param: input_labels: List of Str, inputs whose gains are restored after the measurement
+        :rtype: Latency, or None if it could not be measured
+        """
+        # Accumulation times are a whole number of spectra, ignore float noise in the sensor
+        key = (self.corr_fix.instrument, round(int_time, 6))
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+        try:
+            latency = self.calibrate(receiver, int_time, input_labels)
+        except Exception:
+            LOGGER.exception('Failed to measure the pipeline latency of %s, assuming %ss' % (
+                key, self.fallback_latency))
+            latency = None
+        else:
+            if latency is None:
+                # Cached too, otherwise every call reads the gains of every input again
+                LOGGER.warning('No signal to measure the pipeline latency with, assuming %ss'
+                               % self.fallback_latency)
+            else:
+                LOGGER.info('Pipeline latency of %s: %s' % (key, latency))
+        with self._lock:
+            self._cache[key] = latency
+        return latency
+
+    def dumps_until_effective(self, receiver, int_time, input_labels):
+        """
+        :param: receiver: corr2.corr_rx.CorrRx
+        :param: int_time: Float, current accumulation time [s]
+        :param: input_labels: List of Str, inputs whose gains are restored after a measurement
+        :rtype: Int, `discard` argument of receiver.get_clean_dump that returns the first
+                accumulation captured entirely after a CAM request that has already returned
+        """
+        latency = self.latency(receiver, int_time, input_labels)
+        if latency is None:
+            return int(math.ceil(self.fallback_latency / int_time)) + self.margin
+        return latency.dumps + self.margin
+
+    def calibrate(self, receiver, int_time, input_labels):
+        """
+        :param: receiver: corr2.corr_rx.CorrRx
+        :param: int_time: Float, current accumulation time [s]
+        :param: input_labels: List of Str, inputs whose gains are restored after the measurement
+        :rtype: Latency, or None if no baseline has signal
+        :raises: LatencyCalibrationError, Queue.Empty if accumulations stop
+        """
+        # Tests may have equalised inputs differently, so every input's gains are restored
+        initial_gains = {}
+        for label in input_labels:
+            reply, _informs = self.corr_fix.katcp_rct.req.gain(label, timeout=self.cam_timeout)
+            if not reply.reply_ok():
+                raise LatencyCalibrationError('Failed to retrieve gains of %s: %s' % (
+                    label, str(reply)))
+            initial_gains[label] = reply.arguments[1:]
+        timeout = int_time + self.dump_timeout
+        dump = receiver.get_clean_dump(dump_timeout=timeout, discard=0)
+        initial_nonzero = classify_baselines(dump['xeng_raw']).nonzero
+        if not initial_nonzero.any():
+            return None
+        try:
+            dumps, seconds = self._measure(receiver, self._zero_gains,
+                                           lambda nonzero: not nonzero.any(), timeout)
+        finally:
+            self._measure(receiver, lambda: self._restore_gains(initial_gains),
+                          lambda nonzero: np.array_equal(nonzero, initial_nonzero), timeout)
+        return Latency(dumps, seconds, int_time)
+
+    def _zero_gains(self):
+        reply, _informs = self.corr_fix.katcp_rct.req.gain_all(0, timeout=self.cam_timeout)
+        if not reply.reply_ok():
+            raise LatencyCalibrationError('Failed to set gains to zero: %s' % str(reply))
+
+    def _restore_gains(self, gains):
+        """:param: gains: Dict of input label: List of Str gains, as read with `gain`"""
+        # Restore as many inputs as possible before reporting a failure
+        failed = []
+        for label, input_gains in gains.items():
+            reply, _informs = self.corr_fix.katcp_rct.req.gain(label, *input_gains,
+                                                               timeout=self.cam_timeout)
+            if not reply.reply_ok():
+                LOGGER.error('Failed to restore gains of %s: %s' % (label, str(reply)))
+                failed.append(label)
+        if failed:
+            raise LatencyCalibrationError('Failed to restore gains of %s' % ', '.join(failed))
+
+    def _measure(self, receiver, set_fn, effective_fn, timeout):
+        """
+        Change the gains with `set_fn` and count the accumulations, as get_clean_dump discards
+        them, until `effective_fn` is True of the non-zero baselines mask of one
+        :rtype: tuple: (Int accumulations, Float seconds)
+        """
+        start_time = time.time()
+        set_fn()
+        dump = receiver.get_clean_dump(dump_timeout=timeout, discard=0)
+        for dumps in xrange(self.max_dumps):
+            if effective_fn(classify_baselines(dump['xeng_raw']).nonzero):
+                return dumps, time.time() - start_time
+            dump = receiver.data_queue.get(timeout=timeout)
+        raise LatencyCalibrationError('Gain change not seen in %s accumulations' %
+                                      self.max_dumps)
+
+
+def dumps_until_effective(self):
+    """
+    Accumulations to discard after a configuration change, measured once per instrument and
+    accumulation length and kept on the correlator fixture.
+    param: self: object with `corr_fix` and `receiver` attributes
+    rtype: Int, `discard` argument of receiver.get_clean_dump
+    """
+    if getattr(self.corr_fix, 'latency_calibrator', None) is None:
+        self.corr_fix.latency_calibrator = LatencyCalibrator(self.corr_fix)
+    _parameters = parameters(self)
+    return self.corr_fix.latency_calibrator.dumps_until_effective(
+        self.receiver, _parameters['int_time'], _parameters['input_labels'])
@@ -1,9 +1,12 @@
 import csv
 import logging
+import numpy as np
 import os
+import pandas as pd
 import telnetlib
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from inspect import currentframe, getframeinfo
 from telnetlib import IAC, NOP
 from corr2.utils import parse_ini_file
@@ -17,17 +20,115 @@ class NetworkError(RuntimeError):
     pass
 
 
+LOG_HEADERS = ['Sample Time', 'PDU Host', 'Phase Current', 'Phase Power']
+NUM_PHASES = 3
+
+
+def load_power_log(power_log_file, start_timestamp=None):
+    """
+        Load a PowerLogger CSV file into a columnar DataFrame.
+
+        The comma-joined phase strings are expanded into numeric columns
+        current_0..2 [A] and power_0..2 [kW].
+
+        params:
+            power_log_file: CSV file written by PowerLogger
+            start_timestamp: Only samples at or after this time are returned
+        returns: pandas.DataFrame
+    """
+    df = pd.read_csv(power_log_file, delimiter='\t')
+    if list(df.keys()) != LOG_HEADERS:
+        raise IOError(power_log_file)
+    if start_timestamp is not None:
+        df = df[df['Sample Time'] >= int(start_timestamp)]
+    frame = pd.DataFrame({'Sample Time': df['Sample Time'].values,
+                          'PDU Host': df['PDU Host'].values})
+    for column, prefix in (('Phase Current', 'current'), ('Phase Power', 'power')):
+        phases = (df[column].astype(str).str.split(',', expand=True)
+                  .reindex(columns=range(NUM_PHASES)))
+        phases = phases.apply(pd.to_numeric, errors='coerce').values
+        for phase in range(NUM_PHASES):
+            frame['{}_{}'.format(prefix, phase)] = phases[:, phase]
+    return frame
+
+
+def analyse_power_log(frame, time_gap=60):
+    """
+        Compute CBF and per-rack power statistics from a frame returned by load_power_log.
+
+        Samples are grouped into time slices containing one reading per PDU. Logs written
+        with a shared sampling clock are grouped on sample time, older (serially polled)
+        logs on the k-th reading of each PDU. Slices missing a PDU, or containing NaNs,
+        are dropped. A rack is named by the PDU host name up to the first '-'.
+
+        params:
+            frame: pandas.DataFrame from load_power_log
+            time_gap: Report gaps between consecutive samples larger than this [s]
+        returns: dict with keys
+            time_gaps: list of (sample time, gap) tuples
+            slice_times: array of time slice start times
+            total_power: array of total CBF power per time slice [kW]
+            racks: {rack: {'power': mean power [kW], 'phase_current': mean current per
+                    phase [A], 'phase_imbalance': max difference in current per phase [%]}}
+    """
+    time_stamps = frame['Sample Time'].values
+    ts_diff = np.diff(time_stamps)
+    gap_idx = np.flatnonzero(ts_diff > time_gap)
+    result = {'time_gaps': zip(time_stamps[gap_idx], ts_diff[gap_idx]),
+              'slice_times': np.array([]), 'total_power': np.array([]), 'racks': {}}
+
+    phase_cols = (['current_{}'.format(i) for i in range(NUM_PHASES)] +
+                  ['power_{}'.format(i) for i in range(NUM_PHASES)])
+    frame = frame.copy()
+    pdus = frame['PDU Host'].unique()
+    # With a shared sampling clock there is roughly one sample time per len(pdus) rows
+    if frame['Sample Time'].nunique() * len(pdus) < 2 * len(frame):
+        frame['slice'] = frame['Sample Time']
+    else:
+        frame['slice'] = frame.groupby('PDU Host').cumcount()
+    frame = frame.dropna(subset=phase_cols).drop_duplicates(['slice', 'PDU Host'])
+    # (slices x (phase columns x pdus)), only keep slices with samples from all PDUs
+    table = frame.pivot(index='slice', columns='PDU Host', values=phase_cols)
+    table = table.dropna()
+    if table.empty or len(pdus) == 0:
+        return result
+    slice_times = frame.groupby('slice')['Sample Time'].min().reindex(table.index).values
+    values = table.values.reshape(len(table), 2, NUM_PHASES, -1)
+    pdu_order = np.asarray(table.columns.get_level_values('PDU Host')[:values.shape[-1]])
+    currents = values[:, 0]
+    powers = values[:, 1]
+
+    result['slice_times'] = slice_times
+    result['total_power'] = powers.sum(axis=(1, 2))
+    rack_names = np.array([name[:name.find('-')] for name in pdu_order])
+    for rack in np.unique(rack_names):
+        in_rack = rack_names == rack
+        rack_current = currents[:, :, in_rack].sum(axis=2)
+        rack_power = powers[:, :, in_rack].sum(axis=2)
+        phase_current = rack_current.mean(axis=0)
+        ph_m = np.max(phase_current)
+        result['racks'][rack] = {
+            'power': rack_power.sum(axis=1).mean(),
+            'phase_current': phase_current,
+            'phase_imbalance': np.max(100 * (ph_m - phase_current) / ph_m),
+        }
+    return result
+
+
 class PowerLogger(threading.Thread):
     REQ_PWR = ['phReading id:all power', 'kW']
     REQ_CRNT = ['phReading id:all current', 'A']
 
     def __init__(self, config_info, conn_retry=10, console_log_level=logging.ERROR,
-                 file_log_level=logging.INFO):
+                 file_log_level=logging.INFO, sample_period=1):
         """
             PowerLogger reads PDU IP addresses from a config file and starts logging
             current and power from each PDU. Values are written to a CSV file. This
             class is threaded and must be started with instance.start()
 
+            All PDUs are polled concurrently against a shared sampling tick, every row
+            written for a tick carries the same sample time.
+
             params:
                 config_info: Dictionary parsed with corr2.utils.parse_ini_file or
                              a config file.
@@ -35,6 +136,7 @@ class PowerLogger(threading.Thread):
                              and if contact is lost during logging to PDUs
                 console_log_level: Log level for print to std_out
                 file_log_level: Log level for logging to file
+                sample_period: Seconds between sampling ticks
         """
 
         # **************************************************************************
@@ -91,6 +193,7 @@ class PowerLogger(threading.Thread):
         self._pdu_password = decode_passwd(pdu_password, arb)
         self._stop = threading.Event()
         self._conn_retry = conn_retry
+        self._sample_period = sample_period
         self.start_timestamp = None
         self.log_file_name = 'pdu_log.csv'
         self.logger.info('PDUs logged: %s' % (pdu_names))
@@ -157,6 +260,22 @@ class PowerLogger(threading.Thread):
         except Exception:
             raise
 
+    def _poll_pdu(self, telnet_handles, idx):
+        """Read current and power from one PDU, reconnecting if the connection was lost
+            returns: (host, phase current, phase power)
+        """
+        th = telnet_handles[idx]
+        try:
+            th.sock.sendall(IAC + NOP)
+        except Exception:
+            self.logger.warning('Connection lost to PDU {}.'.format(th.host))
+            self.logger.info('Trying to reconnect to PDU {}'.format(th.host))
+            th = self.open_telnet_conn(th.host, self._pdu_port)
+            telnet_handles[idx] = th
+        power = self.read_from_pdu(th, self.REQ_PWR)
+        current = self.read_from_pdu(th, self.REQ_CRNT)
+        return th.host, current[1], power[1]
+
     def write_pdu_log(self):
         # Open all the pdus
         telnet_handles = []
@@ -190,31 +309,28 @@ class PowerLogger(threading.Thread):
                 if open_mode == 'wb':
                     csv_writer.writerow(['Sample Time', 'PDU Host', 'Phase Current', 'Phase Power'])
                 con_err_dict = {x: 0 for x in self._pdu_hosts}
-                while not self._stop.isSet():
-                    for idx, th in enumerate(telnet_handles):
-                        try:
-                            th.sock.sendall(IAC + NOP)
-                        except:
-                            self.logger.warning('Connection lost to PDU {}.'.format(th.host))
+                pollers = ThreadPoolExecutor(max_workers=len(telnet_handles))
+                try:
+                    next_tick = time.time()
+                    while not self._stop.isSet():
+                        # Single sampling clock: every PDU is polled concurrently for this tick
+                        smpl_time = str(int(next_tick))
+                        futures = [pollers.submit(self._poll_pdu, telnet_handles, idx)
+                                   for idx in range(len(telnet_handles))]
+                        for idx, future in enumerate(futures):
                             try:
-                                self.logger.info('Trying to reconnect to PDU {}'.format(th.host))
-                                telnet_handles[idx] = self.open_telnet_conn(host, th.host)
-                                th = telnet_handles[idx]
-                                con_err_dict[th.host] = 0
-                            except KeyError:
-                                break
+                                host, current, power = future.result()
                             except Exception as e:
-                                con_err_dict[th.host] += 1
-                                self.logger.error('Exception occured while connecting to PDU {}.'.format(th.host))
-                                self.logger.error('Exception: {}'.format(e))
-                                break
-                        power = self.read_from_pdu(th, self.REQ_PWR)
-                        current = self.read_from_pdu(th, self.REQ_CRNT)
-                        data = [power[0], th.host, current[1], power[1]]
-                        if self.start_timestamp is None:
-                            self.start_timestamp = power[0]
-                        csv_writer.writerow(data)
+                                host = telnet_handles[idx].host
+                                con_err_dict[host] = con_err_dict.get(host, 0) + 1
+                                self.logger.error('Exception occured while polling PDU {}: {}'.format(
+                                    host, e))
+                                continue
+                            con_err_dict[host] = 0
+                            csv_writer.writerow([smpl_time, host, current, power])
                         csvfile.flush()
+                        if self.start_timestamp is None:
+                            self.start_timestamp = smpl_time
                         for key in con_err_dict:
                             if con_err_dict[key] > self._conn_retry:
                                 self.logger.error('Connection lost to PDU {}... exiting.'.format(key))
@@ -222,6 +338,15 @@ class PowerLogger(threading.Thread):
                                 for th in telnet_handles:
                                     self.close_telnet_conn(th)
                                 raise NetworkError("Connection lost to PDU {}.".format(key))
+                        next_tick += self._sample_period
+                        sleep_time = next_tick - time.time()
+                        if sleep_time > 0:
+                            self._stop.wait(sleep_time)
+                        else:
+                            # Polling took longer than a sample period, realign to the clock
+                            next_tick = time.time()
+                finally:
+                    pollers.shutdown(wait=True)
         else:
             self.logger.error('Unable to connect to the following PDUs: {}'.format(hosts))
             self.logger.info('Closing telnet connections to PDUs.')
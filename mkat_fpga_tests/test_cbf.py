@@ -15,7 +15,6 @@ from __future__ import division
 import collections
 import colors
 import corr2
-import csv
 import gc
 import katcp
 import logging
@@ -52,6 +51,14 @@ from datetime import datetime
 from mkat_fpga_tests import correlator_fixture
 
 from mkat_fpga_tests.aqf_utils import *
+from mkat_fpga_tests.delay_model import (DELAY_FIELDS, DelayLoadError, DelaySchedule,
+                                         baseline_visibilities, fit_phases, model_delays,
+                                         model_phases, nyquist_chan_freqs,
+                                         parse_delay_coefficients, wrap_phases)
+from mkat_fpga_tests.latency import dumps_until_effective
+from mkat_fpga_tests.freq_sweep import (FrequencySweep, MultiToneSweep, SweepAborted, SweepStore,
+                                        sfdr_peaks)
+from mkat_fpga_tests.power_logger import PowerLogger, analyse_power_log, load_power_log
 from mkat_fpga_tests.utils import *
 from nosekatreport import *
 from descriptions import TestProcedure
@@ -90,7 +97,6 @@ have_subscribed = False
 set_dsim_epoch = False
 dsim_timeout = 60
 
-
 @cls_end_aqf
 @system('all')
 class test_CBF(unittest.TestCase):
@@ -102,6 +108,10 @@ class test_CBF(unittest.TestCase):
         global have_subscribed, set_dsim_epoch
         self._dsim_set = False
         self.corr_fix = correlator_fixture
+        # Run against the offline digital twin instead of CBF hardware
+        if eval(os.getenv('DIGITAL_TWIN', 'False')) and self.corr_fix.twin is None:
+            from mkat_fpga_tests.digital_twin import DigitalTwin
+            DigitalTwin(self.corr_fix.instrument or 'bc8n856M4k').attach(self.corr_fix)
         try:
             self.conf_file = self.corr_fix.test_config
             self.corr_fix.katcp_clt = self.conf_file['inst_param']['katcp_client']
@@ -220,6 +230,7 @@ class test_CBF(unittest.TestCase):
             return False
         else:
             acc_time = float(reply.arguments[-1])
+            self.corr_fix.invalidate_parameters()
             Aqf.step('[CBF-REQ-0071, 0096, 0089] Set and confirm accumulation period via CAM interface.')
             Aqf.progress('Accumulation time set to {:.3f} seconds'.format(acc_time))
             try:
@@ -242,7 +253,10 @@ class test_CBF(unittest.TestCase):
                 output_product = parameters(self)['output_product']
                 Aqf.step('Initiate SPEAD receiver on port %s, and CBF output product %s' % (
                     corrRx_port, output_product))
-                if corrRx_port == 8888:
+                if self.corr_fix.twin is not None:
+                    self.receiver = self.corr_fix.twin.receiver(queue_size=queue_size)
+                    LOGGER.info('Running against the digital twin')
+                elif corrRx_port == 8888:
                     self.receiver = CorrRx(product_name=output_product,
                         port=corrRx_port, queue_size=queue_size)
                     LOGGER.info('Running lab testing and listening to corr2_servlet on localhost')
@@ -457,7 +471,8 @@ class test_CBF(unittest.TestCase):
             instrument_success = self.set_instrument(instrument, acc_time=0.2)
             _running_inst = self.corr_fix.get_running_instrument()
             if instrument_success and _running_inst:
-                self._test_sfdr_peaks(required_chan_spacing=30e3, no_channels=32768)  # Hz
+                self._test_sfdr_peaks(required_chan_spacing=30e3, no_channels=32768,
+                                      multi_tone=True)  # Hz
             else:
                 Aqf.failed(self.errmsg)
 
@@ -476,7 +491,8 @@ class test_CBF(unittest.TestCase):
             instrument_success = self.set_instrument(instrument, acc_time=0.5)
             _running_inst = self.corr_fix.get_running_instrument()
             if instrument_success and _running_inst:
-                self._test_sfdr_peaks(required_chan_spacing=30e3, no_channels=32768)  # Hz
+                self._test_sfdr_peaks(required_chan_spacing=30e3, no_channels=32768,
+                                      multi_tone=True)  # Hz
             else:
                 Aqf.failed(self.errmsg)
 
@@ -495,7 +511,8 @@ class test_CBF(unittest.TestCase):
             instrument_success = self.set_instrument(instrument, acc_time=0.5)
             _running_inst = self.corr_fix.get_running_instrument()
             if instrument_success and _running_inst:
-                self._test_sfdr_peaks(required_chan_spacing=30e3, no_channels=32768)  # Hz
+                self._test_sfdr_peaks(required_chan_spacing=30e3, no_channels=32768,
+                                      multi_tone=True)  # Hz
             else:
                 Aqf.failed(self.errmsg)
 
@@ -2095,10 +2112,13 @@ class test_CBF(unittest.TestCase):
         Aqf.step('Checking system stability(sensors OK status) before and after testing')
         xeng_sensors = ['phy', 'qdr', 'lru', 'reorder', 'network-tx', 'network-rx']
         test_timeout = 30
+        # One sensor-value request serves both the X and F-engine checks
+        health_snapshot = HostHealthSnapshot.fetch(self)
         errmsg = 'Failed to retrieve X-Eng status: Timed-out after %s seconds.' % (test_timeout)
         try:
             with RunTestWithTimeout(test_timeout, errmsg):
-                get_hosts_status(self, check_host_okay, xeng_sensors, engine_type='xeng')
+                get_hosts_status(self, check_host_okay, xeng_sensors, engine_type='xeng',
+                                 snapshot=health_snapshot)
         except Exception:
             LOGGER.exception(errmsg)
             Aqf.failed(errmsg)
@@ -2107,7 +2127,8 @@ class test_CBF(unittest.TestCase):
         errmsg = ('Failed to retrieve F-Eng status: Timed-out after %s seconds.' % (test_timeout))
         try:
             with RunTestWithTimeout(test_timeout, errmsg):
-                get_hosts_status(self, check_host_okay, feng_sensors, engine_type='feng')
+                get_hosts_status(self, check_host_okay, feng_sensors, engine_type='feng',
+                                 snapshot=health_snapshot)
         except Exception:
             LOGGER.exception(errmsg)
             Aqf.failed(errmsg)
@@ -2127,23 +2148,30 @@ class test_CBF(unittest.TestCase):
 
         try:
             self.correlator.xops.set_acc_time(accumulation_time)
+            self.corr_fix.invalidate_parameters()
         except VaccSynchAttemptsMaxedOut:
             Aqf.failed('Failed to set accumulation time of {} after {} maximum vacc '
                        'sync attempts.'.format(accumulation_time, max_vacc_sync_attempts))
         else:
             Aqf.step('Getting SPEAD accumulation #1 before setting {}.'
                      .format(flag_description))
-            try:
-                dump1 = self.receiver.get_clean_dump()
-            except Queue.Empty:
-                errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
-                Aqf.failed(errmsg)
-                LOGGER.exception(errmsg)
-            else:
+            with EpochTracker(self.receiver, accumulation_time,
+                              dump_timeout=DUMP_TIMEOUT) as epochs:
+                # Start from a fresh accumulation, not one left in the receiver queue, so that
+                # the flag is set and cleared within the following accumulation
+                epochs.mark('before flag')
+                try:
+                    dump1 = epochs.first_dump('before flag')
+                except Queue.Empty:
+                    errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
+                    Aqf.failed(errmsg)
+                    LOGGER.exception(errmsg)
+                    return
                 start_time = time.time()
                 Aqf.wait(0.1 * accumulation_time, 'Waiting 10% of accumulation length')
                 Aqf.step('Setting {}'.format(flag_description))
                 flag_enable_fn()
+                flag_set_time = epochs.mark('flag set')
                 # Ensure that the flag is disabled even if the test fails to avoid
                 # contaminating other tests
                 self.addCleanup(flag_disable_fn)
@@ -2154,11 +2182,18 @@ class test_CBF(unittest.TestCase):
                 Aqf.wait(wait_time, 'Waiting until 80% of accumulation length has elapsed')
                 Aqf.step('Clearing {}'.format(flag_description))
                 flag_disable_fn()
-                Aqf.step('Getting SPEAD accumulation #2 after setting and clearing {}.'
-                         .format(flag_description))
-                dump2 = self.receiver.data_queue.get()
-                Aqf.step('Getting SPEAD accumulation #3.')
-                dump3 = self.receiver.data_queue.get()
+                epochs.mark('flag cleared')
+                try:
+                    Aqf.step('Getting SPEAD accumulation #2 after setting and clearing {}.'
+                             .format(flag_description))
+                    dump2 = epochs.dump_at(flag_set_time)
+                    Aqf.step('Getting SPEAD accumulation #3.')
+                    dump3 = epochs.first_dump('flag cleared')
+                except Queue.Empty:
+                    errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
+                    Aqf.failed(errmsg)
+                    LOGGER.exception(errmsg)
+                    return
                 return (dump1, dump2, dump3)
 
     def _delays_setup(self, test_source_idx=2):
@@ -2199,6 +2234,7 @@ class test_CBF(unittest.TestCase):
         self.addCleanup(restore_src_names, self)
         try:
             reply, _informs = self.corr_fix.katcp_rct.req.input_labels(*local_src_names, timeout=60)
+            self.corr_fix.invalidate_parameters()
             assert reply.reply_ok()
         except Exception:
             Aqf.failed(
@@ -2228,7 +2264,7 @@ class test_CBF(unittest.TestCase):
             Aqf.step('Retrieve initial SPEAD accumulation, in-order to calculate all '
                      'relevant parameters.')
             try:
-                _discards = 2
+                _discards = dumps_until_effective(self)
                 initial_dump = self.receiver.get_clean_dump(discard=_discards)
             except Queue.Empty:
                 errmsg = 'Could not retrieve clean SPEAD accumulation: Queue might be Empty.'
@@ -2332,7 +2368,6 @@ class test_CBF(unittest.TestCase):
             Aqf.less(final_cmd_time, cam_max_load_time, msg)
 
         last_discard = setup_data['t_apply'] - setup_data['int_time']
-        num_discards = 0
         fpga = self.correlator.xhosts[0]
         vacc_lsw = fpga.registers.vacc_time_lsw.read()
         vacc_msw = fpga.registers.vacc_time_msw.read()
@@ -2343,160 +2378,73 @@ class test_CBF(unittest.TestCase):
         Aqf.step('Getting SPEAD accumulation containing the change in fringes(s) on input: %s '
                  'baseline: %s, and discard all irrelevant accumulations.' % (
                   setup_data['test_source'], setup_data['baseline_index']))
-        while True:
-            num_discards += 1
+        with DumpRingBuffer(self.receiver) as dump_buffer:
             try:
-                dump = self.receiver.data_queue.get()
-            except Queue.Empty:
-                errmsg = 'Could not retrieve clean SPEAD accumulation: Queue might be Empty.'
-                Aqf.failed(errmsg)
-                LOGGER.exception(errmsg)
-            else:
-                # print np.max(
-                #     np.angle(complexise(dump['xeng_raw'][:, setup_data['baseline_index'], :])))
-                #Aqf.hop('Dump timestamp in ticks: {:20d}'.format(dump['timestamp']))
-
-                if (np.abs(dump['dump_timestamp'] - last_discard) < 0.1 * setup_data['int_time']):
-                    Aqf.passed('[CBF-REQ-0077]: Received final accumulation before fringe '
-                             'application with dump timestamp: %s, relevant to time apply: %s '
-                             '(Difference %.2f)' % (dump['dump_timestamp'], setup_data['t_apply'],
-                                (setup_data['t_apply'] - dump['dump_timestamp'])))
-                    fringe_dumps.append(dump)
-                    break
-
-                if num_discards > max_wait_dumps:
-                    Aqf.failed('Could not get accumulation with correct timestamp within %s '
-                               'accumulation periods.' % max_wait_dumps)
-                    break
-                else:
-                    difference = setup_data['t_apply'] - dump['dump_timestamp']
-                    msg = ("Discarding (#%d) Spead accumulation with dump timestamp: %s"
-                           "(and timestamp in ticks: %s), relevant to time to apply: %s"
-                           "(Difference %.2f), Current epoch time: %s." % (num_discards,
-                            dump['dump_timestamp'], dump['timestamp'], setup_data['t_apply'],
-                            difference, time.time()))
-                    Aqf.progress(msg)
-
-        for i in xrange(dump_counts - 1):
-            Aqf.progress('Getting subsequent SPEAD accumulation {}.'.format(i + 1))
-            try:
-                dump = self.receiver.data_queue.get()
-                #dump = self.receiver.get_clean_dump(discard=0)
-            except Queue.Empty:
-                errmsg = 'Could not retrieve clean SPEAD accumulation: Queue might be Empty.'
-                Aqf.failed(errmsg)
-                LOGGER.exception(errmsg)
-            else:
-                # print np.max(np.angle(dump['xeng_raw'][:,setup_data['baseline_index'],:]))
+                dump = dump_buffer.await_dump(last_discard,
+                    tolerance=0.1 * setup_data['int_time'],
+                    timeout=max_wait_dumps * setup_data['int_time'] + DUMP_TIMEOUT)
+            except (DumpMissedError, Queue.Empty):
+                Aqf.failed('Could not get accumulation with correct timestamp within %s '
+                           'accumulation periods.' % max_wait_dumps)
+                LOGGER.exception('Failed to retrieve accumulation with dump timestamp: %s' % (
+                    last_discard))
+            else:
+                Aqf.passed('[CBF-REQ-0077]: Received final accumulation before fringe '
+                         'application with dump timestamp: %s, relevant to time apply: %s '
+                         '(Difference %.2f)' % (dump['dump_timestamp'], setup_data['t_apply'],
+                            (setup_data['t_apply'] - dump['dump_timestamp'])))
                 fringe_dumps.append(dump)
 
-        chan_resp = []
-        phases = []
-        for acc in fringe_dumps:
-            dval = acc['xeng_raw']
-            freq_response = normalised_magnitude(
-                dval[:, setup_data['baseline_index'], :])
-            chan_resp.append(freq_response)
-
-            data = complexise(dval[:, setup_data['baseline_index'], :])
-            #print np.max(np.angle(data))
-            phases.append(np.angle(data))
-            # amp = np.mean(np.abs(data)) / setup_data['n_accs']
+                for i in xrange(dump_counts - 1):
+                    Aqf.progress('Getting subsequent SPEAD accumulation {}.'.format(i + 1))
+                    try:
+                        dump = dump_buffer.await_next_dump(dump['dump_timestamp'],
+                                                           timeout=DUMP_TIMEOUT)
+                    except Queue.Empty:
+                        errmsg = 'Could not retrieve clean SPEAD accumulation: Queue might be Empty.'
+                        Aqf.failed(errmsg)
+                        LOGGER.exception(errmsg)
+                        break
+                    else:
+                        fringe_dumps.append(dump)
 
+        if not fringe_dumps:
+            return [], actual_delay_coef
+        visibilities = baseline_visibilities(fringe_dumps, setup_data['baseline_index'])
+        phases = np.angle(visibilities)
+        chan_resp = normalise(np.abs(visibilities))
         return zip(phases, chan_resp), actual_delay_coef
 
 
-    def _get_expected_data(self, setup_data, dump_counts, delay_coefficients, actual_phases):
-
-        def calc_actual_delay(setup_data):
-            no_ch = self.corr_freqs.n_chans
-            first_dump = np.unwrap(actual_phases[0])
-            actual_slope = np.polyfit(xrange(0, no_ch), first_dump, 1)[0] * no_ch
-            actual_delay = setup_data['sample_period'] * actual_slope / np.pi
-            return actual_delay
-
-        def gen_delay_vector(delay, setup_data):
-            res = []
-            no_ch = self.corr_freqs.n_chans
-            delay_slope = np.pi * (delay / setup_data['sample_period'])
-            c = delay_slope / 2
-            for i in xrange(0, no_ch):
-                m = i / float(no_ch)
-                res.append(delay_slope * m - c)
-            return res
-
-        def gen_delay_data(delay, delay_rate, dump_counts, setup_data):
-            expected_phases = []
-            prev_delay_rate = 0
-            for dump in xrange(0, dump_counts):
-                # For delay rate the expected delay is the average of delays
-                # applied during the integration. This is equal to the
-                # delay delta over the integration divided by two
-                max_delay_rate = dump * delay_rate
-                avg_delay_rate = ((max_delay_rate - prev_delay_rate) / 2) + prev_delay_rate
-                prev_delay_rate = max_delay_rate
-                tot_delay = (delay + avg_delay_rate * setup_data['int_time'])
-                expected_phases.append(gen_delay_vector(tot_delay, setup_data))
-            return expected_phases
-
-        def calc_actual_offset(setup_data):
-            no_ch = self.corr_freqs.n_chans
-            # mid_ch = no_ch / 2
-            first_dump = actual_phases[0]
-            # Determine average offset around 5 middle channels
-            actual_offset = np.average(first_dump)  # [mid_ch-3:mid_ch+3])
-            return actual_offset
-
-        def gen_fringe_vector(offset, setup_data):
-            return [offset] * self.corr_freqs.n_chans
-
-        def gen_fringe_data(fringe_offset, fringe_rate, dump_counts, setup_data):
-            expected_phases = []
-            prev_fringe_rate = 0
-            for dump in xrange(0, dump_counts):
-                # For fringe rate the expected delay is the average of delays
-                # applied during the integration. This is equal to the
-                # delay delta over the integration divided by two
-                max_fringe_rate = dump * fringe_rate
-                avg_fringe_rate = ((max_fringe_rate - prev_fringe_rate) / 2) + prev_fringe_rate
-                prev_fringe_rate = max_fringe_rate
-                offset = -(fringe_offset + avg_fringe_rate * setup_data['int_time'])
-                expected_phases.append(gen_fringe_vector(offset, setup_data))
-            return expected_phases
-
-        ant_delay = []
-        for delay in delay_coefficients:
-            bits = delay.strip().split(':')
-            if len(bits) != 2:
-                raise ValueError('%s is not a valid delay setting' % delay)
-            delay = bits[0]
-            delay = delay.split(',')
-            delay = (float(delay[0]), float(delay[1]))
-            fringe = bits[1]
-            fringe = fringe.split(',')
-            fringe = (float(fringe[0]), float(fringe[1]))
-            ant_delay.append((delay, fringe))
-
-        ant_idx = setup_data['test_source_ind']
-        delay = ant_delay[ant_idx][0][0]
-        delay_rate = ant_delay[ant_idx][0][1]
-        fringe_offset = ant_delay[ant_idx][1][0]
-        fringe_rate = ant_delay[ant_idx][1][1]
-
-        delay_data = np.array((gen_delay_data(delay, delay_rate, dump_counts,
-                                              setup_data)))
-        fringe_data = np.array(gen_fringe_data(fringe_offset, fringe_rate,
-                                               dump_counts, setup_data))
-        result = delay_data + fringe_data
-        wrapped_results = ((result + np.pi) % (2 * np.pi) - np.pi)
-
-        if (fringe_offset or fringe_rate) != 0:
-            fringe_phase = [np.abs((np.min(phase) + np.max(phase)) / 2.)
-                            for phase in fringe_data]
-            return zip(fringe_phase, wrapped_results)
+    def _get_expected_data(self, setup_data, dump_counts, delay_coefficients, actual_phases,
+                           actual_response=None):
+        coefficients = parse_delay_coefficients(delay_coefficients)[
+            setup_data['test_source_ind']]
+        sample_period = setup_data['sample_period']
+        n_chans = self.corr_freqs.n_chans
+        delays, fringe_phases = model_delays(coefficients, dump_counts, setup_data['int_time'])
+        chan_freqs = nyquist_chan_freqs(n_chans, sample_period)
+        wrapped_results = model_phases(coefficients, chan_freqs,
+                                       reference_freq=0.25 / sample_period, n_dumps=dump_counts,
+                                       int_time=setup_data['int_time'])
+
+        if len(actual_phases):
+            # Delay and fringe offset measured from each dump, weighted by channel magnitude
+            fit = fit_phases(actual_phases, chan_freqs, reference_freq=0.25 / sample_period,
+                             weights=actual_response)
+            for i, (delay, offset, residual) in enumerate(zip(fit.delays, fit.fringe_offsets,
+                                                              fit.residuals)):
+                Aqf.progress('Accumulation {}: measured delay {:.5e}s (expected {:.5e}s), fringe '
+                             'offset {:.3f} rad (expected {:.3f} rad), rms phase residual {:.3f} '
+                             'rad'.format(i, delay, delays[i], offset,
+                                          wrap_phases(fringe_phases[i]), residual))
+
+        fringe_offset, fringe_rate = coefficients[2:]
+        if fringe_offset or fringe_rate:
+            return zip(np.abs(fringe_phases), wrapped_results)
         else:
-            delay_phase = [np.abs((np.min(phase) - np.max(phase)) / 2.)
-                           for phase in delay_data]
+            # Half the phase swing across the band
+            delay_phase = np.abs(np.pi * delays / sample_period * (n_chans - 1) / n_chans) / 2.
             return zip(delay_phase, wrapped_results)
 
 
@@ -2506,121 +2454,48 @@ class test_CBF(unittest.TestCase):
         max_power_cbf = 60
         time_gap = 60
 
-        df = pd.read_csv(power_log_file, delimiter='\t')
-        headers = list(df.keys())
-        exp_headers = ['Sample Time', 'PDU Host', 'Phase Current', 'Phase Power']
-        if headers != exp_headers:
-            raise IOError(power_log_file)
-        pdus = list(set(list(df[headers[1]])))
-        # Slice out requested time block
-        end_ts = df['Sample Time'].iloc[-1]
         try:
-            strt_idx = df[df['Sample Time'] >= int(start_timestamp)].index
+            frame = load_power_log(power_log_file, start_timestamp)
         except TypeError:
             msg = ''
             Aqf.failed(msg)
             LOGGER.exception(msg)
-        else:
-            df = df.loc[strt_idx]
-            end_idx = df[df['Sample Time'] <= end_ts].index
-            df = df.loc[end_idx]
-            # Check for gaps and warn
-            time_stamps = df['Sample Time'].values
-            ts_diff = np.diff(time_stamps)
-            time_gaps = np.where(ts_diff > time_gap)
-            for idx in time_gaps[0]:
-                ts = time_stamps[idx]
-                diff_time = datetime.fromtimestamp(int(ts)).strftime('%Y-%m-%d_%H:%M')
-                diff = ts_diff[idx]
-                Aqf.step('Time gap of {}s found at {} in PDU samples.'.format(diff, diff_time))
-            # Convert power column to floats and build new array
-            df_list = np.asarray(df.values.tolist())
-            power_col = [x.split(',') for x in df_list[:, 3]]
-            power_col = [[float(x) for x in y] for y in power_col]
-            curr_col = [x.split(',') for x in df_list[:, 2]]
-            curr_col = [[float(x) for x in y] for y in curr_col]
-            cp_col = zip(curr_col, power_col)
-            power_array = []
-            for idx, val in enumerate(cp_col):
-                power_array.append([df_list[idx, 0], df_list[idx, 1], val[0], val[1]])
-            # Cut array into sets containing all pdus for a time slice
-            num_pdus = len(pdus)
-            rolled_up_samples = []
-            time_slice = []
-            name_found = []
-            pdus = np.asarray(pdus)
-            # Create dictionary with rack names
-            pdu_samples = {x: [] for x in pdus}
-            for _time, name, cur, power in power_array:
-                try:
-                    name_found.index(name)
-                except ValueError:
-                    # Remove NANs
-                    if not (np.isnan(cur[0]) or np.isnan(power[0])):
-                        time_slice.append([_time, name, cur, power])
-                    name_found.append(name)
-                else:
-                    # Only add time slices with samples from all PDUS
-                    if len(time_slice) == num_pdus:
-                        rolled_up = np.zeros(3)
-                        for sample in time_slice:
-                            rolled_up += np.asarray(sample[3])
-                        # add first timestamp from slice
-                        rolled_up = np.insert(rolled_up, 0, int(time_slice[0][0]))
-                        rolled_up_samples.append(rolled_up)
-                        # Populate samples per pdu
-                        for name in pdus:
-                            sample = next(x for x in time_slice if x[1] == name)
-                            sample = (sample[2], sample[3])
-                            smple = np.asarray(sample)
-                            pdu_samples[name].append(smple)
-
-                    time_slice = []
-                    name_found = []
-            if rolled_up_samples:
-                start_time = datetime.fromtimestamp(rolled_up_samples[0][0]).strftime('%Y-%m-%d %H:%M:%S')
-                end_time = datetime.fromtimestamp(rolled_up_samples[-1][0]).strftime('%Y-%m-%d %H:%M:%S')
-                ru_smpls = np.asarray(rolled_up_samples)
-                tot_power = ru_smpls[:, 1:4].sum(axis=1)
-                Aqf.progress('Power report from {} to {}'.format(start_time, end_time))
-                Aqf.progress('Average sample time: {}s'.format(int(np.diff(ru_smpls[:, 0]).mean())))
-                # Add samples for pdus in same rack
-                rack_samples = {x[:x.find('-')]: [] for x in pdus}
-                for name in pdu_samples:
-                    rack_name = name[:name.find('-')]
-                    if rack_samples[rack_name] != []:
-                        sample = np.add(rack_samples[rack_name], pdu_samples[name])
-                    else:
-                        sample = pdu_samples[name]
-                    rack_samples[rack_name] = sample
-                for rack in rack_samples:
-                    val = np.asarray(rack_samples[rack])
-                    curr = val[:, 0]
-                    power = val[:, 1]
-                    watts = power.sum(axis=1).mean()
-                    msg = ('[CBF-REQ-0164] Measured power for rack {} ({:.2f}kW) is more than {}kW'.format(
-                            rack, watts, max_power_per_rack))
-                    Aqf.less(watts, max_power_per_rack, msg)
-                    phase = np.zeros(3)
-                    for i, x in enumerate(phase):
-                        phase[i] = curr[:, i].mean()
-                    Aqf.progress('Average current per phase for rack {}: P1={:.2f}A, P2={:.2f}A, '
-                            'P3={:.2f}A'.format(rack, phase[0], phase[1], phase[2]))
-                    ph_m = np.max(phase)
-                    max_diff = np.max([100 * (x / ph_m) for x in ph_m - phase])
-                    max_diff = float('{:.1f}'.format(max_diff))
-                    msg = ('[CBF-REQ-0191] Maximum difference in current per phase for rack {} ({:.1f}%) is '
-                           'less than {}%'.format(rack, max_diff, max_power_diff_per_rack))
-                    # Aqf.less(max_diff,max_power_diff_per_rack,msg)
-                    # Aqf.waived(msg)
-                watts = tot_power.mean()
-                msg = '[CBF-REQ-0164] Measured power for CBF ({:.2f}kW) is more than {}kW'.format(watts,
-                    max_power_cbf)
-                Aqf.less(watts, max_power_cbf, msg)
-                watts = tot_power.max()
-                msg = '[CBF-REQ-0164] Measured peak power for CBF ({:.2f}kW) is more than {}kW'.format(watts,
-                    max_power_cbf)
-                Aqf.less(watts, max_power_cbf, msg)
+            return
+        power_stats = analyse_power_log(frame, time_gap)
+        # Check for gaps and warn
+        for ts, diff in power_stats['time_gaps']:
+            diff_time = datetime.fromtimestamp(int(ts)).strftime('%Y-%m-%d_%H:%M')
+            Aqf.step('Time gap of {}s found at {} in PDU samples.'.format(diff, diff_time))
+        slice_times = power_stats['slice_times']
+        if not len(slice_times):
+            return
+        tot_power = power_stats['total_power']
+        start_time = datetime.fromtimestamp(slice_times[0]).strftime('%Y-%m-%d %H:%M:%S')
+        end_time = datetime.fromtimestamp(slice_times[-1]).strftime('%Y-%m-%d %H:%M:%S')
+        Aqf.progress('Power report from {} to {}'.format(start_time, end_time))
+        if len(slice_times) > 1:
+            Aqf.progress('Average sample time: {}s'.format(int(np.diff(slice_times).mean())))
+        for rack, rack_stats in power_stats['racks'].iteritems():
+            watts = rack_stats['power']
+            msg = ('[CBF-REQ-0164] Measured power for rack {} ({:.2f}kW) is more than {}kW'.format(
+                    rack, watts, max_power_per_rack))
+            Aqf.less(watts, max_power_per_rack, msg)
+            phase = rack_stats['phase_current']
+            Aqf.progress('Average current per phase for rack {}: P1={:.2f}A, P2={:.2f}A, '
+                    'P3={:.2f}A'.format(rack, phase[0], phase[1], phase[2]))
+            max_diff = float('{:.1f}'.format(rack_stats['phase_imbalance']))
+            msg = ('[CBF-REQ-0191] Maximum difference in current per phase for rack {} ({:.1f}%) is '
+                   'less than {}%'.format(rack, max_diff, max_power_diff_per_rack))
+            # Aqf.less(max_diff,max_power_diff_per_rack,msg)
+            # Aqf.waived(msg)
+        watts = tot_power.mean()
+        msg = '[CBF-REQ-0164] Measured power for CBF ({:.2f}kW) is more than {}kW'.format(watts,
+            max_power_cbf)
+        Aqf.less(watts, max_power_cbf, msg)
+        watts = tot_power.max()
+        msg = '[CBF-REQ-0164] Measured peak power for CBF ({:.2f}kW) is more than {}kW'.format(watts,
+            max_power_cbf)
+        Aqf.less(watts, max_power_cbf, msg)
 
     #################################################################
     #                       Test Methods                            #
@@ -2636,14 +2511,8 @@ class test_CBF(unittest.TestCase):
         min_bandwithd_req = 770e6
         # [CBF-REQ-0126] CBF channel isolation
         cutoff = 53  # dB
-        # Placeholder of actual frequencies that the signal generator produces
-        actual_test_freqs = []
-        # Channel magnitude responses for each frequency
-        chan_responses = []
-        last_source_freq = None
 
         print_counts = 3
-        spead_failure_counter = 0
 
         try:
             self.last_pfb_counts = get_pfb_counts(
@@ -2679,7 +2548,7 @@ class test_CBF(unittest.TestCase):
         try:
             Aqf.step('Randomly select a frequency channel to test. Capture an initial correlator '
                      'SPEAD accumulation, determine the number of frequency channels')
-            initial_dump = self.receiver.get_clean_dump(discard=10)
+            initial_dump = self.receiver.get_clean_dump(discard=dumps_until_effective(self))
             self.assertIsInstance(initial_dump, dict)
         except Exception:
             errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
@@ -2728,7 +2597,7 @@ class test_CBF(unittest.TestCase):
         Aqf.step('Sweep the digitiser simulator over the centre frequencies of at '
                  'least all the channels that fall within the complete L-band')
 
-        for i, freq in enumerate(requested_test_freqs):
+        def report_progress(i, freq):
             if i < print_counts:
                 Aqf.progress('Getting channel response for freq {} @ {}: {:.3f} MHz.'.format(
                     i + 1, len(requested_test_freqs), freq / 1e6))
@@ -2741,95 +2610,60 @@ class test_CBF(unittest.TestCase):
                 LOGGER.info('Getting channel response for freq %s @ %s: %s MHz.' % (
                     i + 1, len(requested_test_freqs), freq / 1e6))
 
-            self.dhost.sine_sources.sin_0.set(frequency=freq, scale=cw_scale)
-            this_source_freq = self.dhost.sine_sources.sin_0.frequency
-
-            if this_source_freq == last_source_freq:
-                LOGGER.info('Skipping channel response for freq %s @ %s: %s MHz.\n'
-                            'Digitiser frequency is same as previous.' % (
-                                i + 1, len(requested_test_freqs), freq / 1e6))
-                continue  # Already calculated this one
-            else:
-                last_source_freq = this_source_freq
-
-            try:
-                this_freq_dump = self.receiver.get_clean_dump()
-            except Queue.Empty:
-                spead_failure_counter += 1
-                errmsg = ('Could not retrieve clean SPEAD accumulation, as # %s '
-                          'Queue is Empty.' % spead_failure_counter)
-                Aqf.failed(errmsg)
-                LOGGER.exception(errmsg)
-                if spead_failure_counter > 5:
-                    spead_failure_counter = 0
-                    Aqf.failed('Failing Test: Kept receiving empty SPEAD accumulations')
-                    return False
-            else:
-                # No of spead heap discards relevant to vacc
-                discards = 0
-                max_wait_dumps = 100
-                deng_timestamp = self.dhost.registers.sys_clkcounter.read().get('timestamp')
-                while True:
-                    try:
-                        queued_dump = self.receiver.data_queue.get(timeout=DUMP_TIMEOUT)
-                        self.assertIsInstance(queued_dump, dict)
-                    except Exception:
-                        errmsg = 'Could not retrieve clean accumulation.'
-                        LOGGER.exception(errmsg)
-                        Aqf.failed(errmsg)
-                    else:
-                        timestamp_diff = np.abs(queued_dump['dump_timestamp'] - deng_timestamp)
-                        if (timestamp_diff < 0.5):
-                            msg = ('Received correct accumulation timestamp: %s, relevant to '
-                                   'DEngine timestamp: %s (Difference %.2f)' % (
-                                    queued_dump['dump_timestamp'], deng_timestamp, timestamp_diff))
-                            LOGGER.info(msg)
-                            break
-
-                        if discards > max_wait_dumps:
-                            Aqf.failed('Could not get accumulation with correct timestamp within %s '
-                                       'accumulation periods.' % max_wait_dumps)
-                            break
-                        else:
-                            msg = ('Discarding subsequent dumps (%s) with dump timestamp (%s) '
-                                   'and DEngine timestamp (%s) with difference of %s.' %(discards,
-                                    queued_dump['dump_timestamp'], deng_timestamp, timestamp_diff))
-                            LOGGER.info(msg)
-                    discards += 1
-
-                this_freq_data = queued_dump['xeng_raw']
-                this_freq_response = normalised_magnitude(this_freq_data[:, test_baseline, :])
-                actual_test_freqs.append(this_source_freq)
-                chan_responses.append(this_freq_response)
-
-            # Plot an overall frequency response at the centre frequency just as
-            # a sanity check
-
-            if np.abs(freq - expected_fc) < 0.1:
-                plt_filename = '{}/{}_overall_channel_resolution.png'.format(self.logs_path,
-                    self._testMethodName)
-                plt_title = 'Overall frequency response at {} at {:.3f}MHz.'.format(
-                    test_chan, this_source_freq / 1e6)
-                max_peak = np.max(loggerise(this_freq_response))
-                new_cutoff = max_peak - cutoff
-                y_axis_limits = (-100, 1)
-                caption = ('An overall frequency response at the centre frequency, and ({:.3f}dB) '
-                           'and selected baseline {} / {} to test. CBF channel isolation [max channel'
-                           ' peak ({:.3f}dB) - ({}dB) cut-off] when '
-                           'digitiser simulator is configured to generate a continuous wave, with '
-                           'cw scale: {}, awgn scale: {}, Eq gain: {} and FFT shift: {}'.format(
-                                new_cutoff, test_baseline, bls_to_test, max_peak, cutoff, cw_scale,
-                                awgn_scale, gain, fft_shift))
-                aqf_plot_channels(this_freq_response, plt_filename, plt_title, caption=caption,
-                                  ylimits=y_axis_limits, cutoff=new_cutoff)
+        # Retune the dsim as soon as the accumulation for the previous frequency has arrived
+        sweep = FrequencySweep(self.dhost, self.receiver, int_time, scale=cw_scale,
+                               dump_timeout=DUMP_TIMEOUT)
+        # Keep the response matrix for offline analysis, see freq_sweep.load_sweep
+        sweep_filename = '{}/{}_channelisation_sweep.h5'.format(self.logs_path,
+                                                                self._testMethodName)
+        sweep_attrs = dict(baseline=test_baseline, test_chan=test_chan, cw_scale=cw_scale,
+                           awgn_scale=awgn_scale, gain=gain, fft_shift=fft_shift)
+        try:
+            with SweepStore(sweep_filename, no_channels, attrs=sweep_attrs) as sweep_store:
+                sweep_result = sweep.run(requested_test_freqs,
+                    lambda dump: normalised_magnitude(dump['xeng_raw'][:, test_baseline, :]),
+                    progress_fn=report_progress, store=sweep_store)
+                chan_responses = sweep_result.responses[()]
+        except SweepAborted:
+            LOGGER.exception('Channelisation sweep aborted')
+            Aqf.failed('Failing Test: Kept receiving empty SPEAD accumulations')
+            return False
+        Aqf.progress('Channel responses saved to {}'.format(sweep_filename))
+        for freq in sweep_result.missed_freqs:
+            errmsg = ('Could not retrieve clean SPEAD accumulation for freq {:.3f} MHz: Queue is '
+                      'Empty.'.format(freq / 1e6))
+            Aqf.failed(errmsg)
+        # Actual frequencies that the signal generator produces, and the channel magnitude
+        # responses for each frequency
+        actual_test_freqs = sweep_result.source_freqs
+
+        # Plot an overall frequency response at the centre frequency just as
+        # a sanity check
+        centre_idx = np.flatnonzero(np.abs(sweep_result.requested_freqs - expected_fc) < 0.1)
+        if centre_idx.size:
+            this_freq_response = chan_responses[centre_idx[0]]
+            this_source_freq = actual_test_freqs[centre_idx[0]]
+            plt_filename = '{}/{}_overall_channel_resolution.png'.format(self.logs_path,
+                self._testMethodName)
+            plt_title = 'Overall frequency response at {} at {:.3f}MHz.'.format(
+                test_chan, this_source_freq / 1e6)
+            max_peak = np.max(loggerise(this_freq_response))
+            new_cutoff = max_peak - cutoff
+            y_axis_limits = (-100, 1)
+            caption = ('An overall frequency response at the centre frequency, and ({:.3f}dB) '
+                       'and selected baseline {} / {} to test. CBF channel isolation [max channel'
+                       ' peak ({:.3f}dB) - ({}dB) cut-off] when '
+                       'digitiser simulator is configured to generate a continuous wave, with '
+                       'cw scale: {}, awgn scale: {}, Eq gain: {} and FFT shift: {}'.format(
+                            new_cutoff, test_baseline, bls_to_test, max_peak, cutoff, cw_scale,
+                            awgn_scale, gain, fft_shift))
+            aqf_plot_channels(this_freq_response, plt_filename, plt_title, caption=caption,
+                              ylimits=y_axis_limits, cutoff=new_cutoff)
         if self._hosts.startswith('roach'):
             # Test fft overflow and qdr status after
             Aqf.step('[CBF-REQ-0067] Check FFT overflow and QDR errors after channelisation.')
             check_fftoverflow_qdrstatus(self.correlator, self.last_pfb_counts)
         clear_host_status(self)
-        # Convert the lists to numpy arrays for easier working
-        actual_test_freqs = np.array(actual_test_freqs)
-        chan_responses = np.array(chan_responses)
         df = self.corr_freqs.delta_f
         try:
             rand_chan_response = len(chan_responses[random.randrange(len(chan_responses))])
@@ -2995,7 +2829,8 @@ class test_CBF(unittest.TestCase):
                         'relative to channel centre response.'.format(**locals()))
 
 
-    def _test_sfdr_peaks(self, required_chan_spacing, no_channels, cutoff=53, log_power=True):
+    def _test_sfdr_peaks(self, required_chan_spacing, no_channels, cutoff=53, log_power=True,
+                         multi_tone=False):
         """Test channel spacing and out-of-channel response
 
         Check that the correct channels have the peak response to each
@@ -3011,6 +2846,9 @@ class test_CBF(unittest.TestCase):
         cutoff : float
             Responses in other channels must be at least `-cutoff` dB below the response
             of the channel with centre frequency corresponding to the source frequency
+        multi_tone : bool
+            Sweep two tones per accumulation, see freq_sweep.MultiToneSweep. Falls back to
+            a single tone if inter-tone leakage is detected
 
         """
         # Start a power logger in a thread
@@ -3027,13 +2865,6 @@ class test_CBF(unittest.TestCase):
 
         # Get baseline 0 data, i.e. auto-corr of m000h
         test_baseline = 0
-        # Placeholder of actual frequencies that the signal generator produces
-        actual_test_freqs = []
-        # Channel no with max response for each frequency
-        max_channels = []
-        # Channel responses higher than -cutoff dB relative to expected channel
-        extra_peaks = []
-
         # Checking for all channels.
         start_chan = 1  # skip DC channel since dsim puts out zeros for freq=0
         n_chans = self.corr_freqs.n_chans
@@ -3074,7 +2905,7 @@ class test_CBF(unittest.TestCase):
         Aqf.step('[CBF-REQ-0053]  Capture an initial correlator SPEAD accumulation, determine the '
                  'number of requency channels.')
         try:
-            initial_dump = self.receiver.get_clean_dump()
+            initial_dump = self.receiver.get_clean_dump(discard=dumps_until_effective(self))
         except Queue.Empty:
             errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
             Aqf.failed(errmsg)
@@ -3096,10 +2927,11 @@ class test_CBF(unittest.TestCase):
 
         Aqf.step('Sweep the digitiser simulator over the all channels that fall '
                  'within the complete L-band.')
-        spead_failure_counter = 0
         channel_response_lst = []
         print_counts = 4
-        for channel, channel_f0 in enumerate(self.corr_freqs.chan_freqs[start_chan:], start_chan):
+
+        def report_progress(i, channel_f0):
+            channel = i + start_chan
             if channel < print_counts:
                 Aqf.progress('Getting channel response for freq {} @ {}: {:.3f} MHz.'.format(
                     channel, len(self.corr_freqs.chan_freqs), channel_f0 / 1e6))
@@ -3108,44 +2940,62 @@ class test_CBF(unittest.TestCase):
             elif channel > (n_chans - print_counts):
                 Aqf.progress('Getting channel response for freq {} @ {}: {:.3f} MHz.'.format(
                     channel, len(self.corr_freqs.chan_freqs), channel_f0 / 1e6))
-            else:
-                # LOGGER.info('Getting channel response for freq %s @ %s: %s MHz.' % (channel,
-                #         len(self.corr_freqs.chan_freqs), channel_f0 / 1e6))
-                pass
-
-            self.dhost.sine_sources.sin_0.set(frequency=channel_f0, scale=cw_scale)
 
-            this_source_freq = self.dhost.sine_sources.sin_0.frequency
-            actual_test_freqs.append(this_source_freq)
-            try:
-                this_freq_dump = self.receiver.get_clean_dump()
-            except Queue.Empty:
-                spead_failure_counter += 1
-                errmsg = ('Could not retrieve clean SPEAD accumulation, as # %s Queue is'
-                          ' Empty.' % (spead_failure_counter))
-                Aqf.failed(errmsg)
-                LOGGER.exception(errmsg)
-                if spead_failure_counter > 5:
-                    spead_failure_counter = 0
-                    Aqf.failed('Bailed: Kept receiving empty SPEAD accumulations')
-                    return False
-            else:
-                this_freq_data = this_freq_dump['xeng_raw']
-                this_freq_response = (
-                    normalised_magnitude(this_freq_data[:, test_baseline, :]))
-                chans_to_plot = (n_chans // 10, n_chans // 2, 9 * n_chans // 10)
-                if channel in chans_to_plot:
-                    channel_response_lst.append(this_freq_response)
-
-                max_chan = np.argmax(this_freq_response)
-                max_channels.append(max_chan)
-                # Find responses that are more than -cutoff relative to max
-
-                new_cutoff = np.max(loggerise(this_freq_response)) + cutoff
-                unwanted_cutoff = this_freq_response[max_chan] / 10 ** (new_cutoff / 10.)
-                extra_responses = [i for i, resp in enumerate(this_freq_response)
-                                   if i != max_chan and resp >= unwanted_cutoff]
-                extra_peaks.append(extra_responses)
+        def baseline_response(baseline):
+            return lambda dump: normalised_magnitude(dump['xeng_raw'][:, baseline, :])
+
+        int_time = parameters(self)['int_time']
+        sweep_filename = '{}/{}_sfdr_sweep.h5'.format(self.logs_path, self._testMethodName)
+        sweep_store = SweepStore(sweep_filename, n_chans,
+                                 attrs=dict(baseline=test_baseline, cw_scale=cw_scale,
+                                            awgn_scale=awgn_scale, gain=gain,
+                                            fft_shift=fft_shift))
+        self.addCleanup(sweep_store.close)
+        try:
+            if multi_tone:
+                # sin_0 drives input 0 and sin_1 input 1, measure one tone on each auto-correlation
+                Aqf.progress('Sweeping two tones per accumulation, one on each of the first two '
+                             'inputs.')
+                input_labels = parameters(self)['input_labels']
+                second_baseline = get_baselines_lookup(self)[(input_labels[1], input_labels[1])]
+                sweep = MultiToneSweep(self.dhost, self.receiver, int_time,
+                                       self.corr_freqs.delta_f, cutoff=cutoff, scale=cw_scale,
+                                       dump_timeout=DUMP_TIMEOUT)
+                sweep_result = sweep.run_tones(self.corr_freqs.chan_freqs[start_chan:],
+                    [baseline_response(test_baseline), baseline_response(second_baseline)],
+                    progress_fn=report_progress, store=sweep_store)
+            else:
+                sweep = FrequencySweep(self.dhost, self.receiver, int_time, scale=cw_scale,
+                                       dump_timeout=DUMP_TIMEOUT)
+                sweep_result = sweep.run(self.corr_freqs.chan_freqs[start_chan:],
+                    baseline_response(test_baseline), progress_fn=report_progress,
+                    skip_repeats=False, store=sweep_store)
+        except SweepAborted:
+            LOGGER.exception('SFDR sweep aborted')
+            Aqf.failed('Bailed: Kept receiving empty SPEAD accumulations')
+            return False
+        Aqf.progress('Channel responses saved to {}'.format(sweep_filename))
+        for channel_f0 in sweep_result.missed_freqs:
+            errmsg = ('Could not retrieve clean SPEAD accumulation for freq {:.3f} MHz: Queue is '
+                      'Empty.'.format(channel_f0 / 1e6))
+            Aqf.failed(errmsg)
+        # Responses are stored in capture order, analyse them in channel order
+        capture_order = np.argsort(sweep_result.requested_freqs, kind='mergesort')
+        actual_test_freqs = list(sweep_result.source_freqs[capture_order])
+        swept_channels = np.searchsorted(self.corr_freqs.chan_freqs,
+                                         sweep_result.requested_freqs[capture_order])
+        chans_to_plot = (n_chans // 10, n_chans // 2, 9 * n_chans // 10)
+        for channel, row in zip(swept_channels, capture_order):
+            if channel in chans_to_plot:
+                channel_response_lst.append(sweep_result.responses[row])
+        # Peak channel and responses within -cutoff dB of it, for all frequencies at once
+        peaks = sfdr_peaks(sweep_result.responses, cutoff)
+        sweep_store.close()
+        max_channels = list(peaks.max_channels[capture_order])
+        # Spur coordinates in terms of the channel each frequency was centred on
+        spur_freq_channels = np.empty(len(capture_order), dtype=np.int64)
+        spur_freq_channels[capture_order] = swept_channels
+        spur_freq_channels = spur_freq_channels[peaks.spur_rows]
 
         for channel, channel_resp in zip(chans_to_plot, channel_response_lst):
             plt_filename = '{}/{}_channel_{}_resp.png'.format(self.logs_path,
@@ -3162,7 +3012,7 @@ class test_CBF(unittest.TestCase):
             aqf_plot_channels(channel_resp, plt_filename, plt_title, log_dynamic_range=90,
                               caption=caption, hlines=new_cutoff)
 
-        channel_range = range(start_chan, len(max_channels) + start_chan)
+        channel_range = list(swept_channels)
         Aqf.step('[VR.C.20] Check that the correct channels have the peak response to each frequency')
         if max_channels == channel_range:
             Aqf.passed('Confirm that the correct channels have the peak response to each frequency')
@@ -3171,10 +3021,13 @@ class test_CBF(unittest.TestCase):
             Aqf.array_abs_error(max_channels[1:], channel_range[1:], msg, 1)
 
         msg = ("[CBF-REQ-0126] Check that no other channels response more than -%s dB.\n"% cutoff)
-        if extra_peaks == [[]] * len(max_channels):
+        if not peaks.spur_rows.size:
             Aqf.passed(msg)
         else:
-            LOGGER.info('Expected: %s\n\nGot: %s' % (extra_peaks, [[]] * len(max_channels)))
+            spurs = ['channel {}: {} ({:.2f} dB)'.format(*spur) for spur in zip(
+                spur_freq_channels, peaks.spur_channels, peaks.spur_levels)]
+            LOGGER.info('%s responses within -%s dB of the peak channel, tone channel: spur '
+                        'channel (level):\n%s' % (len(spurs), cutoff, '\n'.join(spurs)))
             Aqf.failed(msg)
         if power_logger:
             power_logger.stop()
@@ -3196,7 +3049,7 @@ class test_CBF(unittest.TestCase):
         self.dhost.sine_sources.sin_0.set(scale=cw_scale, frequency=freq)
         Aqf.step('Capture a correlator SPEAD accumulation.')
         try:
-            dump = self.receiver.get_clean_dump(discard=5)
+            dump = self.receiver.get_clean_dump(discard=dumps_until_effective(self))
         except Queue.Empty:
             errmsg = 'Could not retrieve clean SPEAD accumulation, as Queue is Empty.'
             Aqf.failed(errmsg)
@@ -3213,7 +3066,7 @@ class test_CBF(unittest.TestCase):
                      'scale:{} on input 1'.format(freq / 1e6, cw_scale))
             self.dhost.sine_sources.sin_1.set(scale=cw_scale, frequency=freq)
             Aqf.step('Capture a correlator SPEAD accumulation.')
-            dump = self.receiver.get_clean_dump(discard=5)
+            dump = self.receiver.get_clean_dump(discard=dumps_until_effective(self))
             vacc_offset = get_vacc_offset(dump['xeng_raw'])
             msg = ('Confirm that auto-correlation in baseline 1 contains non-Zeros, '
                    'and baseline 0 is Zeros, when cw tone is only outputted on input 1.')
@@ -3221,7 +3074,7 @@ class test_CBF(unittest.TestCase):
             init_dsim_sources(self.dhost)
 
 
-    def _test_product_baselines(self, discards=25):
+    def _test_product_baselines(self, discards=None):
         if self.corr_freqs.n_chans == 4096:
             # 4K
             awgn_scale = 0.0645
@@ -3246,6 +3099,7 @@ class test_CBF(unittest.TestCase):
         local_src_names = self.correlator.configd['fengine']['source_names'].split(',')
         try:
             reply, informs = self.corr_fix.katcp_rct.req.input_labels(*local_src_names)
+            self.corr_fix.invalidate_parameters()
             assert reply.reply_ok()
             Aqf.passed('Input labels successfully changed/set to {}'.format(str(reply.arguments[1:])))
         except Exception:
@@ -3255,6 +3109,8 @@ class test_CBF(unittest.TestCase):
                  'of all the correlator input labels via Cam interface.')
         self.corr_fix.issue_metadata
         try:
+            if discards is None:
+                discards = dumps_until_effective(self)
             test_dump = self.receiver.get_clean_dump(discard=discards)
         except Queue.Empty:
             errmsg = 'Could not retrieve clean SPEAD accumulation, as Queue is Empty.'
@@ -3298,14 +3154,14 @@ class test_CBF(unittest.TestCase):
 
             msg = 'Check that all baselines are present in correlator output.'
             Aqf.is_true(all(baseline_is_present.values()), msg)
-            test_data = test_dump['xeng_raw']
             Aqf.step('[CBF-REQ-0213] Expect all baselines and all channels to be '
                      'non-zero with Digitiser Simulator set to output AWGN.')
+            bls_classes = DumpView(test_dump).baseline_classes
             msg = 'Confirm that no baselines have all-zero visibilities.'
-            Aqf.is_false(zero_baselines(test_data), msg)
+            Aqf.is_false(np.any(bls_classes.zero), msg)
 
             msg = 'Confirm that all baseline visibilities are non-zero across all channels'
-            Aqf.equals(nonzero_baselines(test_data), all_nonzero_baselines(test_data), msg)
+            Aqf.is_true(np.array_equal(bls_classes.nonzero, bls_classes.all_nonzero), msg)
 
             Aqf.step('Save initial f-engine equalisations, and ensure they are '
                      'restored at the end of the test')
@@ -3337,10 +3193,23 @@ class test_CBF(unittest.TestCase):
             Aqf.step('Set all inputs gains to \'Zero\', and confirm that output product '
                      'is all-zero')
 
+            # Take the first accumulation after each gain change instead of discarding dumps
+            epochs = EpochTracker(self.receiver, _parameters['int_time'],
+                                  dump_timeout=DUMP_TIMEOUT)
+            epochs.start()
+            self.addCleanup(epochs.stop)
             set_zero_gains()
+            epochs.mark('zero gains')
             read_zero_gains()
 
-            test_data = self.receiver.get_clean_dump(discard=discards)
+            try:
+                test_data = epochs.first_dump('zero gains')
+            except Queue.Empty:
+                errmsg = 'Could not retrieve clean SPEAD accumulation, as Queue is Empty.'
+                Aqf.failed(errmsg)
+                LOGGER.exception(errmsg)
+                epochs.stop()
+                return
             Aqf.is_false(nonzero_baselines(test_data['xeng_raw']),
                 'Confirm that all baseline visibilities are \'Zero\'.\n')
             # -----------------------------------
@@ -3379,6 +3248,7 @@ class test_CBF(unittest.TestCase):
                     Aqf.failed(errmsg)
                     LOGGER.exception(errmsg)
                 else:
+                    epochs.mark(inp)
                     msg = 'Gain/Equalisation correction on input {} set to {}.'.format(inp, old_eq)
                     Aqf.passed(msg)
                     zero_inputs.remove(inp)
@@ -3388,17 +3258,16 @@ class test_CBF(unittest.TestCase):
                     try:
                         Aqf.step('Retrieving SPEAD accumulation and confirm if gain/equlisation '
                                  'correction has been applied.')
-                        test_dump = self.receiver.get_clean_dump(discard=discards)
+                        test_dump = epochs.first_dump(inp)
                     except Queue.Empty:
                         errmsg = 'Could not retrieve clean SPEAD accumulation, as Queue is Empty.'
                         Aqf.failed(errmsg)
                         LOGGER.exception(errmsg)
                     else:
-                        test_data = test_dump['xeng_raw']
-                        # plot baseline channel response
-                        plot_data = [normalised_magnitude(test_data[:, i, :])
-                                     # plot_data = [loggerise(test_data[:, i, :])
-                                     for i in plot_baseline_inds]
+                        # Every check below reads its products from the one accumulation
+                        dump_view = DumpView(test_dump)
+                        # plot baseline channel response, (baselines x channels)
+                        plot_data = dump_view.normalised_magnitude(plot_baseline_inds).T
                         plot_filename = '{}/{}_channel_resp_{}.png'.format(self.logs_path,
                             self._testMethodName.replace(' ', '_'), inp)
 
@@ -3415,11 +3284,11 @@ class test_CBF(unittest.TestCase):
                         aqf_plot_channels(zip(plot_data, plot_baseline_legends), plot_filename,
                                           plot_title, log_dynamic_range=None, log_normalise_to=1,
                                           caption=caption, ylimits=(-0.1, np.max(plot_data) + 0.1))
-                        actual_nz_bls_indices = all_nonzero_baselines(test_data)
-                        actual_nz_bls = set(tuple(bls_ordering[i]) for i in actual_nz_bls_indices)
-
-                        actual_z_bls_indices = zero_baselines(test_data)
-                        actual_z_bls = set(tuple(bls_ordering[i]) for i in actual_z_bls_indices)
+                        bls_classes = dump_view.baseline_classes
+                        actual_nz_bls = set(tuple(bls_ordering[i])
+                                            for i in np.flatnonzero(bls_classes.all_nonzero))
+                        actual_z_bls = set(tuple(bls_ordering[i])
+                                           for i in np.flatnonzero(bls_classes.zero))
                         msg = ('Check that expected baseline visibilities are nonzero with '
                                'non-zero inputs {} and,'.format(sorted(nonzero_inputs)))
                         Aqf.equals(actual_nz_bls, expected_nz_bls, msg)
@@ -3428,14 +3297,15 @@ class test_CBF(unittest.TestCase):
                         Aqf.equals(actual_z_bls, expected_z_bls, msg)
 
                         # Sum of all baselines powers expected to be non zeros
-                        sum_of_bl_powers = (
-                            [normalised_magnitude(test_data[:, expected_bl, :])
-                             for expected_bl in [baselines_lookup[expected_nz_bl_ind]
-                                                 for expected_nz_bl_ind in sorted(expected_nz_bls)]])
-                        test_data = None
+                        sum_of_bl_powers = dump_view.power(
+                            [baselines_lookup[expected_nz_bl_ind]
+                             for expected_nz_bl_ind in sorted(expected_nz_bls)])
+                        # Drop the cached products of this accumulation before the next one
+                        dump_view = test_dump = None
                         dataFrame.loc[inp][sorted(
                             [i for i in expected_nz_bls])[-1]] = np.sum(sum_of_bl_powers)
 
+            epochs.stop()
             dataFrame.T.to_csv('{}.csv'.format(self._testMethodName), encoding='utf-8')
 
 
@@ -3464,7 +3334,7 @@ class test_CBF(unittest.TestCase):
 
         def retrieve_clean_dump(self, spead_failure_counter=0):
             try:
-                this_freq_dump = self.receiver.get_clean_dump()
+                this_freq_dump = self.receiver.get_clean_dump(discard=dumps_until_effective(self))
             except Queue.Empty:
                 spead_failure_counter += 1
                 errmsg = ('Could not retrieve clean SPEAD accumulation, as # %s '
@@ -3574,7 +3444,7 @@ class test_CBF(unittest.TestCase):
         Aqf.step('Calculate a list of frequencies to test')
         requested_test_freqs = self.corr_freqs.calc_freq_samples(
             test_chan, samples_per_chan=3, chans_around=1)
-        discards = 5
+        discards = dumps_until_effective(self)
         # Get baseline 0 data, i.e. auto-corr of m000h
         test_baseline = 0
         chan_responses = []
@@ -3583,7 +3453,7 @@ class test_CBF(unittest.TestCase):
         source_period_in_samples = self.corr_freqs.n_chans * 2
 
         try:
-            test_dump = self.receiver.get_clean_dump(discard=1)
+            test_dump = self.receiver.get_clean_dump(discard=discards)
         except Queue.Empty:
             errmsg = 'Could not retrieve clean SPEAD accumulation, as Queue is Empty.'
             Aqf.failed(errmsg)
@@ -3704,7 +3574,7 @@ class test_CBF(unittest.TestCase):
             return False
 
         try:
-            this_freq_dump = self.receiver.get_clean_dump(discard=1)
+            this_freq_dump = self.receiver.get_clean_dump(discard=dumps_until_effective(self))
         except Queue.Empty:
             errmsg = 'Could not retrieve clean SPEAD accumulation, as Queue is Empty.'
             Aqf.failed(errmsg)
@@ -3818,7 +3688,8 @@ class test_CBF(unittest.TestCase):
                             Aqf.hop('Getting Frequency SPEAD accumulation #{} with Digitiser simulator '
                                     'configured to generate cw at {:.3f}MHz'.format(i, freq / 1e6))
                             try:
-                                this_freq_dump = self.receiver.get_clean_dump(discard=1)
+                                this_freq_dump = self.receiver.get_clean_dump(
+                                    discard=dumps_until_effective(self))
                             except Queue.Empty:
                                 errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
                                 Aqf.failed(errmsg)
@@ -3833,7 +3704,8 @@ class test_CBF(unittest.TestCase):
                         Aqf.hop(msg)
                         self.dhost.sine_sources.sin_0.set(frequency=freq, scale=0.125)
                         try:
-                            this_freq_dump = self.receiver.get_clean_dump(discard=1)
+                            this_freq_dump = self.receiver.get_clean_dump(
+                                discard=dumps_until_effective(self))
                         except Queue.Empty:
                             errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
                             Aqf.failed(errmsg)
@@ -3889,12 +3761,12 @@ class test_CBF(unittest.TestCase):
                 test_delays))
 
             def get_expected_phases():
-                expected_phases = []
-                for delay in test_delays:
-                    phases = self.corr_freqs.chan_freqs * 2 * np.pi * delay
-                    phases -= np.max(phases) / 2.
-                    expected_phases.append(phases)
-                return zip(test_delays_ns, expected_phases)
+                coefficients = np.zeros((len(test_delays), len(DELAY_FIELDS)))
+                coefficients[:, 0] = test_delays
+                phases = model_phases(coefficients, self.corr_freqs.chan_freqs,
+                                      reference_freq=self.corr_freqs.chan_freqs[-1] / 2.,
+                                      wrap=False)
+                return zip(test_delays_ns, phases[:, 0])
 
             def get_actual_phases(_parameters):
                 actual_phases_list = []
@@ -3949,7 +3821,7 @@ class test_CBF(unittest.TestCase):
                             '''[CBF-REQ-0066, 0072] Delays set successfully via CAM interface:
                             Reply: %s'''%(formated_reply))
                     try:
-                        _num_discards = num_int + 5
+                        _num_discards = num_int + dumps_until_effective(self)
                         Aqf.step('Getting SPEAD accumulation(while discarding %s dumps) containing '
                                  'the change in delay(s) on input: %s baseline: %s.'%(_num_discards,
                                     setup_data['test_source'], setup_data['baseline_index']))
@@ -3966,10 +3838,8 @@ class test_CBF(unittest.TestCase):
                         # # this_freq_response = normalised_magnitude(
                         # #    this_freq_data[:, setup_data['test_source_ind'], :])
                         # # chan_responses.append(this_freq_response)
-                        data = complexise(dump['xeng_raw']
-                                          [:, setup_data['baseline_index'], :])
-
-                        phases = np.angle(data)
+                        phases = xeng_phase(dump['xeng_raw'][:, setup_data['baseline_index'], :],
+                                            dtype=np.float64)
                         # # actual_channel_responses = zip(test_delays, chan_responses)
                         # # return zip(actual_phases_list, actual_channel_responses)
                         actual_phases_list.append(phases)
@@ -4583,7 +4453,7 @@ class test_CBF(unittest.TestCase):
             Aqf.failed(errmsg)
             LOGGER.exception(errmsg)
         else:
-            quantiser_spectrum = np.array(eval(informs.arguments[-1]))
+            quantiser_spectrum = decode_snapshot(informs.arguments[-1])
             # Check that the spectrum is not zero in the test channel
             # Aqf.is_true(quantiser_spectrum[test_freq_channel] != 0,
             # 'Check that the spectrum is not zero in the test channel')
@@ -4601,11 +4471,16 @@ class test_CBF(unittest.TestCase):
                                                           delta_acc_t))
 
             chan_response = []
+            epochs = EpochTracker(self.receiver, max(acc_times), dump_timeout=DUMP_TIMEOUT)
+            epochs.start()
+            self.addCleanup(epochs.stop)
             # TODO MM 2016-10-07 Fix tests to use cam interface instead of corr object
             for vacc_accumulations, acc_time in zip(test_acc_lens, acc_times):
                 try:
                     # self.correlator.xops.set_acc_len(vacc_accumulations)
                     reply = self.corr_fix.katcp_rct.req.accumulation_length(acc_time, timeout=60)
+                    epochs.mark(acc_time)
+                    self.corr_fix.invalidate_parameters()
                     self.assertIsInstance(reply, katcp.resource.KATCPReply)
                 except (TimeoutError, VaccSynchAttemptsMaxedOut):
                     Aqf.failed('Failed to set accumulation length of {} after {} maximum vacc '
@@ -4621,7 +4496,7 @@ class test_CBF(unittest.TestCase):
                     no_accs = internal_accumulations * vacc_accumulations
                     expected_response = np.abs(quantiser_spectrum) ** 2 * no_accs
                     try:
-                        dump = self.receiver.get_clean_dump()
+                        dump = epochs.first_dump(acc_time)
                     except Queue.Empty:
                         errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
                         Aqf.failed(errmsg)
@@ -4652,6 +4527,7 @@ class test_CBF(unittest.TestCase):
                                                    abs_error=0.1):
                             aqf_plot_channels(actual_response_mag, plot_filename, plot_title,
                                               log_normalise_to=0, normalise=0, caption=caption)
+            epochs.stop()
 
 
     def _test_product_switch(self, instrument, no_channels):
@@ -4945,10 +4821,12 @@ class test_CBF(unittest.TestCase):
 
             if _delay_coefficients is not None:
                 expected_phases = self._get_expected_data(setup_data, dump_counts,
-                                                          _delay_coefficients, actual_phases)
+                                                          _delay_coefficients, actual_phases,
+                                                          actual_response)
             else:
                 expected_phases = self._get_expected_data(setup_data, dump_counts,
-                                                          delay_coefficients, actual_phases)
+                                                          delay_coefficients, actual_phases,
+                                                          actual_response)
 
             no_chans = range(self.corr_freqs.n_chans)
             plot_units = 'ns/s'
@@ -5060,10 +4938,12 @@ class test_CBF(unittest.TestCase):
 
             if _delay_coefficients is not None:
                 expected_phases = self._get_expected_data(setup_data, dump_counts,
-                                                          _delay_coefficients, actual_phases)
+                                                          _delay_coefficients, actual_phases,
+                                                          actual_response)
             else:
                 expected_phases = self._get_expected_data(setup_data, dump_counts,
-                                                          delay_coefficients, actual_phases)
+                                                          delay_coefficients, actual_phases,
+                                                          actual_response)
 
             if set([float(0)]) in [set(i) for i in actual_phases[1:]]:
                 Aqf.failed('Delays could not be applied at time_apply: {} '
@@ -5177,10 +5057,12 @@ class test_CBF(unittest.TestCase):
             actual_response = [response for phases, response in actual_data]
             if _delay_coefficients is not None:
                 expected_phases = self._get_expected_data(setup_data, dump_counts,
-                                                          _delay_coefficients, actual_phases)
+                                                          _delay_coefficients, actual_phases,
+                                                          actual_response)
             else:
                 expected_phases = self._get_expected_data(setup_data, dump_counts,
-                                                          delay_coefficients, actual_phases)
+                                                          delay_coefficients, actual_phases,
+                                                          actual_response)
 
             if set([float(0)]) in [set(i) for i in actual_phases[1:]]:
                 Aqf.failed('Delays could not be applied at time_apply: {} '
@@ -5303,7 +5185,7 @@ class test_CBF(unittest.TestCase):
             actual_response = [response for phases, response in actual_data]
 
             expected_phases = self._get_expected_data(setup_data, dump_counts, delay_coefficients,
-                                                      actual_phases)
+                                                      actual_phases, actual_response)
 
             if set([float(0)]) in [set(i) for i in actual_phases]:
                 Aqf.failed('Delays could not be applied at time_apply: {} '
@@ -5629,84 +5511,105 @@ class test_CBF(unittest.TestCase):
         setup_data = self._delays_setup()
         if setup_data:
             test_delay = self.corr_freqs.sample_period  # Pi
-            expected_phases = self.corr_freqs.chan_freqs * 2 * np.pi * test_delay
-            expected_phases -= np.max(expected_phases) / 2.
+            coefficients = np.zeros((1, len(DELAY_FIELDS)))
+            coefficients[0, 0] = test_delay
+            expected_phases = model_phases(coefficients, self.corr_freqs.chan_freqs,
+                                           reference_freq=self.corr_freqs.chan_freqs[-1] / 2.,
+                                           wrap=False)[0, 0]
             source_names = parameters(self)['input_labels']
-            # (MM) 2016-07-12
-            # Disabled source name randomisation due to the fact that some roach boards
-            # are known to have QDR issues which results to test failures, hence
-            # input1 has been statically assigned to be the testing input
-            delayed_input = source_names[random.randrange(len(source_names))]
-            delays = [0] * setup_data['num_inputs']
-            # Get index for input to delay
-            test_source_idx = source_names.index(delayed_input)
-            Aqf.step('Selected input to test: {}'.format(delayed_input))
-            delays[test_source_idx] = test_delay
-            delay_coefficients = ['{},0:0,0'.format(dv) for dv in delays]
+            num_inputs = setup_data['num_inputs']
             int_time = setup_data['int_time']
-            sync_time = setup_data['synch_epoch']
             num_int = setup_data['num_int']
+            # Delay each input in turn, one schedule step per input
+            steps = []
+            for test_source_idx in xrange(num_inputs):
+                step = np.zeros((num_inputs, len(DELAY_FIELDS)))
+                step[test_source_idx, 0] = test_delay
+                steps.append(step)
+            schedule = DelaySchedule(self.corr_fix.katcp_rct, self.receiver, int_time,
+                                     dump_timeout=DUMP_TIMEOUT)
+            # Reused between the settled accumulations of each delayed input
+            phase_buffers = {}
+
+            def delay_step_phases(step_idx, dump):
+                """
+                Phases of the baselines with and without the delayed input, computed as soon as
+                each step is over so that only the phases outlive the accumulation
+                :rtype: tuple: (List of (baseline, channels phases) with the delayed input,
+                        List of (baseline, index, maximum phase) of the other baselines with a
+                        phase offset)
+                """
+                delayed_input = source_names[step_idx]
+                # Phases of all baselines in one pass, (channels x baselines)
+                bls_phases = phase_buffers['phases'] = xeng_phase(
+                    dump['xeng_raw'], out=phase_buffers.get('phases'))
+                delayed_bls = []
+                offset_bls = []
+                for b_line in sorted_bls:
+                    b_line_val = b_line[1]
+                    b_line_phase = bls_phases[:, b_line_val]
+                    if ((delayed_input in b_line[0]) and
+                                b_line[0] != (delayed_input, delayed_input)):
+                        # Copied out of the phase buffer, which the next step reuses
+                        delayed_bls.append((b_line[0], b_line_phase.copy()))
+                    else:
+                        # np.deg2rad(1) = 0.017 ie error should be withing 2 decimals
+                        b_line_phase_max = round(np.max(b_line_phase), 2)
+                        if b_line_phase_max != 0.0:
+                            offset_bls.append((b_line[0], b_line_val, b_line_phase_max))
+                return delayed_bls, offset_bls
+
             try:
                 this_freq_dump = self.receiver.get_clean_dump(discard=0)
+                sorted_bls = get_baselines_lookup(self, this_freq_dump, sorted_lookup=True)
                 t_apply = this_freq_dump['dump_timestamp'] + (num_int * int_time)
-                t_apply_readable = this_freq_dump['dump_timestamp_readable']
-                Aqf.step('Delays will be applied with the following parameters:')
+                load_times = schedule.load_times(num_inputs, t_apply)
+                Aqf.step('Delays will be applied to each input in turn with the following '
+                         'parameters:')
                 Aqf.progress('Current epoch time: %s (%s)' %(time.time(), time.strftime("%H:%M:%S")))
                 Aqf.progress('Current Dump timestamp: %s (%s)'%(this_freq_dump['dump_timestamp'],
                     this_freq_dump['dump_timestamp_readable']))
-                Aqf.progress('Time delays will be applied: %s (%s)' %(t_apply, t_apply_readable))
-                Aqf.progress('Delay coefficients: %s' %delay_coefficients)
-                Aqf.step('''Execute delays via CAM interface and calculate the amount of time
-                    it takes to load the delays''')
-                reply, _informs = self.corr_fix.katcp_rct.req.delays(t_apply, *delay_coefficients)
-                assert reply.reply_ok()
+                Aqf.progress('Time delays will be applied: %s on input %s, to %s on input %s' % (
+                    load_times[0], source_names[0], load_times[-1], source_names[-1]))
+                Aqf.progress('Delay applied to each input: %s, for %s accumulations' % (
+                    test_delay, schedule.dumps_per_step))
+                Aqf.step('Execute delays via CAM interface, delaying the next input every %s '
+                         'accumulations, and capture all accumulations.' % (
+                            schedule.dumps_per_step))
+                delay_steps = schedule.run(steps, t_apply, delay_step_phases)
             except Queue.Empty:
                 errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
                 Aqf.failed(errmsg)
                 LOGGER.exception(errmsg)
                 return
-            except AssertionError:
-                errmsg = '%s'%str(reply).replace('\_',' ')
-                Aqf.failed(errmsg)
-                LOGGER.error(errmsg)
+            except DelayLoadError as e:
+                Aqf.failed(str(e))
+                LOGGER.exception(str(e))
                 return
             else:
-                Aqf.is_true(reply.reply_ok(), '[CBF-REQ-0066, 0072] Reply: {}'.format(str(reply)))
-                Aqf.passed('[CBF-REQ-0066, 0072]: Delays were applied on input: {} via CAM int'.format(
-                    delayed_input))
-            try:
-                _num_discards = num_int + 5
-                Aqf.step('Getting SPEAD accumulation(while discarding %s dumps) containing '
-                         'the change in delay(s) on input: %s.'%(
-                            _num_discards, test_source_idx))
-                dump = self.receiver.get_clean_dump(discard=_num_discards)
-            except Exception:
-                errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
-                Aqf.failed(errmsg)
-                LOGGER.exception(errmsg)
-            else:
-                sorted_bls = get_baselines_lookup(self, this_freq_dump, sorted_lookup=True)
-                degree = 1.0
-                Aqf.step('Maximum expected delay: %s' %np.max(expected_phases))
-                for b_line in sorted_bls:
-                    b_line_val = b_line[1]
-                    b_line_dump = (dump['xeng_raw'][:, b_line_val, :])
-                    b_line_phase = np.angle(complexise(b_line_dump))
-                    # np.deg2rad(1) = 0.017 ie error should be withing 2 decimals
-                    b_line_phase_max = round(np.max(b_line_phase), 2)
-                    if ((delayed_input in b_line[0]) and
-                                b_line[0] != (delayed_input, delayed_input)):
-                        msg = ('[CBF-REQ-0128] Confirm that baseline(s) {} '
-                               'expected delay is within 1 degree.'.format(b_line[0]))
-                        Aqf.array_abs_error(np.abs(b_line_phase[1:-1]),
-                                            np.abs(expected_phases[1:-1]), msg, degree)
-                    else:
-                        # TODO Readdress this failure and calculate
-                        if b_line_phase_max != 0.0:
-                            desc = ('Checking baseline {}, index: {:02d}, '
-                                    'phase offset found, maximum error value = {:0.8f} rads'.format(
-                                           b_line[0], b_line_val, b_line_phase_max))
-                            Aqf.failed(desc)
+                Aqf.passed('[CBF-REQ-0066, 0072]: Delays were applied on each of the {} inputs '
+                           'via CAM int'.format(num_inputs))
+
+            degree = 1.0
+            Aqf.step('Maximum expected delay: %s' %np.max(expected_phases))
+            for delayed_input, delay_step in zip(source_names, delay_steps):
+                if delay_step.settled is None:
+                    Aqf.failed('No SPEAD accumulation received while input {} was '
+                               'delayed.'.format(delayed_input))
+                    continue
+                # From the last accumulation of the step, entirely after the load time
+                delayed_bls, offset_bls = delay_step.settled
+                for b_line_name, b_line_phase in delayed_bls:
+                    msg = ('[CBF-REQ-0128] Confirm that baseline(s) {} '
+                           'expected delay is within 1 degree.'.format(b_line_name))
+                    Aqf.array_abs_error(np.abs(b_line_phase[1:-1]),
+                                        np.abs(expected_phases[1:-1]), msg, degree)
+                for b_line_name, b_line_val, b_line_phase_max in offset_bls:
+                    # TODO Readdress this failure and calculate
+                    desc = ('Checking baseline {}, index: {:02d}, '
+                            'phase offset found, maximum error value = {:0.8f} rads'.format(
+                                   b_line_name, b_line_val, b_line_phase_max))
+                    Aqf.failed(desc)
 
 
     def _test_data_product(self, instrument, no_channels):
@@ -5826,11 +5729,7 @@ class test_CBF(unittest.TestCase):
                     return False
                 try:
                     nc = 10000
-                    cap = [0] * nc
-                    for i in range(0, nc):
-                        cap[i] = np.array(complexise(bf_raw[:, i, :]))
-                    cap_mag = np.abs(cap)
-                    cap_avg = cap_mag.sum(axis=0) / nc
+                    cap_avg = unpack_beam_capture(bf_raw[:, :nc]).mean_magnitude
                     # Confirm that the beam channel bandwidth corresponds to the channel bandwidth
                     # determined from the baseline capture
                     # baseline_ch_bw = bw * dsim_clk_factor / response.shape[0]
@@ -5937,7 +5836,7 @@ class test_CBF(unittest.TestCase):
         source = random.randrange(len(self.correlator.fops.fengines))
 
         try:
-            initial_dump = self.receiver.get_clean_dump(discard=3)
+            initial_dump = self.receiver.get_clean_dump(discard=dumps_until_effective(self))
         except Queue.Empty:
             errmsg = 'Could not retrieve clean SPEAD accumulation, as Queue is Empty.'
             Aqf.failed(errmsg)
@@ -5956,7 +5855,7 @@ class test_CBF(unittest.TestCase):
             rand_ch = random.randrange(n_chans)
             gain_vector = [gain] * n_chans
             base_gain = gain
-            initial_resp = np.abs(complexise(initial_dump['xeng_raw'][:, auto_corr_idx, :]))
+            initial_resp = magnetise(initial_dump['xeng_raw'][:, auto_corr_idx, :])
             initial_resp = 10 * np.log10(initial_resp)
             chan_resp = []
             legends = []
@@ -5965,6 +5864,10 @@ class test_CBF(unittest.TestCase):
             count = 0
             Aqf.step('Note: Gains are relative to reference channels, and are increased '
                      'interatively until output power is increased by more than 6dB.')
+            epochs = EpochTracker(self.receiver, _parameters['int_time'],
+                                  dump_timeout=DUMP_TIMEOUT)
+            epochs.start()
+            self.addCleanup(epochs.stop)
             while not found:
                 if not fnd_less_one:
                     target = 1
@@ -5986,14 +5889,15 @@ class test_CBF(unittest.TestCase):
                     msg = ('[CBF-REQ-0119] Gain correction on input {}, channel {} set to {}.'.format(
                         test_input, rand_ch, complex(gain)))
                     Aqf.passed(msg)
+                    epochs.mark(gain)
                     try:
-                        dump = self.receiver.get_clean_dump(discard=10)
+                        dump = epochs.first_dump(gain)
                     except Queue.Empty:
                         errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
                         Aqf.failed(errmsg)
                         LOGGER.exception(errmsg)
                     else:
-                        response = np.abs(complexise(dump['xeng_raw'][:, auto_corr_idx, :]))
+                        response = magnetise(dump['xeng_raw'][:, auto_corr_idx, :])
                         response = 10 * np.log10(response)
                         resp_diff = response[rand_ch] - initial_resp[rand_ch]
                         if resp_diff < target:
@@ -6019,6 +5923,7 @@ class test_CBF(unittest.TestCase):
                     Aqf.failed('Gains to change output power by less than 1 and more than 6 dB '
                                'could not be found.')
                     found = True
+            epochs.stop()
 
             if chan_resp != []:
                 zipped_data = zip(chan_resp, legends)
@@ -6090,10 +5995,10 @@ class test_CBF(unittest.TestCase):
         Aqf.progress('Bandwidth = {}Hz'.format(bw))
         Aqf.progress('Number of channels = {}'.format(nr_ch))
         Aqf.progress('Channel spacing = {}Hz'.format(ch_freq))
-        docker_status = start_katsdpingest_docker(self, beam_ip, beam_port,
-                                                  parts_to_process, nr_ch,
-                                                  ticks_between_spectra,
-                                                  ch_per_heap, spectra_per_heap)
+        docker_status = beam_capture_session(self).start_ingest(self, beam_ip, beam_port,
+                                                                parts_to_process, nr_ch,
+                                                                ticks_between_spectra,
+                                                                ch_per_heap, spectra_per_heap)
         if docker_status:
             Aqf.progress('KAT SDP Ingest Node started')
         else:
@@ -6110,6 +6015,7 @@ class test_CBF(unittest.TestCase):
             #reply, informs = self.corr_fix.katcp_rct.req.capture_stop('c856M4k')
             #assert reply.reply_ok()
             reply, informs = self.corr_fix.katcp_rct.req.input_labels(*local_src_names)
+            self.corr_fix.invalidate_parameters()
             assert reply.reply_ok()
             labels = reply.arguments[1:]
         except AssertionError as e:
@@ -6170,9 +6076,9 @@ class test_CBF(unittest.TestCase):
                     return False
                 retries += 1
                 try:
-                    bf_raw, bf_flags, bf_ts, in_wgts, pb, cf = capture_beam_data(self, beam,
-                        beam_dict, target_pb, target_cf)
-
+                    capture, bf_flags, bf_ts, in_wgts, pb, cf = capture_beam_data(self, beam,
+                        beam_dict, target_pb, target_cf, lazy=True)
+                    self.addCleanup(capture.close)
                 except Exception as e:
                     Aqf.step('Confirm that Docker container is running and also confirm the '
                         'igmp version = 2')
@@ -6181,6 +6087,7 @@ class test_CBF(unittest.TestCase):
                     LOGGER.error(errmsg)
                     return False
 
+                bf_raw = capture.bf_raw
                 data_type = bf_raw.dtype.name
                 #for heaps in bf_flags:
                 # Cut selected partitions out of bf_flags
@@ -6202,6 +6109,7 @@ class test_CBF(unittest.TestCase):
                     # Good capture, break out of loop
                     if not missed_err:
                         break
+                capture.close()
 
             # Print missed heaps
             idx = part_strt_idx
@@ -6213,41 +6121,24 @@ class test_CBF(unittest.TestCase):
                         missed_heaps))
                 idx += 1
             # Combine all missed heap flags. These heaps will be discarded
-            flags = np.sum(flags,axis=0)
-            #cap = [0] * num_caps
-            #cap = [0] * len(bf_raw.shape[1])
-            cap = []
-            cap_idx = 0
-            raw_idx = 0
             try:
-                for heap_flag in flags:
-                    if heap_flag == 0:
-                        for raw_idx in range(raw_idx, raw_idx+spectra_per_heap):
-                            cap.append(np.array(complexise(bf_raw[bf_raw_str:bf_raw_end, raw_idx, :])))
-                            cap_idx += 1
-                        raw_idx += 1
-                    else:
-                        if raw_idx == 0:
-                            raw_idx = spectra_per_heap
-                        else:
-                            raw_idx = raw_idx + spectra_per_heap
+                valid = beam_heap_mask(bf_raw.shape[1], spectra_per_heap, flags)
+                beam_stats = unpack_beam_capture(bf_raw, valid,
+                                                 channels=slice(bf_raw_str, bf_raw_end),
+                                                 chunk_size=16 * spectra_per_heap)
+                capture.close()
+                cap_idx = beam_stats.n_spectra
+                assert cap_idx, 'No valid heaps in beam capture'
             except Exception, e:
                 errmsg = 'Failed to capture beam data due to error: %s' % str(e)
                 LOGGER.exception(errmsg)
                 Aqf.failed(errmsg)
-            Aqf.step('Confirm the data type of the beamforming data for one channel.')
-            try:
-                msg = ('[CBF-REQ-0118] Beamformer data type is {}, example value for one channel: {}'.format(
-                    data_type, cap[0][0]))
-            except Exception as e:
-                errmsg = "Failed with exception: %s" %str(e)
-                Aqf.failed(errmsg)
-                LOGGER.exception(errmsg)
                 return False
-
+            Aqf.step('Confirm the data type of the beamforming data for one channel.')
+            msg = ('[CBF-REQ-0118] Beamformer data type is {}, example value for one channel: {}'.format(
+                data_type, beam_stats.first_sample))
             Aqf.equals(data_type, 'int8', msg)
-            cap_mag = np.abs(cap)
-            cap_avg = cap_mag.sum(axis=0) / cap_idx
+            cap_avg = beam_stats.mean_magnitude
             cap_db = 20 * np.log10(cap_avg)
             cap_db_mean = np.mean(cap_db)
             # NOT WORKING
@@ -6403,8 +6294,8 @@ class test_CBF(unittest.TestCase):
                               caption='Captured beamformer data with level adjust after beam-forming gain set.',
                               hlines=exp1, plot_type='bf', hline_strt_idx=1)
 
-        # Close any KAT SDP ingest nodes
-        stop_katsdpingest_docker(self)
+        # The KAT SDP ingest node is left running for later captures, it is stopped at the
+        # end of the test run
 
 
     def _test_cap_beam(self, instrument='bc8n856M4k'):
@@ -6434,6 +6325,7 @@ class test_CBF(unittest.TestCase):
             reply, informs = self.corr_fix.katcp_rct.req.capture_stop('beam_0y')
             reply, informs = self.corr_fix.katcp_rct.req.capture_stop('c856M4k')
             reply, informs = self.corr_fix.katcp_rct.req.input_labels(*local_src_names)
+            self.corr_fix.invalidate_parameters()
             dsim_clk_factor = 1.712e9 / self.corr_freqs.sample_freq
             Aqf.hop('Dsim_clock_Factor = {}'.format(dsim_clk_factor))
             bw = self.corr_freqs.bandwidth  # * dsim_clk_factor
@@ -6517,6 +6409,7 @@ class test_CBF(unittest.TestCase):
         reply, informs = self.corr_fix.katcp_rct.req.capture_stop('beam_0y')
         reply, informs = self.corr_fix.katcp_rct.req.capture_stop('c856M4k')
         reply, informs = self.corr_fix.katcp_rct.req.input_labels(*local_src_names)
+        self.corr_fix.invalidate_parameters()
         bw = self.corr_freqs.bandwidth
         ch_list = self.corr_freqs.chan_freqs
         nr_ch = self.corr_freqs.n_chans
@@ -6615,6 +6508,7 @@ class test_CBF(unittest.TestCase):
             reply, informs = self.corr_fix.katcp_rct.req.capture_stop('beam_0y')
             reply, informs = self.corr_fix.katcp_rct.req.capture_stop('c856M4k')
             reply, informs = self.corr_fix.katcp_rct.req.input_labels(*local_src_names)
+            self.corr_fix.invalidate_parameters()
             if reply.reply_ok():
                 labels = reply.arguments[1:]
             else:
@@ -6669,7 +6563,7 @@ class test_CBF(unittest.TestCase):
             reply, informs = self.corr_fix.katcp_rct.req.quantiser_snapshot(inp)
         except Exception:
             Aqf.failed('Failed to grab quantiser snapshot.')
-        quant_snap = [eval(v) for v in (reply.arguments[1:][1:])]
+        quant_snap = decode_snapshot(reply.arguments[2:])
         try:
             reply, informs = self.corr_fix.katcp_rct.req.adc_snapshot(inp)
         except Exception:
@@ -6713,30 +6607,30 @@ class test_CBF(unittest.TestCase):
         weight = 1.0
         beam_dict = populate_beam_dict(self, 1, weight, beam_dict)
         try:
-            bf_raw, cap_ts, bf_ts, in_wgts, pb, cf = capture_beam_data(self, beam, beam_dict,
-                target_pb, target_cfreq, capture_time=0.3)
+            capture, bf_flags, bf_ts, in_wgts, pb, cf = capture_beam_data(self, beam, beam_dict,
+                target_pb, target_cfreq, capture_time=0.3, lazy=True)
         except TypeError, e:
             errmsg = 'Failed to capture beam data: %s' % str(e)
             Aqf.failed(errmsg)
             LOGGER.info(errmsg)
             return
         Aqf.hop('Packaging beamformer data.')
-        num_caps = np.shape(bf_raw)[1]
-        cap = [0] * num_caps
-        cap_idx = 0
-        for i in range(0, num_caps):
-            if cap_ts[cap_idx] == bf_ts[i]:
-                cap[cap_idx] = complexise(bf_raw[:, i, :])
-                cap_idx += 1
-        del bf_raw
-        cap = np.asarray(cap[:cap_idx])
+        spectra_per_heap = getattr(self.corr_fix.katcp_rct.sensors,
+                                   '{}_spectra_per_heap'.format(beam)).get_value()
         # Output of beamformer is a voltage, get the power
-        cap = np.power(np.abs(cap), 2)
-        nr_ch = len(cap)
+        with capture:
+            valid = beam_heap_mask(capture.bf_raw.shape[1], spectra_per_heap, bf_flags)
+            beam_stats = unpack_beam_capture(capture.bf_raw, valid,
+                                             chunk_size=16 * spectra_per_heap)
+        cap_idx = beam_stats.n_spectra
+        if cap_idx < 2:
+            Aqf.failed('Not enough valid beam spectra captured ({}).'.format(cap_idx))
+            return
+        nr_ch = len(beam_stats.mean_power)
         Aqf.step('Calculating time series mean.')
-        ch_mean = cap.mean(axis=0)
+        ch_mean = beam_stats.mean_power
         Aqf.step('Calculating time series standard deviation')
-        ch_std = cap.std(axis=0, ddof=1)
+        ch_std = beam_stats.std_power
         ch_bw = self.corr_freqs.delta_f
         acc_time = self.corr_freqs.fft_period
         sqrt_bw_at = np.sqrt(ch_bw * acc_time)
@@ -6819,17 +6713,18 @@ class test_CBF(unittest.TestCase):
         self.dhost.outputs.out_1.scale_output(0)
         dump = self.receiver.get_clean_dump()
         baseline_lookup = get_baselines_lookup(self, dump)
-        sync_time = parameters(self)['synch_epoch']
-        scale_factor_timestamp = parameters(self)['scale_factor_timestamp']
-        inp = parameters(self)['input_labels'][0][0]
+        _parameters = parameters(self)
+        sync_time = _parameters['synch_epoch']
+        scale_factor_timestamp = _parameters['scale_factor_timestamp']
+        inp = _parameters['input_labels'][0][0]
         inp_autocorr_idx = baseline_lookup[(inp, inp)]
         # FFT input sliding window size = 8 spectra
         fft_sliding_window = dump['n_chans'].value * 2 * 8
         # Get number of ticks per dump and ensure it is divisible by 8 (FPGA
         # clock runs 8 times slower)
-        dump_ticks = parameters(self)['int_time'] * parameters(self)['adc_sample_rate']
+        dump_ticks = _parameters['int_time'] * _parameters['adc_sample_rate']
         # print dump_ticks
-        dump_ticks = parameters(self)['n_accs'] * parameters(self)['n_chans'] * 2
+        dump_ticks = _parameters['n_accs'] * _parameters['n_chans'] * 2
         # print dump_ticks
         # print ['adc_sample_rate'].value
         # print dump['timestamp']
@@ -6865,24 +6760,26 @@ class test_CBF(unittest.TestCase):
                                                       dump_abs_t.second,
                                                       dump_abs_t.microsecond)
             load_timestamp = dump_ts + future_ticks
-            load_dsim_impulse(load_timestamp, offset)
             dump_list = []
             cnt = 0
-            for i in range(future_dump):
-                cnt += 1
-                dump = self.receiver.data_queue.get()
-                print dump['timestamp']
-                dval = dump['xeng_raw']
-                auto_corr = dval[:, inp_autocorr_idx, :]
-                curr_ts = dump['timestamp']
-                delta_ts = curr_ts - dump_ts
-                dump_ts = curr_ts
-                if delta_ts != dump_ticks:
-                    Aqf.failed('Accumulation dropped, Expected timestamp = {}, '
-                        'received timestamp = {}'.format(dump_ts + dump_ticks, curr_ts))
-                print 'Maximum value found in dump {} = {}, average = {}'.format(cnt,
-                    np.max(auto_corr), np.average(auto_corr))
-                dump_list.append(dval)
+            with DumpRingBuffer(self.receiver, timestamp_key='timestamp') as dump_buffer:
+                load_dsim_impulse(load_timestamp, offset)
+                for i in range(future_dump):
+                    cnt += 1
+                    try:
+                        dump = dump_buffer.await_dump(dump_ts + dump_ticks,
+                                                      tolerance=dump_ticks / 2)
+                    except DumpMissedError:
+                        Aqf.failed('Accumulation dropped, Expected timestamp = {}'.format(
+                            dump_ts + dump_ticks))
+                        dump = dump_buffer.await_next_dump(dump_ts)
+                    print dump['timestamp']
+                    dval = dump['xeng_raw']
+                    auto_corr = dval[:, inp_autocorr_idx, :]
+                    dump_ts = dump['timestamp']
+                    print 'Maximum value found in dump {} = {}, average = {}'.format(cnt,
+                        np.max(auto_corr), np.average(auto_corr))
+                    dump_list.append(dval)
             # Find dump containing impulse, check that other dumps are empty.
             val_found = 0
             auto_corr = []
@@ -7161,7 +7058,7 @@ class test_CBF(unittest.TestCase):
             try:
                 reply,informs = self.corr_fix.katcp_rct.req.adc_snapshot(source)
                 assert reply.reply_ok()
-                adc_data = eval(informs[0].arguments[1])
+                adc_data = decode_snapshot(informs[0].arguments[1])
                 assert len(adc_data)==8192
                 return adc_data
             except AssertionError as e:
@@ -7179,7 +7076,7 @@ class test_CBF(unittest.TestCase):
             try:
                 reply,informs = self.corr_fix.katcp_rct.req.quantiser_snapshot(source)
                 assert reply.reply_ok()
-                quant_data = eval(informs[0].arguments[1])
+                quant_data = decode_snapshot(informs[0].arguments[1])
                 assert len(quant_data)==4096
                 return quant_data
             except AssertionError as e:
@@ -7272,7 +7169,7 @@ class test_CBF(unittest.TestCase):
 
             # reply, informs = self.corr_fix.katcp_rct. \
             #    req.quantiser_snapshot(inp)
-            # data = [eval(v) for v in (reply.arguments[2:])]
+            # data = decode_snapshot(reply.arguments[2:])
             # nr_ch = len(data)
             # ch_bw = bw / nr_ch
             # ch_list = np.linspace(0, bw, nr_ch, endpoint=False)
@@ -7539,11 +7436,15 @@ class test_CBF(unittest.TestCase):
                 Aqf.failed('{} saturated samples found'.format(ret_dict[key]['num_sat']))
         return ret_dict
 
-    def _corr_efficiency(self, n_accs=8000):
+    def _corr_efficiency(self, n_accs=8000, save_time_series=False):
         """
 
         Parameters
         ----------
+        n_accs : int
+            Number of accumulations to gather statistics over
+        save_time_series : bool
+            Also save the channel time series of the input autocorrelation to a .npy file
 
         Returns
         -------
@@ -7581,7 +7482,7 @@ class test_CBF(unittest.TestCase):
             reply, informs = self.corr_fix.katcp_rct.req.quantiser_snapshot(inp)
         except Exception:
             Aqf.failed('Failed to grab quantiser snapshot.')
-        quant_snap = [eval(v) for v in (reply.arguments[1:][1:])]
+        quant_snap = decode_snapshot(reply.arguments[2:])
         try:
             reply, informs = self.corr_fix.katcp_rct.req.adc_snapshot(inp)
         except Exception:
@@ -7616,59 +7517,52 @@ class test_CBF(unittest.TestCase):
                                                                                        fft_shift)),
                            bins=64, ranges=(0, 1.5))
 
-        csvfile = 'ch_time_series_{}.csv'.format(self._testMethodName)
-        with open(csvfile, 'wb') as file:
-            writer = csv.writer(file)
-            Aqf.step('Getting initial Spead Heap')
+        spill_file = None
+        if save_time_series:
+            # n_accs x n_chans float64 samples, only written when asked for
+            spill_file = '{}/{}_ch_time_series.npy'.format(self.logs_path, self._testMethodName)
+        ch_stats = RunningStats(spill_file=spill_file, max_samples=n_accs)
+        Aqf.step('Getting initial Spead Heap')
+        try:
+            dump = self.receiver.get_clean_dump()
+        except Queue.Empty:
+            errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
+            Aqf.failed(errmsg)
+            LOGGER.exception(errmsg)
+            return False
+        baseline_lookup = get_baselines_lookup(self, dump)
+        inp_autocorr_idx = baseline_lookup[(inp, inp)]
+        acc_time = parameters(self)['int_time']
+        ch_bw = self.corr_freqs.delta_f
+        dval = dump['xeng_raw']
+        ch_stats.update(dval[:, inp_autocorr_idx, 0])
+        for i in range(n_accs - 1):
+            if i < print_counts:
+                Aqf.hop('Getting Spead Heap #{}'.format(i + 1))
+            elif i == print_counts:
+                Aqf.hop('.' * print_counts)
+            elif i > (n_accs - print_counts):
+                Aqf.hop('Getting Spead Heap #{}'.format(i + 1))
+            else:
+                LOGGER.info('Getting Spead Heap #{}'.format(i + 1))
             try:
-                dump = self.receiver.get_clean_dump()
+                dump = self.receiver.data_queue.get()
             except Queue.Empty:
                 errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
                 Aqf.failed(errmsg)
                 LOGGER.exception(errmsg)
             else:
-                baseline_lookup = get_baselines_lookup(self, dump)
-                inp_autocorr_idx = baseline_lookup[(inp, inp)]
-                acc_time = parameters(self)['int_time']
-                ch_bw = self.corr_freqs.delta_f
                 dval = dump['xeng_raw']
-                auto_corr = dval[:, inp_autocorr_idx, :][:, 0]
-                writer.writerow(auto_corr)
-                # ch_time_series = auto_corr
-                for i in range(n_accs - 1):
-                    if i < print_counts:
-                        Aqf.hop('Getting Spead Heap #{}'.format(i + 1))
-                    elif i == print_counts:
-                        Aqf.hop('.' * print_counts)
-                    elif i > (n_accs - print_counts):
-                        Aqf.hop('Getting Spead Heap #{}'.format(i + 1))
-                    else:
-                        LOGGER.info('Getting Spead Heap #{}'.format(i + 1))
-                    try:
-                        dump = self.receiver.data_queue.get()
-                    except Queue.Empty:
-                        errmsg = 'Could not retrieve clean SPEAD accumulation: Queue is Empty.'
-                        Aqf.failed(errmsg)
-                        LOGGER.exception(errmsg)
-                    else:
-                        dval = dump['xeng_raw']
-                        auto_corr = dval[:, inp_autocorr_idx, :][:, 0]
-                        writer.writerow(auto_corr)
-                        # ch_time_series = np.vstack((ch_time_series, auto_corr))
-
-        Aqf.hop('Reading data from file.')
-        file = open(csvfile, 'rb')
-        read = csv.reader(file)
-        ch_time_series = []
-        for row in read:
-            ch_time_series.append([int(y) for y in row])
-            time.sleep(1)
-        file.close()
-        ch_time_series = np.asarray(ch_time_series)
+                ch_stats.update(dval[:, inp_autocorr_idx, 0])
+        if spill_file is not None:
+            ch_stats.flush()
+            LOGGER.info('Channel time series ({} samples) saved to {}'.format(ch_stats.count,
+                                                                              spill_file))
+
         Aqf.step('Calculating time series mean.')
-        ch_mean = ch_time_series.mean(axis=0)
+        ch_mean = ch_stats.mean
         Aqf.step('Calculating time series standard deviation')
-        ch_std = ch_time_series.std(axis=0, ddof=1)
+        ch_std = ch_stats.std(ddof=1)
         sqrt_bw_at = np.sqrt(ch_bw * acc_time)
 
         Aqf.step('Calculating channel efficiency.')
@@ -3,20 +3,24 @@ import contextlib
 import glob
 import h5py
 import io
+import katcp
 import logging
 import numpy as np
 import operator
 import os
 import pwd
-# import Queue
+import Queue
 import random
+import re
 import signal
-# import threading
+import threading
 import time
 import warnings
 import subprocess
 
 from collections import Mapping
+from collections import namedtuple
+from collections import deque
 from concurrent.futures import TimeoutError
 from Crypto.Cipher import AES
 from getpass import getuser as getusername
@@ -37,6 +41,7 @@ except ImportError:
 from casperfpga.utils import threaded_fpga_function
 from casperfpga.utils import threaded_fpga_operation
 from corr2.data_stream import StreamAddress
+from mkat_fpga_tests import add_cleanup
 
 
 # LOGGER = logging.getLogger(__name__)
@@ -49,10 +54,48 @@ cam_timeout = 60
 
 
 def complexise(input_data):
-    """Convert input data shape (X,2) to complex shape (X)
-    :param input_data: Xeng_Raw
+    """Convert input data shape (..., 2) to complex shape (...)
+
+    Float pairs that are contiguous in memory are reinterpreted as complex without a copy,
+    other data (e.g. int32 Xeng_Raw) is converted into a single complex128 allocation.
+    :param input_data: Xeng_Raw, one baseline (X,2) or many (X,N,2)
     """
-    return input_data[:, 0] + input_data[:, 1] * 1j
+    input_data = np.asarray(input_data)
+    if input_data.dtype in (np.float32, np.float64) and input_data.flags.c_contiguous:
+        return input_data.view(np.result_type(input_data.dtype, np.complex64))[..., 0]
+    complex_data = np.empty(input_data.shape[:-1], dtype=np.complex128)
+    complex_data.real = input_data[..., 0]
+    complex_data.imag = input_data[..., 1]
+    return complex_data
+
+
+def xeng_magnitude(input_data, out=None, dtype=np.float32):
+    """Magnitude of (real, imag) pairs, without a complex intermediate
+
+    Usage:
+
+    # All baselines of a dump at once, reusing one buffer between dumps
+    magnitudes = xeng_magnitude(dump['xeng_raw'], out=magnitudes)
+
+    :param input_data: Xeng_Raw, one baseline (X,2) or many (X,N,2)
+    :param out: array of shape (...) to write into, allocated if None
+    :param dtype: result dtype if out is None
+    """
+    input_data = np.asarray(input_data)
+    return np.hypot(input_data[..., 0], input_data[..., 1], out=out,
+                    dtype=dtype if out is None else out.dtype)
+
+
+def xeng_phase(input_data, out=None, dtype=np.float32):
+    """Phase [rad] of (real, imag) pairs, without a complex intermediate
+
+    :param input_data: Xeng_Raw, one baseline (X,2) or many (X,N,2)
+    :param out: array of shape (...) to write into, allocated if None
+    :param dtype: result dtype if out is None
+    """
+    input_data = np.asarray(input_data)
+    return np.arctan2(input_data[..., 1], input_data[..., 0], out=out,
+                      dtype=dtype if out is None else out.dtype)
 
 
 def magnetise(input_data):
@@ -60,9 +103,7 @@ def magnetise(input_data):
        Calculate the absolute value element-wise.
        :param input_data: Xeng_Raw
     """
-    id_c = complexise(input_data)
-    id_m = np.abs(id_c)
-    return id_m
+    return xeng_magnitude(input_data, dtype=np.float64)
 
 
 def normalise(input_data):
@@ -70,7 +111,9 @@ def normalise(input_data):
 
 
 def normalised_magnitude(input_data):
-    return normalise(magnetise(input_data))
+    magnitudes = magnetise(input_data)
+    magnitudes /= VACC_FULL_RANGE
+    return magnitudes
 
 
 def loggerise(data, dynamic_range=70, normalise=False, normalise_to=None):
@@ -100,22 +143,102 @@ def baseline_checker(xeng_raw, check_fn):
     return baselines
 
 
+BaselineClasses = namedtuple('BaselineClasses', 'zero nonzero all_nonzero')
+
+
+def _channel_nonzero_mask(xeng_raw):
+    """Return a (n_chans, n_bls) boolean mask of channels with non-zero visibilities"""
+    xeng_raw = np.asarray(xeng_raw)
+    if (xeng_raw.ndim == 3 and xeng_raw.shape[-1] == 2 and xeng_raw.dtype == np.int32 and
+            xeng_raw.flags.c_contiguous):
+        # Reinterpret each (real, imag) int32 pair as a single int64, which is non-zero iff
+        # either component is non-zero. No temporaries the size of the dump are created.
+        return xeng_raw.view(np.int64)[..., 0] != 0
+    return np.logical_or(xeng_raw[..., 0] != 0, xeng_raw[..., 1] != 0)
+
+
+def classify_baselines(xeng_raw):
+    """Classify all baselines of a dump as zero, non-zero and all-channels non-zero in one pass
+
+    :param xeng_raw: Xeng_Raw, shape (n_chans, n_bls, 2)
+    :rtype: BaselineClasses namedtuple of boolean masks with shape (n_bls,)
+    """
+    chan_nonzero = _channel_nonzero_mask(xeng_raw)
+    nonzero = chan_nonzero.any(axis=0)
+    return BaselineClasses(zero=~nonzero, nonzero=nonzero, all_nonzero=chan_nonzero.all(axis=0))
+
+
 def zero_baselines(xeng_raw):
     """Return baseline indices that have all-zero data"""
-    return baseline_checker(xeng_raw, lambda bldata: np.all(bldata == 0))
+    return set(np.flatnonzero(classify_baselines(xeng_raw).zero).tolist())
 
 
 def nonzero_baselines(xeng_raw):
     """Return baseline indices that have some non-zero data"""
-    return baseline_checker(xeng_raw, lambda bldata: np.any(bldata != 0))
+    return set(np.flatnonzero(classify_baselines(xeng_raw).nonzero).tolist())
 
 
 def all_nonzero_baselines(xeng_raw):
     """Return baseline indices that have all non-zero data"""
-    non_zerobls = lambda bldata: np.all(
-        np.linalg.norm(
-            bldata.astype(np.float64), axis=1) != 0)
-    return baseline_checker(xeng_raw, non_zerobls)
+    return set(np.flatnonzero(classify_baselines(xeng_raw).all_nonzero).tolist())
+
+
+class DumpView(object):
+    """Derived products of one SPEAD accumulation, each computed at most once
+
+    Products are computed for every baseline on first use and kept on the view, so checks of
+    different baselines of the same dump share the work. Only the view references them: make a
+    new view for each dump and drop the old one, and the cached arrays go with it. Cached
+    arrays are shared between callers and must not be modified in place.
+
+    Usage:
+
+    dump_view = DumpView(test_dump)
+    plot_data = dump_view.normalised_magnitude(plot_baseline_inds).T
+    bls_classes = dump_view.baseline_classes
+    total_power = np.sum(dump_view.power(expected_baseline_inds))
+
+    :param dump: SPEAD accumulation with key 'xeng_raw', or Xeng_Raw (n_chans, n_bls, 2)
+    """
+
+    def __init__(self, dump):
+        self.xeng_raw = dump['xeng_raw'] if isinstance(dump, dict) else np.asarray(dump)
+        self._cache = {}
+
+    def _cached(self, name, compute_fn, baselines=None):
+        if name not in self._cache:
+            self._cache[name] = compute_fn()
+        data = self._cache[name]
+        if baselines is None:
+            return data
+        return data[list(baselines)] if data.ndim == 1 else data[:, list(baselines)]
+
+    @property
+    def baseline_classes(self):
+        """:rtype: BaselineClasses of all baselines"""
+        return self._cached('baseline_classes', lambda: classify_baselines(self.xeng_raw))
+
+    def complex(self, baselines=None):
+        """:rtype: complex array (n_chans, n_bls), or (n_chans, len(baselines))"""
+        return self._cached('complex', lambda: complexise(self.xeng_raw), baselines)
+
+    def magnitude(self, baselines=None):
+        """:rtype: float32 array (n_chans, n_bls), or (n_chans, len(baselines))"""
+        return self._cached('magnitude', lambda: xeng_magnitude(self.xeng_raw), baselines)
+
+    def normalised_magnitude(self, baselines=None):
+        """:rtype: float32 array, magnitude as a fraction of the VACC full range"""
+        return normalise(self.magnitude(baselines))
+
+    def phase(self, baselines=None):
+        """:rtype: float32 array (n_chans, n_bls) [rad], or (n_chans, len(baselines))"""
+        return self._cached('phase', lambda: xeng_phase(self.xeng_raw), baselines)
+
+    def power(self, baselines=None):
+        """:rtype: float64 array (n_bls,), sum of normalised magnitudes over all channels"""
+        return self._cached(
+            'power', lambda: self.magnitude().sum(axis=0, dtype=np.float64) / VACC_FULL_RANGE,
+            baselines)
 
 
 def init_dsim_sources(dhost):
@@ -242,6 +365,334 @@ class CorrelatorFrequencyInfo(object):
             LOGGER.error('Failed to calculate frequency points to sweep over a test channel')
 
 
+class RunningStats(object):
+    """Streaming per-element mean and variance (Welford's algorithm)
+
+    Samples are folded in one at a time, so statistics over long time series are
+    available as soon as the last sample arrives without keeping the series in memory.
+    An optional spill file stores every sample as a .npy memmap for later plotting.
+    """
+
+    def __init__(self, spill_file=None, max_samples=None):
+        """Initialise the accumulator
+
+        Parameters
+        ==========
+        spill_file : str
+            Optional .npy file to which every sample is written
+        max_samples : int
+            Number of samples reserved in the spill file, required with `spill_file`
+
+        """
+        if spill_file is not None and not max_samples:
+            raise ValueError('max_samples is required when spilling samples to file')
+        self.spill_file = spill_file
+        self.max_samples = max_samples
+        self.count = 0
+        self._mean = None
+        self._m2 = None
+        self._spill = None
+
+    def update(self, sample):
+        """Fold a single sample (array of any shape) into the statistics"""
+        sample = np.asarray(sample, dtype=np.float64)
+        if self._mean is None:
+            self._mean = np.zeros_like(sample)
+            self._m2 = np.zeros_like(sample)
+            if self.spill_file is not None:
+                self._spill = np.lib.format.open_memmap(
+                    self.spill_file, mode='w+', dtype=np.float64,
+                    shape=(self.max_samples,) + sample.shape)
+        if self._spill is not None and self.count < self.max_samples:
+            self._spill[self.count] = sample
+        self.count += 1
+        delta = sample - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (sample - self._mean)
+
+    @property
+    def mean(self):
+        return self._mean
+
+    def variance(self, ddof=0):
+        if self.count - ddof <= 0:
+            raise ValueError('Not enough samples ({}) for ddof={}'.format(self.count, ddof))
+        return self._m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.variance(ddof))
+
+    def flush(self):
+        """Write the samples spilled so far to the spill file, if any"""
+        if self._spill is not None:
+            self._spill.flush()
+
+    def spilled(self):
+        """Return the samples written to the spill file so far, or None"""
+        if self._spill is None:
+            return None
+        self.flush()
+        return self._spill[:min(self.count, self.max_samples)]
+
+
+class DumpMissedError(Exception):
+    """Raised when the requested accumulation has already been superseded by newer dumps"""
+    pass
+
+
+class DumpRingBuffer(threading.Thread):
+    """
+    Receiver-side ring buffer of SPEAD accumulations keyed by dump timestamp.
+
+    The buffer drains `receiver.data_queue` in a background thread and keeps the last `maxlen`
+    dumps, so tests can block until the accumulation they care about arrives instead of pulling
+    and discarding dumps one at a time. While the buffer is running it owns the receiver queue,
+    use it as a context manager or call stop() before going back to receiver.get_clean_dump().
+
+    Usage:
+
+    with DumpRingBuffer(self.receiver) as dump_buffer:
+        dump = dump_buffer.await_dump(t_apply, tolerance=0.1 * int_time)
+        next_dump = dump_buffer.await_next_dump(dump['dump_timestamp'])
+
+    :param: receiver: corr2.corr_rx.CorrRx
+    :param: maxlen: Int, number of dumps to keep. A 32k channel dump is over 100MB, so callers
+            that need more than the newest few dumps must ask for them
+    :param: timestamp_key: Str, dump key to index on ('dump_timestamp' [s] or 'timestamp' [ticks])
+    :rtype: None
+    """
+
+    def __init__(self, receiver, maxlen=4, timestamp_key='dump_timestamp', poll_timeout=0.5):
+        threading.Thread.__init__(self)
+        self.setName('DumpRingBuffer Thread')
+        self.setDaemon(True)
+        self.receiver = receiver
+        self.timestamp_key = timestamp_key
+        self.poll_timeout = poll_timeout
+        self._dumps = deque(maxlen=maxlen)
+        self._dumps_cond = threading.Condition()
+        self._stop_event = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def stop(self, timeout=5):
+        self._stop_event.set()
+        if self.isAlive():
+            self.join(timeout)
+
+    def stopped(self):
+        return self._stop_event.isSet()
+
+    def run(self):
+        LOGGER.info('Starting %s' % self.name)
+        while not self._stop_event.isSet():
+            try:
+                dump = self.receiver.data_queue.get(timeout=self.poll_timeout)
+            except Queue.Empty:
+                continue
+            if not isinstance(dump, dict) or self.timestamp_key not in dump:
+                LOGGER.error('Ignoring invalid SPEAD accumulation: %s' % type(dump))
+                continue
+            with self._dumps_cond:
+                self._dumps.append(dump)
+                self._dumps_cond.notify_all()
+        LOGGER.info('Stopping %s' % self.name)
+
+    def _wait_for(self, match_fn, timeout):
+        """Block until match_fn returns a dump (or raises) for the buffered dumps"""
+        deadline = time.time() + timeout
+        with self._dumps_cond:
+            while True:
+                dump = match_fn(list(self._dumps))
+                if dump is not None:
+                    return dump
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Queue.Empty('No matching SPEAD accumulation within %ss' % timeout)
+                self._dumps_cond.wait(min(remaining, self.poll_timeout))
+
+    def await_dump(self, timestamp, tolerance=0.5, timeout=60):
+        """
+        Block until the dump with `timestamp` (within `tolerance`) is available
+        :param: timestamp: Float/Int, in units of `timestamp_key`
+        :param: tolerance: Float
+        :param: timeout: Float seconds
+        :rtype: dict: SPEAD accumulation
+        :raises: Queue.Empty on timeout, DumpMissedError if newer dumps arrived but none matched
+        """
+        key = self.timestamp_key
+
+        def match_fn(dumps):
+            for dump in dumps:
+                if np.abs(dump[key] - timestamp) < tolerance:
+                    return dump
+            if dumps and dumps[-1][key] > timestamp + tolerance:
+                raise DumpMissedError('Accumulation with %s %s not in buffer, oldest: %s, '
+                                      'newest: %s' % (key, timestamp, dumps[0][key],
+                                                      dumps[-1][key]))
+
+        return self._wait_for(match_fn, timeout)
+
+    def await_next_dump(self, after=None, timeout=60):
+        """
+        Block until a dump newer than `after` is available
+        :param: after: Float/Int, in units of `timestamp_key`. Defaults to the newest buffered dump
+        :param: timeout: Float seconds
+        :rtype: dict: SPEAD accumulation
+        """
+        key = self.timestamp_key
+        if after is None:
+            with self._dumps_cond:
+                after = self._dumps[-1][key] if self._dumps else -np.inf
+
+        def match_fn(dumps):
+            for dump in dumps:
+                if dump[key] > after:
+                    return dump
+
+        return self._wait_for(match_fn, timeout)
+
+    def await_first_dump(self, start, after=None, timeout=60):
+        """
+        Block until the first dump that started at or after `start` and is newer than `after`
+        is available
+        :param: start: Float/Int, in units of `timestamp_key`
+        :param: after: Float/Int, in units of `timestamp_key`, e.g. the previously used dump
+        :param: timeout: Float seconds
+        :rtype: dict: SPEAD accumulation
+        """
+        key = self.timestamp_key
+        if after is None:
+            after = -np.inf
+
+        def match_fn(dumps):
+            for dump in dumps:
+                if dump[key] >= start and dump[key] > after:
+                    return dump
+
+        return self._wait_for(match_fn, timeout)
+
+    def snapshot(self):
+        """Return the buffered dumps, oldest first"""
+        with self._dumps_cond:
+            return list(self._dumps)
+
+
+class EpochTracker(DumpRingBuffer):
+    """
+    DumpRingBuffer that routes accumulations to the configuration epoch they were captured in.
+
+    Mark each configuration change as soon as the CAM interface has acknowledged it. Every
+    accumulation that started at least `settle` seconds after the mark, and ended before the
+    next one, belongs to that epoch, so tests can take the first valid accumulation after a
+    change instead of discarding a fixed, pessimistic number of dumps.
+
+    Usage:
+
+    with EpochTracker(self.receiver, int_time) as epochs:
+        reply, informs = self.corr_fix.katcp_rct.req.gain_all(0)
+        epochs.mark('zero gains')
+        dump = epochs.first_dump('zero gains')
+
+    :param: receiver: corr2.corr_rx.CorrRx
+    :param: int_time: Float, longest accumulation time while tracking [s]
+    :param: settle: Float, time after a mark before accumulations are valid, e.g. to absorb the
+            offset between this host's clock and dump timestamps [s]
+    :param: dump_timeout: Float, extra time to wait for an accumulation [s]
+    Other parameters as for DumpRingBuffer
+    """
+
+    def __init__(self, receiver, int_time, settle=0., dump_timeout=10, **kwargs):
+        DumpRingBuffer.__init__(self, receiver, **kwargs)
+        self.int_time = int_time
+        self.settle = settle
+        self.dump_timeout = dump_timeout
+        self.epochs = []
+
+    def mark(self, label, timestamp=None):
+        """
+        Start a new epoch
+        :param: label: hashable epoch label
+        :param: timestamp: Float, time the change was acknowledged, defaults to now [s]
+        :rtype: Float: first valid accumulation start time of the epoch
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self.epochs.append((label, timestamp + self.settle))
+        LOGGER.info('Configuration epoch %s starts at %s' % (label, timestamp + self.settle))
+        return timestamp + self.settle
+
+    def _epoch_start(self, label):
+        if label is None:
+            return self.epochs[-1][1]
+        for epoch_label, start in reversed(self.epochs):
+            if epoch_label == label:
+                return start
+        raise KeyError('No configuration epoch %s' % label)
+
+    def epoch_of(self, dump):
+        """
+        :param: dump: SPEAD accumulation
+        :rtype: epoch label, or None if the accumulation straddles a configuration change
+        """
+        timestamp = dump[self.timestamp_key]
+        starts = [start for _label, start in self.epochs]
+        idx = np.searchsorted(starts, timestamp, side='right') - 1
+        if idx < 0 or (idx + 1 < len(starts) and timestamp + self.int_time > starts[idx + 1]):
+            return None
+        return self.epochs[idx][0]
+
+    def first_dump(self, label=None, timeout=None):
+        """
+        Block until the first accumulation of an epoch is available
+        :param: label: epoch label, defaults to the latest epoch
+        :param: timeout: Float seconds, defaults to two accumulations plus dump_timeout
+        :rtype: dict: SPEAD accumulation
+        :raises: Queue.Empty on timeout
+        """
+        start = self._epoch_start(label)
+        key = self.timestamp_key
+        if timeout is None:
+            timeout = 2 * self.int_time + self.dump_timeout
+
+        def match_fn(dumps):
+            for dump in dumps:
+                if dump[key] >= start:
+                    return dump
+
+        return self._wait_for(match_fn, timeout)
+
+    def dump_at(self, timestamp, timeout=None):
+        """
+        Block until the accumulation that was in progress at `timestamp` is available
+        :param: timestamp: Float [s]
+        :param: timeout: Float seconds, defaults to two accumulations plus dump_timeout
+        :rtype: dict: SPEAD accumulation
+        :raises: Queue.Empty on timeout
+        """
+        key = self.timestamp_key
+        if timeout is None:
+            timeout = 2 * self.int_time + self.dump_timeout
+
+        def match_fn(dumps):
+            for dump in dumps:
+                if dump[key] <= timestamp < dump[key] + self.int_time:
+                    return dump
+
+        return self._wait_for(match_fn, timeout)
+
+    def dumps(self, label=None):
+        """Return the buffered accumulations of an epoch (default latest), oldest first"""
+        if label is None:
+            label = self.epochs[-1][0]
+        return [dump for dump in self.snapshot() if self.epoch_of(dump) == label]
+
+
 def get_dsim_source_info(dsim):
     """Return a dict with all the current sine, noise and output settings of a dsim"""
     info = dict(sin_sources={}, noise_sources={}, outputs={})
@@ -407,34 +858,31 @@ def clear_all_delays(self, num_int=25):
             return False
 
 
-def get_fftoverflow_qdrstatus(correlator):
+def get_fhost_status(fhost):
+    status = {'QDR_okay': fhost.ct_okay()}
+    status.update(fhost.registers.pfb_ctrs.read()['data'])
+    return status
+
+
+def get_xhost_status(xhost):
+    return {'QDR_okay': xhost.qdr_okay()}
+
+
+def get_fftoverflow_qdrstatus(correlator, timeout=30):
     """Get dict of all roaches present in the correlator
+    Every host is read once, all hosts concurrently.
     Param: Correlator object
     Return: Dict:
-        Roach, QDR status, PFB counts
-    """
-    fhosts = {}
-    xhosts = {}
-    dicts = {'fhosts': {}, 'xhosts': {}}
-    fengs = correlator.fhosts
-    xengs = correlator.xhosts
-    for fhost in fengs:
-        fhosts[fhost.host] = {}
-        try:
-            fhosts[fhost.host]['QDR_okay'] = fhost.ct_okay()
-        except Exception:
-            return False
-        for pfb, value in fhost.registers.pfb_ctrs.read()['data'].iteritems():
-            fhosts[fhost.host][pfb] = value
-        for xhost in xengs:
-            xhosts[xhost.host] = {}
-            try:
-                xhosts[xhost.host]['QDR_okay'] = xhost.qdr_okay()
-            except Exception:
-                return False
-    dicts['fhosts'] = fhosts
-    dicts['xhosts'] = xhosts
-    return dicts
+        {'fhosts': {host: {'QDR_okay': bool, pfb counter: value, ...}},
+         'xhosts': {host: {'QDR_okay': bool}}}, or False on failure
+    """
+    try:
+        fhosts = threaded_fpga_operation(correlator.fhosts, timeout, (get_fhost_status,))
+        xhosts = threaded_fpga_operation(correlator.xhosts, timeout, (get_xhost_status,))
+    except Exception:
+        LOGGER.exception('Failed to read FFT overflow and QDR status from hosts.')
+        return False
+    return {'fhosts': fhosts, 'xhosts': xhosts}
 
 
 def check_fftoverflow_qdrstatus(correlator, last_pfb_counts, status=False):
@@ -453,12 +901,11 @@ def check_fftoverflow_qdrstatus(correlator, last_pfb_counts, status=False):
     else:
         curr_pfb_counts = False
     if curr_pfb_counts is not False:
-        for (curr_pfb_host, curr_pfb_value), (curr_pfb_host_x, last_pfb_value) in zip(
-                last_pfb_counts.items(), curr_pfb_counts.items()):
-            if curr_pfb_host is curr_pfb_host_x:
-                if curr_pfb_value != last_pfb_value:
-                    if status:
-                        Aqf.failed("PFB FFT overflow on {}".format(curr_pfb_host))
+        for curr_pfb_host, curr_pfb_value in curr_pfb_counts.items():
+            last_pfb_value = last_pfb_counts.get(curr_pfb_host)
+            if last_pfb_value is not None and curr_pfb_value != last_pfb_value:
+                if status:
+                    Aqf.failed("PFB FFT overflow on {}".format(curr_pfb_host))
 
         for hosts_status in fftoverflow_qdrstatus.values():
             for host, _hosts_status in hosts_status.items():
@@ -469,73 +916,113 @@ def check_fftoverflow_qdrstatus(correlator, last_pfb_counts, status=False):
 
         return list(qdr_error_roaches)
 
-def get_hosts_status(self, check_host_okay, list_sensor=None, engine_type=None, ):
-            LOGGER.info('Retrieving %s sensors for %s.' %(list_sensor, engine_type.upper()))
-            for _sensor in list_sensor:
-                try:
-                    _status_hosts = check_host_okay(self, engine=engine_type, sensor=_sensor)
-                    if _status_hosts is not (True or None):
-                        for _status in _status_hosts:
-                            LOGGER.error('Failed :%s\nFile: %s line: %s' %(_status,
-                                 getframeinfo(currentframe()).filename.split('/')[-1],
-                                 getframeinfo(currentframe()).lineno))
-                except Exception as e:
-                    errmsg = 'Failed to verify if host is ok(%s) with error: %s' %(_sensor, str(e))
-                    LOGGER.exception(errmsg)
+class HostHealthSnapshot(object):
+    """
+    All '*-ok' sensor readings from a single sensor-value request via the CAM interface,
+    indexed by sensor name so that any number of engine/sensor checks can be evaluated
+    without further requests.
+    """
+
+    def __init__(self, informs):
+        """
+        :param: List: informs: sensor-value informs
+        """
+        # sensor name: (status, reading)
+        self.sensors = {}
+        for inform in informs:
+            name = inform.arguments[2]
+            if name.endswith('ok') and not name.startswith('antenna'):
+                self.sensors[name.lower()] = (str(inform.arguments[3]),
+                                              ' '.join(inform.arguments[2:]))
+
+    @classmethod
+    def fetch(cls, self):
+        """
+        Request all sensor values via CAM interface.
+        :param: Object: self
+        :rtype: HostHealthSnapshot or None
+        """
+        try:
+            reply, informs = self.corr_fix.katcp_rct.req.sensor_value(timeout=cam_timeout)
+            assert reply.reply_ok()
+        except Exception:
+            LOGGER.exception('Failed to retrieve sensor values via CAM interface.')
+            return None
+        return cls(informs)
+
+    def errors(self, hosts, sensor):
+        """
+        List of errors for sensor on hosts. Sensors are attributed to hosts by name; if no
+        sensor name contains any of the hosts, all sensors matching `sensor` are checked.
+        :param: List: hosts
+        :param: Str: sensor
+        :rtype: List
+        """
+        matching = [name for name in self.sensors if sensor in name]
+        on_hosts = [name for name in matching if any(host in name for host in hosts)]
+        if on_hosts:
+            matching = on_hosts
+        _errors_list = []
+        for name in sorted(matching):
+            status, reading = self.sensors[name]
+            if status != 'nominal':
+                errmsg = '{} Failure/Error: {}'.format(sensor.upper(), reading)
+                LOGGER.error(errmsg)
+                _errors_list.append(errmsg)
+        return _errors_list
+
 
+def get_hosts_status(self, check_host_okay, list_sensor=None, engine_type=None, snapshot=None):
+    """
+    Check list_sensor on all engine_type hosts, logging any failures. All sensors are checked
+    against a single HostHealthSnapshot, fetched here unless one is supplied.
+    """
+    if snapshot is None:
+        snapshot = HostHealthSnapshot.fetch(self)
+    LOGGER.info('Retrieving %s sensors for %s.' %(list_sensor, engine_type.upper()))
+    for _sensor in list_sensor:
+        try:
+            _status_hosts = check_host_okay(self, engine=engine_type, sensor=_sensor,
+                                            snapshot=snapshot)
+            if _status_hosts not in (True, None):
+                for _status in _status_hosts:
+                    LOGGER.error('Failed :%s\nFile: %s line: %s' %(_status,
+                         getframeinfo(currentframe()).filename.split('/')[-1],
+                         getframeinfo(currentframe()).lineno))
+        except Exception as e:
+            errmsg = 'Failed to verify if host is ok(%s) with error: %s' %(_sensor, str(e))
+            LOGGER.exception(errmsg)
 
 
-def check_host_okay(self, engine=None, sensor=None):
+def check_host_okay(self, engine=None, sensor=None, snapshot=None):
     """
     Function retrieves PFB, LRU, QDR, PHY and reorder status on all F/X-Engines via Cam interface.
     :param: Object: self
     :param: Str: F/X-engine
     :param: Str: sensor
+    :param: HostHealthSnapshot: snapshot, fetched if not supplied
     :rtype: Boolean or List
     """
-    try:
-        reply, informs = self.corr_fix.katcp_rct.req.sensor_value(timeout=cam_timeout)
-        assert reply.reply_ok()
-    except Exception:
-        LOGGER.exception('Failed to retrieve sensor values via CAM interface.')
-        return None
-    else:
-        if engine == 'feng':
-            hosts = [_i.host.lower() for _i in self.correlator.fhosts]
-        elif engine == 'xeng':
-            hosts = [_i.host.lower() for _i in self.correlator.xhosts]
-        else:
-            LOGGER.error('Engine cannot be None')
+    if snapshot is None:
+        snapshot = HostHealthSnapshot.fetch(self)
+        if snapshot is None:
             return None
-
-        sensor_status = [[' '.join(i.arguments[2:]) for i in informs
-                         if i.arguments[2].endswith('ok') and not i.arguments[2].startswith('antenna')]
-                         for host in hosts]
-        _errors_list = []
-        for i in sensor_status:
-            try:
-                assert str(i[0].split()[-2]) == 'nominal'
-                return True
-            except AssertionError:
-                if sensor in i[0]:
-                    errmsg = '{} Failure/Error: {}'.format(sensor.upper(), i[0])
-                    LOGGER.error(errmsg)
-                    _errors_list.append(errmsg)
-            except IndexError:
-                LOGGER.fatal('The was an issue reading sensor-values via CAM interface, Investigate:'
-                             'File: %s line: %s' % (
-                                 getframeinfo(currentframe()).filename.split('/')[-1],
-                                 getframeinfo(currentframe()).lineno))
-                return None
-
-        return _errors_list
+    if engine == 'feng':
+        hosts = [_i.host.lower() for _i in self.correlator.fhosts]
+    elif engine == 'xeng':
+        hosts = [_i.host.lower() for _i in self.correlator.xhosts]
+    else:
+        LOGGER.error('Engine cannot be None')
+        return None
+    _errors_list = snapshot.errors(hosts, sensor)
+    return _errors_list or True
 
 
 def get_vacc_offset(xeng_raw):
     """Assuming a tone was only put into input 0,
        figure out if VACC is rooted by 1"""
-    input0 = np.abs(complexise(xeng_raw[:, 0]))
-    input1 = np.abs(complexise(xeng_raw[:, 1]))
+    input0 = magnetise(xeng_raw[:, 0])
+    input1 = magnetise(xeng_raw[:, 1])
     if np.max(input0) > float(0) and np.max(input1) == float(0):
         # We expect autocorr in baseline 0 to be nonzero if the vacc is
         # properly aligned, hence no offset
@@ -608,6 +1095,37 @@ def get_pfb_counts(status_dict):
     return pfb_list
 
 
+def decode_snapshot(payload, dtype=None, encoding=None):
+    """Decode an adc_snapshot/quantiser_snapshot KATCP payload into a typed numpy array
+
+    The CAM interface returns snapshots as a stringified python list, e.g.
+    '[0.1, -0.2, ...]' for ADC data or '[(1+2j), (-3+0j), ...]' for quantiser data. These are
+    parsed with numpy directly instead of eval() of the whole string. A base64 encoded binary
+    payload (encoding='base64') is decoded with np.frombuffer without any text parsing.
+
+    :param payload: Str or list of Str (e.g. reply.arguments[2:])
+    :param dtype: numpy dtype of the result, defaults to float64 (or complex128 for complex data)
+    :param encoding: None/'text' or 'base64'
+    :rtype: numpy array
+    """
+    if isinstance(payload, (list, tuple)):
+        arrays = [decode_snapshot(_payload, dtype=dtype, encoding=encoding) for _payload in payload]
+        return np.concatenate(arrays) if arrays else np.array([], dtype=dtype or np.float64)
+
+    if encoding == 'base64':
+        return np.frombuffer(base64.b64decode(payload), dtype=dtype or np.float64)
+
+    payload = payload.strip().strip('[]')
+    if not payload:
+        return np.array([], dtype=dtype or np.float64)
+    if 'j' in payload:
+        # complex() understands python's own repr, including the surrounding brackets
+        values = payload.split(',')
+        return np.fromiter((complex(value) for value in values), dtype=dtype or np.complex128,
+                           count=len(values))
+    return np.fromstring(payload, dtype=dtype or np.float64, sep=',')
+
+
 def get_adc_snapshot(fpga):
     data = fpga.get_adc_snapshots()
     rv = {'p0': [], 'p1': []}
@@ -912,6 +1430,7 @@ def restore_src_names(self):
     LOGGER.info('Restoring source names to %s' % (', '.join(orig_src_names)))
     try:
         reply, informs = self.corr_fix.katcp_rct.req.input_labels(*orig_src_names)
+        self.corr_fix.invalidate_parameters()
         assert reply.reply_ok()
         self.corr_fix.issue_metadata
         LOGGER.info('Successfully restored source names back to default %s' % (', '.join(
@@ -1137,184 +1656,212 @@ def which_instrument(self, instrument):
         _running_inst = instrument
     return _running_inst
 
-def parameters(self):
+class InstrumentParameters(object):
     """
-    Get all parameters you need to calculate dump time stamp or related.
-    param: self: object
-    param: spead: xeng_raw
-    rtype: dict : int time, scale factor timestamp, sync time, n accs, and etc
+    Cached snapshot of all the instrument parameters needed to calculate dump timestamps etc.
+
+    All sensors are pulled with a single bulk `sensor_value` request (plus one `capture_list`)
+    and cached per instrument and accumulation-length epoch. The cache is invalidated by the
+    correlator fixture on instrument (re)starts and whenever the integration time or input
+    labelling sensors change.
+    :param: corr_fix: CorrelatorFixture
+    :rtype: None
     """
-    LOGGER.info("Getting all parameters needed to calculate dump time stamp and etc via CAM int.")
-    _errmsg = ('Timed out when retrieving capture lists, using default capture as: '
-               'baseline_correlation_products')
-    # Default output product for instrument.
-    output_product_ = 'baseline_correlation_products'
-    with RunTestWithTimeout(cam_timeout, _errmsg):
+    # Sensors that invalidate the cache when they change, {} is replaced with the output product
+    _invalidating_sensors = ('{}_int_time', 'input_labelling')
+
+    def __init__(self, corr_fix):
+        self.corr_fix = corr_fix
+        self._epoch = 0
+        self._cache = {}
+        self._listening = set()
+        self._lock = threading.Lock()
+
+    def invalidate(self, *args, **kwargs):
+        """Drop the cached snapshot, can be used as a katcp sensor listener"""
+        with self._lock:
+            self._epoch += 1
+            self._cache.clear()
+        LOGGER.debug('Instrument parameters cache invalidated (epoch %s)' % self._epoch)
+
+    def get(self, test_obj):
+        """Return a copy of the cached parameters dict, fetching them if required
+        :param: test_obj: object with `corr_fix` and `correlator` attributes
+        :rtype: dict
+        """
+        with self._lock:
+            key = (self.corr_fix.instrument, self._epoch)
+            _parameters = self._cache.get(key)
+        if _parameters is None:
+            _parameters = self._fetch(test_obj)
+            with self._lock:
+                if key[1] == self._epoch:
+                    self._cache[key] = _parameters
+        return dict(_parameters)
+
+    @staticmethod
+    def _sensor_name(name):
+        # Same escaping the katcp resource client uses for sensor attribute names
+        return re.sub('[^0-9a-zA-Z_]', '_', name)
+
+    def _listen(self, sensor_name):
+        """Invalidate cache whenever `sensor_name` changes"""
+        if sensor_name in self._listening:
+            return
         try:
-            reply, informs = self.corr_fix.katcp_rct.req.capture_list(timeout=cam_timeout)
-            assert reply.reply_ok()
-            output_product = [i.arguments[0] for i in informs if
-                self.correlator.configd['xengine']['output_products'] in i.arguments][0]
-            output_product_ = output_product.lower().replace('-', '_')
-            beam0_output_product = [i.arguments[0] for i in informs if
-                self.correlator.configd['beam0']['output_products'] in i.arguments][0]
-            beam1_output_product = [i.arguments[0] for i in informs if
-                self.correlator.configd['beam1']['output_products'] in i.arguments][0]
-        except KeyError:
-            msg = 'Instrument does not contain beamforming capabilities'
-            LOGGER.info(msg)
-            beam0_output_product = beam1_output_product = None
-        except Exception as e:
-            msg = 'Failed to retrieve output products: %s'%str(e)
-            LOGGER.exception(msg)
-
-    katcp_rct = self.corr_fix.katcp_rct.sensor
-    try:
-        int_time = getattr(katcp_rct, '{}_int_time'.format(output_product_)).get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve integration time via CAM int')
-        int_time = None
-
-    try:
-        scale_factor_timestamp = katcp_rct.scale_factor_timestamp.get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve scale_factor_timestamp via CAM int')
-        scale_factor_timestamp = None
-
-    try:
-        synch_epoch = katcp_rct.sync_time.get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve synch_epoch via CAM int')
-        synch_epoch = None
+            katcp_rct = self.corr_fix.katcp_rct
+            katcp_rct.set_sampling_strategy(sensor_name, 'event')
+            getattr(katcp_rct.sensor, sensor_name).register_listener(self._sensor_changed,
+                                                                     reading=True)
+            self._listening.add(sensor_name)
+        except Exception:
+            LOGGER.exception('Failed to register sensor listener on %s' % sensor_name)
+
+    def _sensor_changed(self, sensor, reading):
+        LOGGER.info('Sensor %s changed, invalidating instrument parameters.' % sensor.name)
+        self.invalidate()
+
+    def _fetch(self, test_obj):
+        LOGGER.info("Getting all parameters needed to calculate dump time stamp and etc via CAM int.")
+        katcp_rct = self.corr_fix.katcp_rct
+        configd = test_obj.correlator.configd
+        _errmsg = ('Timed out when retrieving capture lists, using default capture as: '
+                   'baseline_correlation_products')
+        # Default output product for instrument.
+        output_product = output_product_ = 'baseline_correlation_products'
+        beam0_output_product = beam1_output_product = None
+        with RunTestWithTimeout(cam_timeout, _errmsg):
+            try:
+                reply, informs = katcp_rct.req.capture_list(timeout=cam_timeout)
+                assert reply.reply_ok()
+                output_product = [i.arguments[0] for i in informs if
+                    configd['xengine']['output_products'] in i.arguments][0]
+                output_product_ = output_product.lower().replace('-', '_')
+                beam0_output_product = [i.arguments[0] for i in informs if
+                    configd['beam0']['output_products'] in i.arguments][0]
+                beam1_output_product = [i.arguments[0] for i in informs if
+                    configd['beam1']['output_products'] in i.arguments][0]
+            except KeyError:
+                msg = 'Instrument does not contain beamforming capabilities'
+                LOGGER.info(msg)
+            except Exception as e:
+                msg = 'Failed to retrieve output products: %s' % str(e)
+                LOGGER.exception(msg)
 
-    try:
-        reply, informs = self.corr_fix.katcp_rct.req.sensor_value()
-        n_accs = [i.arguments[2::2] for i in informs if 'accs' in i.arguments[2]][0][-1]
-        n_accs = float(n_accs)
-    except Exception:
-        LOGGER.exception('Failed to retrieve n_accs via CAM int')
+        # One bulk request for all sensor values, instead of a request per sensor
+        sensors = {}
         n_accs = None
+        try:
+            reply, informs = katcp_rct.req.sensor_value(timeout=cam_timeout)
+            assert reply.reply_ok()
+            for inform in informs:
+                sensors[self._sensor_name(inform.arguments[2])] = inform.arguments[4]
+            n_accs = float([i.arguments[2::2] for i in informs if 'accs' in i.arguments[2]][0][-1])
+        except Exception:
+            LOGGER.exception('Failed to retrieve sensor values via CAM int')
 
-    try:
-        bandwidth = katcp_rct.bandwidth.get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve bandwidth via CAM int.')
-        bandwidth = None
-
-    try:
-        bls_ordering = eval(getattr(katcp_rct, '{}_bls_ordering'.format(output_product_)).get_value())
-    except Exception:
-        LOGGER.exception('Failed to retrieve bls_ordering via CAM int.')
-        bls_ordering = None
-
-    try:
-        input_labelling = eval(katcp_rct.input_labelling.get_value())
-        input_labels = [x[0] for x in [list(i) for i in input_labelling]]
-    except Exception:
-        LOGGER.exception('Failed to retrieve input labels via CAM int.')
-        reply, informs = self.corr_fix.katcp_rct.req.input_labels()
-        if reply.reply_ok():
-            input_labels = reply.arguments[1:]
-
-    try:
-        clock_rate = getattr(katcp_rct, '{}_clock_rate'.format(output_product_)).get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve clock_rate via CAM int.')
-        clock_rate = None
-
-    try:
-        destination = getattr(katcp_rct, '{}_destination'.format(output_product_)).get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve destination via CAM int.')
-        destination = None
-
-    try:
-        n_bls = getattr(katcp_rct, '{}_n_bls'.format(output_product_)).get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve n_bls via CAM int.')
-        n_bls = None
-
-    try:
-        n_chans = getattr(katcp_rct, '{}_n_chans'.format(output_product_)).get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve n_chans via CAM int.')
-        n_chans = None
-
-    try:
-        xeng_acc_len = getattr(katcp_rct, '{}_xeng_acc_len'.format(output_product_)).get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve xeng_acc_len via CAM int.')
-        xeng_acc_len = None
-
-    try:
-        xeng_out_bits_per_sample = getattr(
-            katcp_rct, '{}_xeng_out_bits_per_sample'.format(output_product_)).get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve xeng_out_bits_per_sample via CAM int.')
-        xeng_out_bits_per_sample = None
+        def sensor_value(name, _type=str):
+            try:
+                return _type(sensors[name])
+            except (KeyError, ValueError):
+                # Fall back to polling the individual sensor
+                try:
+                    return getattr(katcp_rct.sensor, name).get_value()
+                except Exception:
+                    LOGGER.exception('Failed to retrieve %s via CAM int' % name)
+                    return None
+
+        product_sensor = '{}_{{}}'.format(output_product_).format
+        int_time = sensor_value(product_sensor('int_time'), float)
+        scale_factor_timestamp = sensor_value('scale_factor_timestamp', float)
+        synch_epoch = sensor_value('sync_time', float)
+        bandwidth = sensor_value('bandwidth', float)
+        clock_rate = sensor_value(product_sensor('clock_rate'), float)
+        destination = sensor_value(product_sensor('destination'))
+        n_bls = sensor_value(product_sensor('n_bls'), int)
+        n_chans = sensor_value(product_sensor('n_chans'), int)
+        xeng_acc_len = sensor_value(product_sensor('xeng_acc_len'), int)
+        xeng_out_bits_per_sample = sensor_value(product_sensor('xeng_out_bits_per_sample'), int)
+        no_fengines = sensor_value('n_fengs', int)
+        no_xengines = sensor_value('n_xengs', int)
+        adc_sample_rate = sensor_value('adc_sample_rate', float)
 
-    try:
-        no_fengines = katcp_rct.n_fengs.get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve no of fengines via CAM int.')
-        no_fengines = None
+        try:
+            bls_ordering = eval(sensor_value(product_sensor('bls_ordering')))
+        except Exception:
+            LOGGER.exception('Failed to retrieve bls_ordering via CAM int.')
+            bls_ordering = None
 
-    try:
-        no_xengines = katcp_rct.n_xengs.get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve no of xengines via CAM int.')
-        no_xengines = None
+        input_labels = None
+        try:
+            input_labelling = eval(sensor_value('input_labelling'))
+            input_labels = [x[0] for x in [list(i) for i in input_labelling]]
+        except Exception:
+            LOGGER.exception('Failed to retrieve input labels via CAM int.')
+            input_labelling = None
+            reply, informs = katcp_rct.req.input_labels()
+            if reply.reply_ok():
+                input_labels = reply.arguments[1:]
 
-    try:
-        adc_sample_rate = katcp_rct.adc_sample_rate.get_value()
-    except Exception:
-        LOGGER.exception('Failed to retrieve no of xengines via CAM int.')
-        adc_sample_rate = None
+        try:
+            n_ants = int(sensor_value('n_ants', int))
+            custom_src_names = ['inp0{:02d}_{}'.format(x, i) for x in xrange(n_ants) for i in 'xy']
+        except Exception:
+            LOGGER.exception('Failed to retrieve no of antennas via CAM int.')
+            n_ants = None
+            custom_src_names = None
+        try:
+            network_latency = katcp_rct.MAX_LOOP_LATENCY
+        except Exception:
+            LOGGER.exception('Failed to retrieve network latency')
+            network_latency = None
+        try:
+            katcp_host, katcp_port = katcp_rct.address
+        except Exception:
+            LOGGER.exception('Failed not connected to katcp')
+            katcp_host, katcp_port = [0]*2
+
+        for _sensor in self._invalidating_sensors:
+            self._listen(_sensor.format(output_product_))
+
+        return {
+            'adc_sample_rate': adc_sample_rate,
+            'bandwidth': bandwidth,
+            'beam0_output_product': beam0_output_product,
+            'beam1_output_product': beam1_output_product,
+            'bls_ordering': bls_ordering,
+            'clock_rate': clock_rate,
+            'custom_src_names': custom_src_names,
+            'destination': destination,
+            'input_labelling': input_labelling,
+            'input_labels': input_labels,
+            'int_time': int_time,
+            'katcp_host': katcp_host,
+            'katcp_port': katcp_port,
+            'n_accs': n_accs,
+            'n_ants': n_ants,
+            'n_bls': n_bls,
+            'n_chans': n_chans,
+            'network_latency': network_latency,
+            'no_fengines': no_fengines,
+            'no_xengines': no_xengines,
+            'output_product': output_product,
+            'scale_factor_timestamp': scale_factor_timestamp,
+            'synch_epoch': synch_epoch,
+            'xeng_acc_len': xeng_acc_len,
+            'xeng_out_bits_per_sample': xeng_out_bits_per_sample,}
 
-    try:
-        n_ants = int(katcp_rct.n_ants.get_value())
-        custom_src_names = ['inp0{:02d}_{}'.format(x, i) for x in xrange(n_ants) for i in 'xy']
-    except Exception:
-        LOGGER.exception('Failed to retrieve no of xengines via CAM int.')
-        n_ants = None
-        custom_src_names = None
-    try:
-        network_latency = self.corr_fix.katcp_rct.MAX_LOOP_LATENCY
-    except Exception:
-        LOGGER.exception('Failed to retrieve network latency')
-        network_latency = None
-    try:
-        katcp_host, katcp_port = self.corr_fix.katcp_rct.address
-    except Exception:
-        LOGGER.exception('Failed not connected to katcp')
-        katcp_host, katcp_port = [0]*2
 
-    return {
-        'adc_sample_rate': adc_sample_rate,
-        'bandwidth': bandwidth,
-        'beam0_output_product': beam0_output_product,
-        'beam1_output_product': beam1_output_product,
-        'bls_ordering': bls_ordering,
-        'clock_rate': clock_rate,
-        'custom_src_names': custom_src_names,
-        'destination': destination,
-        'input_labelling': input_labelling,
-        'input_labels': input_labels,
-        'int_time': int_time,
-        'katcp_host': katcp_host,
-        'katcp_port': katcp_port,
-        'n_accs': n_accs,
-        'n_ants': n_ants,
-        'n_bls': n_bls,
-        'n_chans': n_chans,
-        'network_latency': network_latency,
-        'no_fengines': no_fengines,
-        'no_xengines': no_xengines,
-        'output_product': output_product,
-        'scale_factor_timestamp': scale_factor_timestamp,
-        'synch_epoch': synch_epoch,
-        'xeng_acc_len': xeng_acc_len,
-        'xeng_out_bits_per_sample': xeng_out_bits_per_sample,}
+def parameters(self):
+    """
+    Get all parameters you need to calculate dump time stamp or related.
+    Parameters are cached per instrument and accumulation length, see InstrumentParameters.
+    param: self: object
+    rtype: dict : int time, scale factor timestamp, sync time, n accs, and etc
+    """
+    if getattr(self.corr_fix, 'instrument_parameters', None) is None:
+        self.corr_fix.instrument_parameters = InstrumentParameters(self.corr_fix)
+    return self.corr_fix.instrument_parameters.get(self)
 
 def start_katsdpingest_docker(self, beam_ip, beam_port, partitions, channels=4096,
                               ticks_between_spectra=8192, channels_per_heap=256, spectra_per_heap=256):
@@ -1353,17 +1900,7 @@ def start_katsdpingest_docker(self, beam_ip, beam_port, partitions, channels=409
         LOGGER.exception(errmsg)
         return False
     time.sleep(5)
-    try:
-        output = subprocess.check_output(['docker','ps'])
-    except subprocess.CalledProcessError:
-        return False
-    output = output.split()
-    sdp_instance = [idx for idx,s in enumerate(output) if 'sdp-docker-registry.kat.ac.za' in s]
-    # If sdp-docker-registry not found it is not running, return false
-    if sdp_instance:
-        return True
-    else:
-        return False
+    return katsdpingest_docker_running()
 
 def stop_katsdpingest_docker(self):
     """ Finds if a katsdpingest docker containter is running and kills it.
@@ -1401,8 +1938,247 @@ def stop_katsdpingest_docker(self):
         return False
     return True
 
-def capture_beam_data(self, beam, beam_dict, target_pb, target_cfreq, capture_time=0.1):
-    """ Capture beamformer data
+def katsdpingest_docker_running():
+    """ Check whether a katsdpingest docker container is running
+
+    Returns
+    -------
+        True if a katsdpingest docker container is listed by docker ps
+    """
+    try:
+        output = subprocess.check_output(['docker', 'ps'])
+    except subprocess.CalledProcessError:
+        return False
+    return 'sdp-docker-registry.kat.ac.za' in output
+
+
+class BeamCaptureSession(object):
+    """Beamformer data captures through a KAT SDP ingest node, reusing setup between captures
+
+    One katsdpingest container and one KATCP connection to the ingest node are kept for the
+    whole test run, and beam passbands and input weights are only requested when they differ
+    from the values last set. The correlator fixture calls invalidate() whenever the
+    instrument changes, which drops the cached beam settings.
+    """
+    beamdata_dir = '/ramdisk'
+    _timeout = 60
+
+    def __init__(self, corr_fix):
+        self.corr_fix = corr_fix
+        self._client = None
+        self._ingest_args = None
+        # beam: ((target_pb, target_cfreq), (pb, cf))
+        self._passbands = {}
+        # (beam, input): weight
+        self._weights = {}
+        add_cleanup(self.close)
+
+    def invalidate(self, *args, **kwargs):
+        """Forget the beam passbands and weights set so far"""
+        self._passbands.clear()
+        self._weights.clear()
+
+    @property
+    def ingest_node(self):
+        beamformer_config = self.corr_fix._test_config_file['beamformer']
+        hostname = os.uname()[1]
+        if hostname in ('cmc2', 'cmc3'):
+            ingst_nd = beamformer_config['ingest_node_{}'.format(hostname)]
+        else:
+            ingst_nd = beamformer_config['ingest_node']
+        return ingst_nd, beamformer_config['ingest_node_port']
+
+    def start_ingest(self, test_obj, beam_ip, beam_port, partitions, channels=4096,
+                     ticks_between_spectra=8192, channels_per_heap=256, spectra_per_heap=256):
+        """Start a katsdpingest container, unless one with the same arguments is running
+
+        Returns
+        -------
+            True if a katsdpingest docker container is running
+        """
+        ingest_args = (beam_ip, beam_port, partitions, channels, ticks_between_spectra,
+                       channels_per_heap, spectra_per_heap)
+        if ingest_args == self._ingest_args and katsdpingest_docker_running():
+            LOGGER.info('Reusing running katsdpingest docker container')
+            return True
+        self._stop_client()
+        self._ingest_args = None
+        if start_katsdpingest_docker(test_obj, *ingest_args):
+            self._ingest_args = ingest_args
+            return True
+        return False
+
+    def stop_ingest(self):
+        self._stop_client()
+        if self._ingest_args is not None:
+            self._ingest_args = None
+            stop_katsdpingest_docker(self)
+
+    def close(self):
+        self.invalidate()
+        self.stop_ingest()
+
+    def _stop_client(self):
+        if self._client is not None:
+            self._client.stop()
+            self._client = None
+
+    def _ingest_client(self):
+        if self._client is not None and self._client.is_connected():
+            return self._client
+        self._stop_client()
+        ingst_nd, ingst_nd_p = self.ingest_node
+        client = katcp.BlockingClient(ingst_nd, ingst_nd_p)
+        client.setDaemon(True)
+        client.start()
+        if not client.wait_connected(self._timeout):
+            client.stop()
+            raise RuntimeError('Could not connect to %s:%s, timed out.' % (ingst_nd, ingst_nd_p))
+        self._client = client
+        return client
+
+    def _ingest_request(self, request):
+        try:
+            reply, informs = self._ingest_client().blocking_request(
+                katcp.Message.request(request), timeout=self._timeout)
+            assert reply.reply_ok()
+        except Exception:
+            # Reconnect on the next request
+            self._stop_client()
+            raise
+        return reply
+
+    def capture(self, test_obj, beam, beam_dict, target_pb, target_cfreq, capture_time=0.1,
+                lazy=False):
+        """Capture beamformer data, see capture_beam_data"""
+        beamdata_dir = self.beamdata_dir
+        ingst_nd, ingst_nd_p = self.ingest_node
+        dsim_clk_factor = 1.712e9 / test_obj.corr_freqs.sample_freq
+        cached = self._passbands.get(beam)
+        if cached is not None and cached[0] == (target_pb, target_cfreq):
+            pb, cf = cached[1]
+            Aqf.progress('Beam {} passband already set to {} at center frequency {}'.format(
+                beam, pb, cf))
+        else:
+            Aqf.step('Configure beam %s passband and set to desired center frequency(%s).' % (
+                beam, target_cfreq))
+            try:
+                reply, informs = self.corr_fix.katcp_rct.req.beam_passband(beam, target_pb,
+                                                                            target_cfreq)
+                assert reply.reply_ok()
+            except AssertionError:
+                self._passbands.pop(beam, None)
+                Aqf.failed('Beam passband not successfully set (requested cf = {}, pb = {}): {}'.format(
+                    target_cfreq, target_pb, reply.arguments))
+                return
+            else:
+                pb = float(reply.arguments[2]) * dsim_clk_factor
+                cf = float(reply.arguments[3]) * dsim_clk_factor
+                self._passbands[beam] = ((target_pb, target_cfreq), (pb, cf))
+                Aqf.progress('Beam {} passband set to {} at center frequency {}'.format(
+                    reply.arguments[1], pb, cf))
+
+        # Build new dictionary with only the requested beam keys:value pairs
+        in_wgts = {}
+        beam_pol = beam[-1]
+        for key in beam_dict:
+            if key.find(beam_pol) != -1:
+                in_wgts[key] = beam_dict[key]
+
+        for key in in_wgts:
+            if self._weights.get((beam, key)) == in_wgts[key]:
+                Aqf.progress('Antenna input {} weight already set to {}'.format(key, in_wgts[key]))
+                continue
+            Aqf.step('Confirm that the Input {} weight has been set to the desired weight.'.format(
+                key))
+            self._weights.pop((beam, key), None)
+            try:
+                reply, informs = self.corr_fix.katcp_rct.req.beam_weights(beam, key, in_wgts[key])
+                assert reply.reply_ok()
+            except AssertionError:
+                Aqf.failed('Beam weights not successfully set')
+            except Exception as e:
+                errmsg = 'Test failed due to %s' % str(e)
+                Aqf.failed(errmsg)
+                LOGGER.exception(errmsg)
+            else:
+                self._weights[(beam, key)] = in_wgts[key]
+                Aqf.passed('Antenna input {} weight set to {}\n'.format(key, reply.arguments[1]))
+
+        try:
+            LOGGER.info('Issue a beam data capture-initialisation cmd and issue metadata via CAM int')
+            self._ingest_request('capture-init')
+        except Exception:
+            errmsg = 'Failed to issues capture-init on %s:%s' % (ingst_nd, ingst_nd_p)
+            LOGGER.exception(errmsg)
+            Aqf.failed(errmsg)
+
+        try:
+            for i in xrange(2):
+                reply, informs = self.corr_fix.katcp_rct.req.capture_meta(beam)
+            errmsg = 'Failed to issue new Metadata: {}'.format(str(reply))
+            assert reply.reply_ok(), errmsg
+            reply, informs = self.corr_fix.katcp_rct.req.capture_start(beam)
+        except AssertionError:
+            errmsg = ' .'.join([errmsg, 'Failed to start Data transmission.'])
+            Aqf.failed(errmsg)
+        else:
+            LOGGER.info('Capture-init successfully issued on %s and Data transmission for '
+                        'beam %s started' % (ingst_nd, beam))
+        Aqf.wait(capture_time, 'Capturing beam data for ')
+        try:
+            LOGGER.info('Issue data capture stop via CAM int')
+            reply, informs = self.corr_fix.katcp_rct.req.capture_stop(beam)
+            assert reply.reply_ok()
+        except AssertionError:
+            errmsg = 'Failed to stop Data transmission.'
+            Aqf.failed(errmsg)
+            LOGGER.exception(errmsg)
+
+        try:
+            self._ingest_request('capture-done')
+        except Exception:
+            errmsg = ('Failed to issue capture-done kcpcmd command on %s:%s' % (ingst_nd, ingst_nd_p))
+            Aqf.failed(errmsg)
+            LOGGER.error(errmsg)
+            return
+        else:
+            LOGGER.info('Data capture-done issued on %s and Data transmission for beam %s stopped.' % (
+                ingst_nd, beam))
+
+        try:
+            LOGGER.info('Getting latest beam data captured in %s' % beamdata_dir)
+            newest_f = max(glob.iglob('%s/*.h5' % beamdata_dir), key=os.path.getctime)
+            _timestamp = int(newest_f.split('/')[-1].split('.')[0])
+            newest_f_timestamp = time.strftime("%H:%M:%S", time.localtime(_timestamp))
+        except ValueError as e:
+            Aqf.failed('Failed to get the latest beamformer data: %s' % str(e))
+            return
+        else:
+            Aqf.progress('Reading h5py data file(%s)[%s] and extracting the beam data.\n' % (newest_f,
+                newest_f_timestamp))
+            capture = BeamCaptureFile(newest_f, remove_on_close=True)
+            if lazy:
+                return capture, capture.bf_flags, capture.bf_ts, in_wgts, pb, cf
+            with capture:
+                bf_raw = np.array(capture.bf_raw)
+            return bf_raw, capture.bf_flags, capture.bf_ts, in_wgts, pb, cf
+
+
+def beam_capture_session(self):
+    """
+    Get the beam capture session shared by all tests, see BeamCaptureSession.
+    param: self: object
+    rtype: BeamCaptureSession
+    """
+    if getattr(self.corr_fix, 'beam_capture_session', None) is None:
+        self.corr_fix.beam_capture_session = BeamCaptureSession(self.corr_fix)
+    return self.corr_fix.beam_capture_session
+
+
+def capture_beam_data(self, beam, beam_dict, target_pb, target_cfreq, capture_time=0.1,
+                      lazy=False):
+    """ Capture beamformer data using the shared BeamCaptureSession
 
     Parameters
     ----------
@@ -1417,11 +2193,14 @@ def capture_beam_data(self, beam, beam_dict, target_pb, target_cfreq, capture_ti
         Target center frequency in Hz
     capture_time:
         Number of seconds to capture beam data
+    lazy:
+        Do not read bf_raw into memory, return an open BeamCaptureFile in its place.
+        The caller must close it, which removes the capture file.
 
     Returns
     -------
         bf_raw:
-            Raw beamformer data for the selected beam
+            Raw beamformer data for the selected beam, or BeamCaptureFile if lazy
         cap_ts:
             Captured timestamps, dropped packet timestamps will not be
             present
@@ -1429,139 +2208,135 @@ def capture_beam_data(self, beam, beam_dict, target_pb, target_cfreq, capture_ti
             Expected timestamps
 
     """
-    beamdata_dir = '/ramdisk'
-    _timeout = 60
-    if os.uname()[1] == 'cmc2':
-        ingst_nd = self.corr_fix._test_config_file['beamformer']['ingest_node_cmc2']
-    elif os.uname()[1] == 'cmc3':
-        ingst_nd = self.corr_fix._test_config_file['beamformer']['ingest_node_cmc3']
-    else:
-        ingst_nd = self.corr_fix._test_config_file['beamformer']['ingest_node']
+    return beam_capture_session(self).capture(self, beam, beam_dict, target_pb, target_cfreq,
+                                              capture_time=capture_time, lazy=lazy)
 
-    ingst_nd_p = self.corr_fix._test_config_file['beamformer']['ingest_node_port']
 
-    dsim_clk_factor = 1.712e9 / self.corr_freqs.sample_freq
-    Aqf.step('Configure beam %s passband and set to desired center frequency(%s).'%(beam,
-        target_cfreq))
-    try:
-        reply, informs = self.corr_fix.katcp_rct.req.beam_passband(beam, target_pb, target_cfreq)
-        assert reply.reply_ok()
-    except AssertionError:
-        Aqf.failed('Beam passband not successfully set (requested cf = {}, pb = {}): {}'.format(
-            target_cfreq, target_pb, reply.arguments))
-        return
+BeamCaptureStats = namedtuple('BeamCaptureStats',
+                              'n_spectra mean_magnitude mean_power std_power first_sample')
+
+
+def beam_heap_mask(n_spectra, spectra_per_heap=1, heap_flags=None, bf_ts=None, cap_ts=None):
+    """Boolean mask of valid spectra in a beam capture
+
+    :param n_spectra: int, number of spectra (bf_raw.shape[1])
+    :param spectra_per_heap: int, number of spectra carried in one heap
+    :param heap_flags: array, non-zero for missed heaps, shape (heaps,) or (partitions, heaps)
+    :param bf_ts: array, expected timestamp per spectrum
+    :param cap_ts: array, timestamps that were actually captured
+    :rtype: numpy.ndarray(bool) of shape (n_spectra,)
+    """
+    valid = np.ones(n_spectra, dtype=bool)
+    if heap_flags is not None:
+        heap_flags = np.asarray(heap_flags)
+        if heap_flags.ndim > 1:
+            heap_flags = heap_flags.sum(axis=0)
+        heap_ok = np.repeat(heap_flags == 0, spectra_per_heap)[:n_spectra]
+        valid[heap_ok.size:] = False
+        valid[:heap_ok.size] &= heap_ok
+    if bf_ts is not None and cap_ts is not None:
+        bf_ts = np.asarray(bf_ts)[:n_spectra]
+        valid[bf_ts.size:] = False
+        valid[:bf_ts.size] &= np.in1d(bf_ts, cap_ts)
+    return valid
+
+
+def unpack_beam_capture(bf_raw, valid=None, channels=None, chunk_size=1024):
+    """Per-channel voltage and power statistics of a beam capture
+
+    bf_raw is reduced in contiguous blocks of chunk_size spectra, so no list of per-spectrum
+    complex arrays is built and peak memory is bounded by the block size. bf_raw may be a lazy
+    h5py dataset (see BeamCaptureFile), in which case only one block is read at a time; use a
+    multiple of the spectra per heap as chunk_size to keep reads heap aligned.
+
+    :param bf_raw: array or h5py.Dataset, int8 beam data of shape (channels, spectra, 2)
+    :param valid: array(bool), spectra to include, see beam_heap_mask
+    :param channels: slice, channels to include
+    :param chunk_size: int, number of spectra reduced at a time
+    :rtype: BeamCaptureStats
+    """
+    if channels is None:
+        channels = slice(None)
+    n_spectra = bf_raw.shape[1]
+    if valid is None:
+        valid = np.ones(n_spectra, dtype=bool)
     else:
-        pb = float(reply.arguments[2]) * dsim_clk_factor
-        cf = float(reply.arguments[3]) * dsim_clk_factor
-        Aqf.progress('Beam {} passband set to {} at center frequency {}'.format(
-            reply.arguments[1], pb, cf))
-
-    # Build new dictionary with only the requested beam keys:value pairs
-    in_wgts = {}
-    beam_pol = beam[-1]
-    for key in beam_dict:
-        if key.find(beam_pol) != -1:
-            in_wgts[key] = beam_dict[key]
+        valid = np.asarray(valid)[:n_spectra]
+    count = int(np.count_nonzero(valid))
+    if count == 0:
+        return BeamCaptureStats(0, None, None, None, None)
+    n_chans = len(xrange(*channels.indices(bf_raw.shape[0])))
+    mag_sum = np.zeros(n_chans)
+    pwr_sum = np.zeros(n_chans)
+    pwr_sq_sum = np.zeros(n_chans)
+    first_sample = None
+    for start in xrange(0, valid.size, chunk_size):
+        keep = valid[start:start + chunk_size]
+        if not keep.any():
+            continue
+        chunk = bf_raw[channels, start:start + keep.size]
+        if not keep.all():
+            chunk = chunk[:, keep]
+        if first_sample is None:
+            first_sample = complex(*chunk[0, 0])
+        chunk = chunk.astype(np.float32)
+        power = np.square(chunk).sum(axis=-1)
+        mag_sum += np.sqrt(power).sum(axis=1)
+        pwr_sum += power.sum(axis=1)
+        pwr_sq_sum += np.square(power, dtype=np.float64).sum(axis=1)
+    mean_power = pwr_sum / count
+    if count > 1:
+        std_power = np.sqrt(np.maximum(pwr_sq_sum - count * mean_power ** 2, 0) / (count - 1))
+    else:
+        std_power = np.zeros(n_chans)
+    return BeamCaptureStats(count, mag_sum / count, mean_power, std_power, first_sample)
 
-    for key in in_wgts:
-        Aqf.step('Confirm that the Input {} weight has been set to the desired weight.'.format(
-            key))
-        try:
-            reply, informs = self.corr_fix.katcp_rct.req.beam_weights(beam, key, in_wgts[key])
-            assert reply.reply_ok()
-        except AssertionError:
-            Aqf.failed('Beam weights not successfully set')
-        except Exception as e:
-            errmsg = 'Test failed due to %s'%str(e)
-            Aqf.failed(errmsg)
-            LOGGER.exception(errmsg)
-        else:
-            Aqf.passed('Antenna input {} weight set to {}\n'.format(key, reply.arguments[1]))
 
-    try:
-        import katcp
-        kcp_client = katcp.BlockingClient(ingst_nd, ingst_nd_p)
-        kcp_client.setDaemon(True)
-        kcp_client.start()
-        self.addCleanup(kcp_client.stop)
-        is_connected = kcp_client.wait_connected(_timeout)
-        if not is_connected:
-            errmsg = 'Could not connect to %s:%s, timed out.' %(ingst_nd, ingst_nd_p)
-            kcp_client.stop()
-            raise RuntimeError(errmsg)
-        LOGGER.info('Issue a beam data capture-initialisation cmd and issue metadata via CAM int')
-        reply, informs = kcp_client.blocking_request(katcp.Message.request('capture-init'),
-            timeout=_timeout)
-        errmsg = 'Failed to issues capture-init on %s:%s'%(ingst_nd, ingst_nd_p)
-        assert reply.reply_ok(), errmsg
-    except Exception:
-        LOGGER.exception(errmsg)
-        Aqf.failed(errmsg)
+class BeamCaptureFile(object):
+    """Lazy view of a beam capture HDF5 file written by the ingest node
 
+    The timestamp and flag datasets are small and read on open; bf_raw is left as an
+    h5py dataset so that it can be reduced in chunks with unpack_beam_capture.
 
-    try:
-        for i in xrange(2):
-            reply, informs = self.corr_fix.katcp_rct.req.capture_meta(beam)
-        errmsg = 'Failed to issue new Metadata: {}'.format(str(reply))
-        assert reply.reply_ok(), errmsg
-        reply, informs = self.corr_fix.katcp_rct.req.capture_start(beam)
-    except AssertionError:
-        errmsg = ' .'.join([errmsg, 'Failed to start Data transmission.'])
-        Aqf.failed(errmsg)
-    else:
-        LOGGER.info('Capture-init successfully issued on %s and Data transmission for '
-                    'beam %s started'%(ingst_nd, beam))
-    Aqf.wait(capture_time, 'Capturing beam data for ')
-    try:
-        LOGGER.info('Issue data capture stop via CAM int')
-        reply, informs = self.corr_fix.katcp_rct.req.capture_stop(beam)
-        assert reply.reply_ok()
-    except AssertionError:
-        errmsg = 'Failed to stop Data transmission.'
-        Aqf.failed(errmsg)
-        LOGGER.exception(errmsg)
+    Usage:
+        with BeamCaptureFile(filename) as capture:
+            stats = unpack_beam_capture(capture.bf_raw, ...)
+    """
 
-    try:
-        if not is_connected:
-            kcp_client.stop()
-            raise RuntimeError('Could not connect to corr2_servlet, timed out.')
+    def __init__(self, filename, remove_on_close=False):
+        """
+        :param filename: str, HDF5 file path
+        :param remove_on_close: bool, delete the file when closed
+        """
+        self.filename = filename
+        self.remove_on_close = remove_on_close
+        self.bf_raw = self.bf_ts = self.cap_ts = self.bf_flags = None
+        self._h5 = h5py.File(filename, 'r')
+        for element in self._h5['Data'].values():
+            if element.name.find('captured_timestamps') > -1:
+                self.cap_ts = np.array(element.value)
+            elif element.name.find('bf_raw') > -1:
+                self.bf_raw = element
+            elif element.name.find('timestamps') > -1:
+                self.bf_ts = np.array(element.value)
+            elif element.name.find('flags') > -1:
+                self.bf_flags = np.array(element.value)
+
+    def close(self):
+        if self._h5 is None:
+            return
+        self._h5.close()
+        self._h5 = None
+        self.bf_raw = None
+        if self.remove_on_close:
+            os.remove(self.filename)
 
-        reply, informs = kcp_client.blocking_request(katcp.Message.request('capture-done'),
-            timeout=_timeout)
-        assert reply.reply_ok()
-    except Exception:
-        errmsg = ('Failed to issue capture-done kcpcmd command on %s:%s' % (ingst_nd, ingst_nd_p))
-        Aqf.failed(errmsg)
-        LOGGER.error(errmsg)
-        return
-    else:
-        LOGGER.info('Data capture-done issued on %s and Data transmission for beam %s stopped.'%(
-            ingst_nd, beam))
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    try:
-        LOGGER.info('Getting latest beam data captured in %s'%beamdata_dir)
-        newest_f = max(glob.iglob('%s/*.h5'%beamdata_dir), key=os.path.getctime)
-        _timestamp = int(newest_f.split('/')[-1].split('.')[0])
-        newest_f_timestamp = time.strftime("%H:%M:%S", time.localtime(_timestamp))
-    except ValueError as e:
-        Aqf.failed('Failed to get the latest beamformer data: %s'%str(e))
-        return
-    else:
-        Aqf.progress('Reading h5py data file(%s)[%s] and extracting the beam data.\n'%(newest_f,
-            newest_f_timestamp))
-        with h5py.File(newest_f, 'r') as fin:
-            data = fin['Data'].values()
-            for element in data:
-                if element.name.find('captured_timestamps') > -1:
-                    cap_ts = np.array(element.value)
-                elif element.name.find('bf_raw') > -1:
-                    bf_raw = np.array(element.value)
-                elif element.name.find('timestamps') > -1:
-                    bf_ts = np.array(element.value)
-                elif element.name.find('flags') > -1:
-                    bf_flags = np.array(element.value)
-        os.remove(newest_f)
-        return bf_raw, bf_flags, bf_ts, in_wgts, pb, cf
 
 def populate_beam_dict(self, num_wgts_to_set, value, beam_dict):
     """
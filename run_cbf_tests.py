@@ -79,6 +79,13 @@ def option_parser():
                       help="Do a dry run. Print commands that would be called as well as generate"
                            "test procedures")
 
+    parser.add_option("--digital-twin",
+                      dest="digital_twin",
+                      action="store_true",
+                      default=False,
+                      help="Run the tests against the offline digital twin of the correlator "
+                           "instead of CBF hardware")
+
     parser.add_option("--available-tests",
                       dest="available-tests",
                       action="store_true",
@@ -214,6 +221,9 @@ def run_command(settings, log_func, cmd, log_filename=None, stdout=False, stderr
         log_func('INFO', *cmd)
         os.environ['DRY_RUN'] = 'True'
 
+    if settings.get('digital_twin'):
+        os.environ['DIGITAL_TWIN'] = 'True'
+
     if settings.get('available-tests'):
         # nosetests -vv collect-only
         if cmd[0].endswith('nosetests'):
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 from mkat_fpga_tests import correlator_fixture
+from mkat_fpga_tests.utils import decode_snapshot
 from optparse import OptionParser
 import matplotlib.pyplot as plt
 import numpy as np
@@ -59,9 +60,7 @@ if __name__ == "__main__":
     reply,informs = corr_fix.katcp_rct.req.adc_snapshot(inp)
     if reply.reply_ok():
         msg = informs[0]
-        adc_data = msg.arguments[1]
-        adc_data = adc_data[1:-1]
-        adc_data = map(float,adc_data.split(','))
+        adc_data = decode_snapshot(msg.arguments[1])
     if opts.raw:
         plt.figure()
         plt.plot(adc_data)
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 from mkat_fpga_tests import correlator_fixture
+from mkat_fpga_tests.utils import decode_snapshot
 from optparse import OptionParser
 import matplotlib.pyplot as plt
 import numpy as np
@@ -59,7 +60,7 @@ if __name__ == "__main__":
         reply, informs = corr_fix.katcp_rct.req.quantiser_snapshot(inp)
     except Exception:
         Aqf.failed('Failed to grab quantiser snapshot.')
-    quant_snap = [eval(v) for v in (reply.arguments[2:])]
+    quant_snap = decode_snapshot(reply.arguments[2:])
     if opts.raw:
         plt.figure()
         plt.plot(quant_snap)